@@ -4,6 +4,8 @@ import threading
 import requests
 from datetime import datetime
 import logging
+from src.models.user import db
+from src.services.tasks import accoda
 
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
@@ -12,15 +14,17 @@ logger = logging.getLogger(__name__)
 class CronJobManager:
     def __init__(self, base_url='http://localhost:8000'):
         self.base_url = base_url
+        self.app = None
         self.running = False
         self.thread = None
     
-    def start(self):
-        """Avvia il sistema di cron job"""
+    def start(self, app=None):
+        """Avvia il sistema di cron job (app serve ai job che accodano task nel processo)"""
         if self.running:
             logger.warning("Cron job manager già in esecuzione")
             return
         
+        self.app = app
         self.running = True
         
         # Schedula i job
@@ -48,6 +52,9 @@ class CronJobManager:
         # Aggiornamento leaderboard ogni ora (per test e aggiornamenti frequenti)
         schedule.every().hour.do(self.update_leaderboard_job)
         
+        # Classifiche dei promotori consigliati alle aziende ogni giorno alle 03:00
+        schedule.every().day.at("03:00").do(self.update_promotori_consigliati_job)
+        
         # Job di test ogni 5 minuti (solo per sviluppo)
         # schedule.every(5).minutes.do(self.test_job)
         
@@ -71,7 +78,7 @@ class CronJobManager:
             # Chiama l'API per aggiornare la leaderboard
             response = requests.post(f"{self.base_url}/api/leaderboard/update-all")
             
-            if response.status_code == 200:
+            if response.status_code in (200, 202):
                 data = response.json()
                 logger.info(f"Leaderboard aggiornata: {data.get('message', 'Successo')}")
             else:
@@ -80,6 +87,22 @@ class CronJobManager:
         except Exception as e:
             logger.error(f"Errore nel job di aggiornamento leaderboard: {e}")
     
+    def update_promotori_consigliati_job(self):
+        """Job per ricalcolare le classifiche dei promotori consigliati: accoda il task nel processo, senza endpoint HTTP"""
+        try:
+            if self.app is None:
+                logger.error("Promotori consigliati: app non configurata, ricalcolo non accodato")
+                return
+            
+            with self.app.app_context():
+                nuovo = accoda("aggiorna_classifiche_promotori", chiave="aggiorna_classifiche_promotori")
+                db.session.commit()
+            
+            logger.info("Ricalcolo classifiche accodato" if nuovo else "Ricalcolo classifiche già in coda")
+                
+        except Exception as e:
+            logger.error(f"Errore nel job dei promotori consigliati: {e}")
+    
     def test_job(self):
         """Job di test"""
         logger.info(f"Test job eseguito alle {datetime.now()}")
@@ -99,9 +122,9 @@ class CronJobManager:
 # Istanza globale del manager
 cron_manager = CronJobManager()
 
-def start_cron_jobs():
+def start_cron_jobs(app=None):
     """Funzione per avviare i cron job"""
-    cron_manager.start()
+    cron_manager.start(app)
 
 def stop_cron_jobs():
     """Funzione per fermare i cron job"""
@@ -7,6 +7,12 @@ from flask import Flask, send_from_directory
 from flask_cors import CORS
 from src.models.user import db
 from src.models.leaderboard import LeaderboardEntry  # Import del modello leaderboard
+from src.models.contatori import ContatoriRichieste  # Contatori dashboard aziende (registra anche il listener)
+from src.models.raccomandazioni import PromotoreConsigliato  # Classifiche promotori consigliati
+from src.models.eliminazione import EliminazioneAccount  # Job di eliminazione degli account
+from src.models.task import Task  # Coda persistente dei task in background
+from src.models.outbox import EventoOutbox  # Outbox degli eventi di dominio
+from src.models.screenshot import Screenshot  # Screenshot e blob dell'archivio per hash
 from src.routes.user import user_bp
 from src.routes.auth import auth_bp
 from src.routes.promotore import promotore_bp
@@ -17,11 +23,20 @@ from src.routes.leaderboard import leaderboard_bp
 from src.routes.subscription import subscription_bp
 from src.routes.perk_points import perk_points_bp
 from src.cron_jobs import start_cron_jobs
+from src.services.session_store import ServerSideSessionInterface, CachedSessionStore, DatabaseSessionStore
+from src.services.eventi import set_broker, PostgresBroker
+from src.services.autocompletamento import indice_autocompletamento
+from src.services.tasks import pool_task
+from src.services.outbox import dispatcher_outbox
+from src.services import sottoscrittori  # Registra i sottoscrittori degli eventi dell'outbox
 import atexit
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 
+# Sessioni lato server: nel cookie viaggia solo un token casuale, i dati restano nel database
+app.session_interface = ServerSideSessionInterface(CachedSessionStore(DatabaseSessionStore()))
+
 # Abilita CORS per tutte le route
 CORS(app, supports_credentials=True)
 
@@ -44,6 +59,19 @@ app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql://postgres.rfwwpmwdpzgbtkdoo
 db.init_app(app)
 with app.app_context():
     db.create_all()
+    # Suggerimenti di ricerca serviti dalla memoria, senza query a ogni tasto
+    indice_autocompletamento.costruisci()
+
+# Worker dei task in background (riprende anche quelli interrotti da un riavvio)
+pool_task.avvia(app)
+
+# Consegna degli eventi dell'outbox e invalidazione delle cache scritte dagli altri processi
+dispatcher_outbox.avvia(app)
+
+# Broker delle notifiche push: in memoria di default; con più worker impostare EVENTI_BROKER_DSN
+# (connessione Postgres diretta, il pooler in transaction mode non supporta LISTEN)
+if os.environ.get('EVENTI_BROKER_DSN'):
+    set_broker(PostgresBroker(os.environ['EVENTI_BROKER_DSN']))
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -66,7 +94,7 @@ import atexit
 from src.cron_jobs import start_cron_jobs, stop_cron_jobs
 if __name__ == '__main__':
     # Avvia i cron job
-    start_cron_jobs()
+    start_cron_jobs(app)
     
     # Registra la funzione di cleanup per fermare i cron job alla chiusura
     from src.cron_jobs import stop_cron_jobs
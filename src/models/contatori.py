@@ -0,0 +1,143 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from src.models.user import db, Azienda, Richiesta, violazione_unicita
+
+logger = logging.getLogger(__name__)
+
+# Colonna del contatore per ciascuno stato della richiesta
+COLONNE_STATO = {
+    'In sospeso': 'in_sospeso',
+    'Accettata': 'accettate',
+    'Rifiutata': 'rifiutate',
+    'Controproposta': 'controproposta',
+    'In negoziazione': 'in_negoziazione',
+}
+
+class ContatoriRichieste(db.Model):
+    __tablename__ = 'contatori_richieste'
+
+    # Una riga per azienda: la dashboard diventa una lettura per chiave primaria
+    azienda_id = db.Column(db.Integer, db.ForeignKey('azienda.id'), primary_key=True)
+    in_sospeso = db.Column(db.Integer, nullable=False, default=0)
+    accettate = db.Column(db.Integer, nullable=False, default=0)
+    rifiutate = db.Column(db.Integer, nullable=False, default=0)
+    controproposta = db.Column(db.Integer, nullable=False, default=0)
+    in_negoziazione = db.Column(db.Integer, nullable=False, default=0)
+
+    # Metadati
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ContatoriRichieste {self.azienda_id}>'
+
+    def to_dict(self):
+        return {
+            'in_sospeso': self.in_sospeso,
+            'accettate': self.accettate,
+            'rifiutate': self.rifiutate,
+            'controproposta': self.controproposta,
+            'in_negoziazione': self.in_negoziazione
+        }
+
+    @staticmethod
+    def statistiche(azienda_id):
+        """
+        Contatori dell'azienda per la dashboard. Ogni azienda ha la sua riga dalla creazione;
+        se manca (dati non ancora migrati) i conteggi vengono calcolati senza scrivere nulla
+        """
+        contatori = db.session.get(ContatoriRichieste, azienda_id)
+        if contatori:
+            return contatori.to_dict()
+        return _conteggi_per_stato(azienda_id)
+
+    @staticmethod
+    def ricostruisci(azienda_id):
+        """
+        Ricalcola i contatori di un'azienda con una sola query GROUP BY stato (riparazione esplicita
+        delle derive, vedi update_db_indici.py). La riga viene bloccata prima del conteggio:
+        le transizioni concorrenti aggiornano la stessa riga, quindi o sono già nel conteggio
+        o applicano il loro delta dopo. Il commit spetta al chiamante
+        """
+        try:
+            with db.session.begin_nested():
+                db.session.add(ContatoriRichieste(azienda_id=azienda_id))
+        except IntegrityError as e:
+            if not violazione_unicita(e):
+                raise
+        contatori = db.session.scalars(
+            select(ContatoriRichieste)
+            .where(ContatoriRichieste.azienda_id == azienda_id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        ).one()
+
+        for colonna, totale in _conteggi_per_stato(azienda_id).items():
+            setattr(contatori, colonna, totale)
+        return contatori
+
+def _conteggi_per_stato(azienda_id):
+    conteggi = {colonna: 0 for colonna in COLONNE_STATO.values()}
+    for stato, totale in db.session.query(
+        Richiesta.stato, func.count(Richiesta.id)
+    ).filter(Richiesta.azienda_id == azienda_id).group_by(Richiesta.stato):
+        colonna = COLONNE_STATO.get(stato)
+        if colonna:
+            conteggi[colonna] = totale
+    return conteggi
+
+def applica_delta(connection, delta):
+    """
+    Applica le variazioni {azienda_id: {stato: +n/-n}} con UPDATE atomici (col = col + n).
+    Va eseguita nella stessa transazione della modifica alle richieste.
+    La riga di ogni azienda esiste dalla sua creazione; una riga mancante viene segnalata nel log
+    """
+    tabella = ContatoriRichieste.__table__
+    for azienda_id, variazioni in delta.items():
+        valori = {}
+        for stato, n in variazioni.items():
+            colonna = COLONNE_STATO.get(stato)
+            if colonna and n:
+                valori[colonna] = tabella.c[colonna] + n
+        if valori:
+            valori['updated_at'] = datetime.utcnow()
+            risultato = connection.execute(tabella.update().where(tabella.c.azienda_id == azienda_id).values(**valori))
+            if not risultato.rowcount:
+                logger.warning(f"Contatori mancanti per l'azienda {azienda_id}: eseguire update_db_indici.py")
+
+@event.listens_for(Azienda, 'after_insert')
+def _crea_contatori(mapper, connection, target):
+    # La riga nasce con l'azienda, nella stessa transazione: nessun delta può andare perso
+    connection.execute(ContatoriRichieste.__table__.insert().values(azienda_id=target.id))
+
+@event.listens_for(Richiesta.stato, 'set', active_history=True)
+def _carica_stato_precedente(target, value, oldvalue, initiator):
+    # Listener vuoto: active_history fa caricare lo stato precedente anche se non era in memoria,
+    # così before_flush conosce sempre da quale stato parte la transizione
+    pass
+
+@event.listens_for(Session, 'before_flush')
+def _aggiorna_contatori(session, flush_context, instances):
+    """Traduce inserimenti, cambi di stato ed eliminazioni di Richiesta in variazioni dei contatori"""
+    delta = defaultdict(lambda: defaultdict(int))
+
+    for obj in session.new:
+        if isinstance(obj, Richiesta):
+            delta[obj.azienda_id][obj.stato or 'In sospeso'] += 1
+
+    for obj in session.dirty:
+        if isinstance(obj, Richiesta):
+            storia = inspect(obj).attrs.stato.history
+            if storia.has_changes() and storia.deleted:
+                delta[obj.azienda_id][storia.deleted[0]] -= 1
+                delta[obj.azienda_id][obj.stato] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Richiesta):
+            delta[obj.azienda_id][obj.stato] -= 1
+
+    if delta:
+        applica_delta(session.connection(), delta)
@@ -0,0 +1,55 @@
+import secrets
+from datetime import datetime
+from src.models.user import db
+
+# Fasi dell'eliminazione di un account, nell'ordine in cui vengono eseguite
+FASI_ELIMINAZIONE = ['richieste', 'letture', 'classifiche', 'leaderboard', 'perk', 'abbonamenti', 'screenshot', 'profilo', 'file']
+
+class EliminazioneAccount(db.Model):
+    __tablename__ = 'eliminazione_account'
+
+    # Identificativo non indovinabile: lo stato resta consultabile anche dopo la revoca delle sessioni
+    id = db.Column(db.String(32), primary_key=True, default=lambda: secrets.token_urlsafe(16))
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # Nessuna FK: l'utente viene eliminato dal job
+    tipo_utente = db.Column(db.String(20), nullable=False)
+    percorso_file = db.Column(db.String(255), nullable=True)  # Cartella degli upload da rimuovere
+
+    # Avanzamento
+    stato = db.Column(db.String(20), nullable=False, default='In coda')  # 'In coda', 'In corso', 'Completata', 'Fallita'
+    fase = db.Column(db.String(20), nullable=True)
+    righe_eliminate = db.Column(db.Integer, nullable=False, default=0)
+    errore = db.Column(db.Text, nullable=True)
+
+    # Metadati
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<EliminazioneAccount {self.id} utente {self.user_id}>'
+
+    def to_dict(self):
+        if self.stato == 'Completata':
+            percentuale = 100
+        elif self.fase in FASI_ELIMINAZIONE:
+            percentuale = round(100 * FASI_ELIMINAZIONE.index(self.fase) / len(FASI_ELIMINAZIONE))
+        else:
+            percentuale = 0
+        return {
+            'id': self.id,
+            'stato': self.stato,
+            'fase': self.fase,
+            'percentuale': percentuale,
+            'righe_eliminate': self.righe_eliminate,
+            'errore': self.errore,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
+
+    @staticmethod
+    def in_corso(user_id):
+        """Eliminazione non ancora conclusa per l'utente, se esiste"""
+        return EliminazioneAccount.query.filter(
+            EliminazioneAccount.user_id == user_id,
+            EliminazioneAccount.stato.in_(['In coda', 'In corso'])
+        ).first()
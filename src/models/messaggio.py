@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from .user import db
 
@@ -13,6 +14,17 @@ class Messaggio(db.Model):
     
     richiesta = db.relationship('Richiesta', backref='messaggi')
 
+    # Indice per la lettura paginata della conversazione (since_id / before_id)
+    # e indice GIN full-text sul contenuto (solo Postgres; altrove si usa l'indice in memoria)
+    __table_args__ = (
+        db.Index('ix_messaggio_richiesta_data', 'richiesta_id', 'data_creazione', 'id'),
+        db.Index(
+            'ix_messaggio_contenuto_fts',
+            db.func.to_tsvector(db.literal_column("'italian'"), contenuto),
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+    )
+
     def __repr__(self):
         return f'<Messaggio {self.id}>'
 
@@ -27,3 +39,59 @@ class Messaggio(db.Model):
             'data_creazione': self.data_creazione.isoformat() if self.data_creazione else None
         }
 
+
+class LetturaConversazione(db.Model):
+    """Cursore di lettura e contatore dei non letti di un utente per una richiesta"""
+    __tablename__ = 'lettura_conversazione'
+
+    # utente_id per primo: i non letti di un utente sono un intervallo contiguo della chiave primaria
+    utente_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    richiesta_id = db.Column(db.Integer, db.ForeignKey('richiesta.id'), primary_key=True)
+    non_letti = db.Column(db.Integer, nullable=False, default=0)
+    ultimo_letto_id = db.Column(db.Integer, nullable=True)  # Ultimo messaggio visto dall'utente
+    data_aggiornamento = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<LetturaConversazione {self.utente_id}/{self.richiesta_id}: {self.non_letti}>'
+
+    @staticmethod
+    def _aggiorna_o_crea(utente_id, richiesta_id, valori, valori_nuovo):
+        """UPDATE della riga esistente o, se manca, INSERT in un savepoint (gestisce inserimenti concorrenti)"""
+        tabella = LetturaConversazione.__table__
+        condizione = (tabella.c.utente_id == utente_id) & (tabella.c.richiesta_id == richiesta_id)
+
+        result = db.session.execute(tabella.update().where(condizione).values(**valori))
+        if result.rowcount:
+            return
+
+        try:
+            with db.session.begin_nested():
+                db.session.execute(tabella.insert().values({
+                    'utente_id': utente_id,
+                    'richiesta_id': richiesta_id,
+                    'data_aggiornamento': datetime.utcnow(),
+                    **valori_nuovo
+                }))
+        except IntegrityError:
+            # Un'altra transazione ha creato la riga nel frattempo
+            db.session.execute(tabella.update().where(condizione).values(**valori))
+
+    @staticmethod
+    def incrementa(utente_id, richiesta_id, n=1):
+        """Aggiunge n messaggi non letti per l'utente (nella transazione corrente)"""
+        tabella = LetturaConversazione.__table__
+        LetturaConversazione._aggiorna_o_crea(
+            utente_id, richiesta_id,
+            {'non_letti': tabella.c.non_letti + n, 'data_aggiornamento': datetime.utcnow()},
+            {'non_letti': n}
+        )
+
+    @staticmethod
+    def segna_letti(utente_id, richiesta_id):
+        """Azzera i non letti dell'utente e sposta il cursore sull'ultimo messaggio della richiesta"""
+        ultimo_id = db.session.query(db.func.max(Messaggio.id)).filter(
+            Messaggio.richiesta_id == richiesta_id
+        ).scalar()
+        valori = {'non_letti': 0, 'ultimo_letto_id': ultimo_id, 'data_aggiornamento': datetime.utcnow()}
+        LetturaConversazione._aggiorna_o_crea(utente_id, richiesta_id, valori, valori)
+        return ultimo_id
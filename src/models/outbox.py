@@ -0,0 +1,36 @@
+import json
+from datetime import datetime
+from src.models.user import db
+
+class EventoOutbox(db.Model):
+    __tablename__ = 'evento_outbox'
+
+    # Evento di dominio scritto nella stessa transazione della modifica che lo genera:
+    # se la transazione viene annullata l'evento non esiste, se va a buon fine verrà consegnato
+    id = db.Column(db.Integer, primary_key=True)
+    aggregato = db.Column(db.String(30), nullable=False)  # 'richiesta', 'azienda', ...
+    aggregato_id = db.Column(db.Integer, nullable=False)
+    tipo = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Consegna ai sottoscrittori globali (una volta per evento, in ordine per aggregato)
+    consegnato_at = db.Column(db.DateTime, nullable=True)
+    tentativi = db.Column(db.Integer, nullable=False, default=0)
+    prossimo_tentativo = db.Column(db.DateTime, nullable=True)
+    errore = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        # Solo gli eventi ancora da consegnare: l'indice resta piccolo anche con molto storico
+        db.Index(
+            'ix_evento_outbox_da_consegnare', 'id',
+            postgresql_where=consegnato_at.is_(None), sqlite_where=consegnato_at.is_(None)
+        ),
+    )
+
+    def __repr__(self):
+        return f'<EventoOutbox {self.id} {self.aggregato}:{self.aggregato_id} {self.tipo}>'
+
+    @property
+    def dati(self):
+        return json.loads(self.payload or '{}')
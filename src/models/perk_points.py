@@ -240,6 +240,14 @@ def get_points_pricing():
         {'points': 1000, 'price': 59.99, 'bonus': 200, 'popular': False},
     ]
 
+# Punti di priorità assegnati da ciascun perk attivo
+PRIORITY_POINTS = {
+    PerkType.PRIORITY_LISTING: 1000,
+    PerkType.FEATURED_PROFILE: 500,
+    PerkType.BOOST_VISIBILITY: 300,
+    PerkType.PREMIUM_BADGE: 100,
+}
+
 def calculate_perk_priority_score(azienda_id):
     """Calcola il punteggio di priorità basato sui perk attivi"""
     active_perks = ActivePerk.query.filter_by(
@@ -247,19 +255,21 @@ def calculate_perk_priority_score(azienda_id):
         is_active=True
     ).filter(ActivePerk.end_date > datetime.utcnow()).all()
     
-    priority_score = 0
-    
-    for perk in active_perks:
-        if perk.perk_type == PerkType.PRIORITY_LISTING:
-            priority_score += 1000
-        elif perk.perk_type == PerkType.FEATURED_PROFILE:
-            priority_score += 500
-        elif perk.perk_type == PerkType.BOOST_VISIBILITY:
-            priority_score += 300
-        elif perk.perk_type == PerkType.PREMIUM_BADGE:
-            priority_score += 100
+    return sum(PRIORITY_POINTS.get(perk.perk_type, 0) for perk in active_perks)
+
+def calculate_perk_priority_scores():
+    """Punteggio di priorità di tutte le aziende con perk attivi, con una sola query raggruppata"""
+    righe = db.session.query(
+        ActivePerk.azienda_id, ActivePerk.perk_type, db.func.count(ActivePerk.id)
+    ).filter(
+        ActivePerk.is_active == True,
+        ActivePerk.end_date > datetime.utcnow()
+    ).group_by(ActivePerk.azienda_id, ActivePerk.perk_type).all()
     
-    return priority_score
+    scores = {}
+    for azienda_id, perk_type, count in righe:
+        scores[azienda_id] = scores.get(azienda_id, 0) + PRIORITY_POINTS.get(perk_type, 0) * count
+    return scores
 
 def cleanup_expired_perks():
     """Pulisce i perk scaduti (da chiamare periodicamente)"""
@@ -0,0 +1,35 @@
+from datetime import datetime
+from src.models.user import db
+
+class PromotoreConsigliato(db.Model):
+    __tablename__ = 'promotore_consigliato'
+
+    # Classifica materializzata dei promotori più adatti a ciascuna azienda (prime N posizioni):
+    # la lettura di una pagina è una scansione della chiave primaria
+    azienda_id = db.Column(db.Integer, db.ForeignKey('azienda.id'), primary_key=True)
+    posizione = db.Column(db.Integer, primary_key=True)
+    promotore_id = db.Column(db.Integer, db.ForeignKey('promotore.id'), nullable=False)
+    punteggio = db.Column(db.Float, nullable=False)
+
+    promotore = db.relationship('Promotore')
+
+    def __repr__(self):
+        return f'<PromotoreConsigliato {self.azienda_id} #{self.posizione}>'
+
+class StatoClassificaPromotori(db.Model):
+    __tablename__ = 'stato_classifica_promotori'
+
+    # Quando è stata calcolata la classifica di un'azienda e se va ricalcolata alla prossima lettura
+    azienda_id = db.Column(db.Integer, db.ForeignKey('azienda.id'), primary_key=True)
+    calcolata_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    obsoleta = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f'<StatoClassificaPromotori {self.azienda_id}>'
+
+    @staticmethod
+    def segna_obsoleta(azienda_id):
+        """Da chiamare nella stessa transazione che modifica il profilo dell'azienda"""
+        db.session.query(StatoClassificaPromotori).filter_by(azienda_id=azienda_id).update(
+            {'obsoleta': True}, synchronize_session=False
+        )
@@ -0,0 +1,45 @@
+from datetime import datetime
+from src.models.user import db
+
+class BlobScreenshot(db.Model):
+    __tablename__ = 'blob_screenshot'
+
+    # Contenuto di un file, identificato dallo SHA-256: lo stesso file caricato più volte è salvato una volta sola
+    hash = db.Column(db.String(64), primary_key=True)
+    dimensione = db.Column(db.Integer, nullable=False)
+    tipo_mime = db.Column(db.String(50), nullable=False)
+    # Screenshot che usano il blob: a zero il file viene rimosso dal disco
+    riferimenti = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<BlobScreenshot {self.hash[:12]} ({self.riferimenti} riferimenti)>'
+
+class Screenshot(db.Model):
+    __tablename__ = 'screenshot'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('blob_screenshot.hash'), nullable=False)
+    nome_file = db.Column(db.String(255), nullable=False)  # Nome originale (già ripulito)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    blob = db.relationship('BlobScreenshot')
+
+    __table_args__ = (
+        # Ricaricare la stessa immagine non crea un secondo screenshot per l'utente
+        db.UniqueConstraint('user_id', 'blob_hash', name='uq_screenshot_utente_blob'),
+    )
+
+    def __repr__(self):
+        return f'<Screenshot {self.id} di {self.user_id}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.nome_file,
+            'hash': self.blob_hash,
+            'dimensione': self.blob.dimensione if self.blob else None,
+            'url': f'/api/settings/screenshots/{self.id}/file',
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
@@ -0,0 +1,18 @@
+from datetime import datetime
+from src.models.user import db
+
+class ServerSession(db.Model):
+    __tablename__ = 'server_session'
+
+    # Token casuale compatto inviato nel cookie: è anche la chiave primaria (lookup O(1))
+    token = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True, index=True)  # Per la revoca di tutte le sessioni di un utente
+    data = db.Column(db.Text, nullable=False, default='{}')  # Contenuto della sessione in JSON
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # Indicizzato per la pulizia in blocco
+
+    # Metadati
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ServerSession {self.token[:6]}… user={self.user_id}>'
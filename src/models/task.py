@@ -0,0 +1,60 @@
+import json
+from datetime import datetime
+from src.models.user import db
+
+# Priorità dei task: numeri più bassi vengono eseguiti prima
+PRIORITA_ALTA = 10
+PRIORITA_NORMALE = 50
+PRIORITA_BASSA = 90
+
+class Task(db.Model):
+    __tablename__ = 'task'
+
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), nullable=False)  # Nome con cui il gestore è registrato
+    payload = db.Column(db.Text, nullable=False, default='{}')  # Argomenti del gestore in JSON
+    priorita = db.Column(db.Integer, nullable=False, default=PRIORITA_NORMALE)
+    chiave = db.Column(db.String(100), nullable=True)  # Facoltativa: un solo task in coda per chiave
+
+    # Esecuzione
+    stato = db.Column(db.String(20), nullable=False, default='In coda')  # 'In coda', 'In esecuzione', 'Completato', 'Fallito'
+    tentativi = db.Column(db.Integer, nullable=False, default=0)
+    max_tentativi = db.Column(db.Integer, nullable=False, default=5)
+    esegui_dopo = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Ritardo iniziale e backoff
+    errore = db.Column(db.Text, nullable=True)
+
+    # Metadati
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        # Prelievo del prossimo task: scansione dell'indice nell'ordine di esecuzione
+        db.Index('ix_task_coda', 'stato', 'priorita', 'esegui_dopo', 'id'),
+        db.Index(
+            'uq_task_chiave_in_coda', 'chiave', unique=True,
+            postgresql_where=db.and_(chiave.isnot(None), stato == 'In coda'),
+            sqlite_where=db.and_(chiave.isnot(None), stato == 'In coda')
+        ),
+    )
+
+    def __repr__(self):
+        return f'<Task {self.id} {self.nome}>'
+
+    @property
+    def argomenti(self):
+        return json.loads(self.payload or '{}')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'nome': self.nome,
+            'priorita': self.priorita,
+            'stato': self.stato,
+            'tentativi': self.tentativi,
+            'max_tentativi': self.max_tentativi,
+            'esegui_dopo': self.esegui_dopo.isoformat() if self.esegui_dopo else None,
+            'errore': self.errore,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
@@ -1,9 +1,19 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import DDL, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, validates
 from datetime import datetime
+from src.services.password_hasher import password_hasher
+from src.services.geo import geocodifica, geohash
 
 db = SQLAlchemy()
 
+# Estensione necessaria per gli indici a trigrammi delle aziende (solo Postgres)
+event.listen(
+    db.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -12,10 +22,15 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        # L'hashing avviene nel pool dedicato; solleva HasherSaturo se il pool è pieno
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        """True se l'hash salvato usa parametri diversi da quelli correnti"""
+        return password_hasher.needs_rehash(self.password_hash)
 
     def __repr__(self):
         return f'<User {self.email}>'
@@ -39,9 +54,38 @@ class Promotore(db.Model):
     foto_visualizzazioni_2_path = db.Column(db.String(255), nullable=True)
     foto_visualizzazioni_3_path = db.Column(db.String(255), nullable=True)
     ultimo_aggiornamento_insight = db.Column(db.DateTime, nullable=True)
+    # Dati usati per consigliare le aziende: pubblico medio dichiarato e zona del creator
+    visualizzazioni_medie = db.Column(db.Integer, nullable=True)
+    localita = db.Column(db.String(255), nullable=True)
+    latitudine = db.Column(db.Float, nullable=True)
+    longitudine = db.Column(db.Float, nullable=True)
     
     user = db.relationship('User', backref=db.backref('promotore', uselist=False))
 
+    # Indici per la ricerca dei promotori da parte delle aziende, ordinata per id:
+    # industry esatta e indici parziali che contengono solo chi ha il relativo link social
+    __table_args__ = (
+        db.Index('ix_promotore_industry', 'industry', 'id'),
+        db.Index(
+            'ix_promotore_con_instagram', 'id',
+            postgresql_where=instagram_link.isnot(None), sqlite_where=instagram_link.isnot(None)
+        ),
+        db.Index(
+            'ix_promotore_con_tiktok', 'id',
+            postgresql_where=tiktok_link.isnot(None), sqlite_where=tiktok_link.isnot(None)
+        ),
+        db.Index(
+            'ix_promotore_con_linkedin', 'id',
+            postgresql_where=linkedin_link.isnot(None), sqlite_where=linkedin_link.isnot(None)
+        ),
+    )
+
+    @validates('localita')
+    def _geocodifica_localita(self, key, localita):
+        coordinate = geocodifica(localita)
+        self.latitudine, self.longitudine = coordinate or (None, None)
+        return localita
+
     def __repr__(self):
         return f'<Promotore {self.id}>'
 
@@ -56,7 +100,9 @@ class Promotore(db.Model):
             'foto_visualizzazioni_1_path': self.foto_visualizzazioni_1_path,
             'foto_visualizzazioni_2_path': self.foto_visualizzazioni_2_path,
             'foto_visualizzazioni_3_path': self.foto_visualizzazioni_3_path,
-            'ultimo_aggiornamento_insight': self.ultimo_aggiornamento_insight.isoformat() if self.ultimo_aggiornamento_insight else None
+            'ultimo_aggiornamento_insight': self.ultimo_aggiornamento_insight.isoformat() if self.ultimo_aggiornamento_insight else None,
+            'visualizzazioni_medie': self.visualizzazioni_medie,
+            'localita': self.localita
         }
 
 class Azienda(db.Model):
@@ -65,9 +111,33 @@ class Azienda(db.Model):
     tipo_attivita = db.Column(db.String(255), nullable=False)
     min_visualizzazioni_richieste = db.Column(db.Integer, nullable=True)
     localita = db.Column(db.String(255), nullable=False)
+    # Coordinate della località secondo il gazetteer (None se la località non è riconosciuta)
+    latitudine = db.Column(db.Float, nullable=True)
+    longitudine = db.Column(db.Float, nullable=True)
+    geohash = db.Column(db.String(12), nullable=True)
     
     user = db.relationship('User', backref=db.backref('azienda', uselist=False))
 
+    # Indici GIN a trigrammi (solo Postgres, estensione pg_trgm): servono sia gli ILIKE '%...%'
+    # dei filtri sia la ricerca per somiglianza; altrove si usa l'indice in memoria.
+    # L'indice sul geohash serve le ricerche per distanza (intervalli di prefissi)
+    __table_args__ = tuple(
+        db.Index(
+            f'ix_azienda_{colonna}_trgm', colonna,
+            postgresql_using='gin',
+            postgresql_ops={colonna: 'gin_trgm_ops'}
+        ).ddl_if(dialect='postgresql')
+        for colonna in ('nome_attivita', 'tipo_attivita', 'localita')
+    ) + (db.Index('ix_azienda_geohash', 'geohash'),)
+
+    @validates('localita')
+    def _geocodifica_localita(self, key, localita):
+        # Le coordinate seguono sempre la località, anche quando viene modificata
+        coordinate = geocodifica(localita)
+        self.latitudine, self.longitudine = coordinate or (None, None)
+        self.geohash = geohash(*coordinate) if coordinate else None
+        return localita
+
     def __repr__(self):
         return f'<Azienda {self.nome_attivita}>'
 
@@ -77,14 +147,24 @@ class Azienda(db.Model):
             'nome_attivita': self.nome_attivita,
             'tipo_attivita': self.tipo_attivita,
             'min_visualizzazioni_richieste': self.min_visualizzazioni_richieste,
-            'localita': self.localita
+            'localita': self.localita,
+            'latitudine': self.latitudine,
+            'longitudine': self.longitudine
         }
 
+# Stati in cui una richiesta è ancora aperta: per ogni coppia promotore-azienda ce ne può essere una sola
+STATI_ATTIVI = ('In sospeso', 'In negoziazione', 'Controproposta')
+
+def violazione_unicita(errore):
+    """True se l'IntegrityError deriva da un vincolo di unicità (Postgres o SQLite)"""
+    originale = getattr(errore, 'orig', None)
+    return getattr(originale, 'pgcode', None) == '23505' or 'UNIQUE constraint failed' in str(originale)
+
 class Richiesta(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     promotore_id = db.Column(db.Integer, db.ForeignKey('promotore.id'), nullable=False)
     azienda_id = db.Column(db.Integer, db.ForeignKey('azienda.id'), nullable=False)
-    stato = db.Column(db.String(50), nullable=False, default='In sospeso')  # 'In sospeso', 'Accettata', 'Rifiutata', 'In negoziazione'
+    stato = db.Column(db.String(50), nullable=False, default='In sospeso')  # transizioni ammesse in src/services/stato_richieste.py
     messaggio_iniziale = db.Column(db.Text, nullable=False)  # Messaggio iniziale del promotore
     data_creazione = db.Column(db.DateTime, default=datetime.utcnow)
     data_aggiornamento = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -93,9 +173,60 @@ class Richiesta(db.Model):
     promotore = db.relationship('Promotore', backref='richieste_inviate')
     azienda = db.relationship('Azienda', backref='richieste_ricevute')
 
+    # Indici per la paginazione keyset delle inbox: filtro per parte (ed eventualmente stato),
+    # poi ordinamento per (data, id) così ogni pagina è una scansione di un intervallo dell'indice
+    __table_args__ = (
+        db.Index('ix_richiesta_azienda_stato_creazione', 'azienda_id', 'stato', 'data_creazione', 'id'),
+        db.Index('ix_richiesta_promotore_stato_creazione', 'promotore_id', 'stato', 'data_creazione', 'id'),
+        db.Index('ix_richiesta_azienda_creazione', 'azienda_id', 'data_creazione', 'id'),
+        db.Index('ix_richiesta_promotore_creazione', 'promotore_id', 'data_creazione', 'id'),
+        db.Index('ix_richiesta_azienda_aggiornamento', 'azienda_id', 'data_aggiornamento', 'id'),
+        db.Index('ix_richiesta_promotore_aggiornamento', 'promotore_id', 'data_aggiornamento', 'id'),
+        # Al massimo una richiesta attiva per coppia: il controllo dei duplicati è il vincolo stesso
+        db.Index(
+            'uq_richiesta_attiva', 'promotore_id', 'azienda_id', unique=True,
+            postgresql_where=stato.in_(STATI_ATTIVI), sqlite_where=stato.in_(STATI_ATTIVI)
+        ),
+        # Ricerca full-text sul messaggio iniziale (solo Postgres)
+        db.Index(
+            'ix_richiesta_messaggio_fts',
+            db.func.to_tsvector(db.literal_column("'italian'"), messaggio_iniziale),
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+    )
+
     def __repr__(self):
         return f'<Richiesta {self.id}>'
 
+    @staticmethod
+    def crea(promotore_id, azienda_id, messaggio_iniziale):
+        """
+        Inserisce una nuova richiesta in sospeso nella transazione corrente.
+        Restituisce None se la coppia ha già una richiesta attiva (vincolo uq_richiesta_attiva)
+        """
+        richiesta = Richiesta(
+            promotore_id=promotore_id,
+            azienda_id=azienda_id,
+            messaggio_iniziale=messaggio_iniziale,
+            stato='In sospeso'
+        )
+        try:
+            with db.session.begin_nested():
+                db.session.add(richiesta)
+        except IntegrityError as e:
+            if not violazione_unicita(e):
+                raise
+            return None
+        return richiesta
+
+    @staticmethod
+    def query_con_dettagli():
+        """Query sulle richieste con promotore, azienda e relativi utenti caricati nella stessa SELECT"""
+        return Richiesta.query.options(
+            joinedload(Richiesta.promotore).joinedload(Promotore.user),
+            joinedload(Richiesta.azienda).joinedload(Azienda.user)
+        )
+
     def to_dict(self, include_sensitive_data=False):
         """
         Restituisce i dati della richiesta.
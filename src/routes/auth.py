@@ -1,5 +1,9 @@
 from flask import Blueprint, request, jsonify, session
 from src.models.user import db, User, Promotore, Azienda
+from src.models.eliminazione import EliminazioneAccount
+from src.services.current_user import require_auth
+from src.services.password_hasher import HasherSaturo
+from src.services.ricerca_aziende import registra_azienda_aggiornata
 from datetime import datetime
 
 auth_bp = Blueprint('auth', __name__)
@@ -55,7 +59,9 @@ def register():
                 industry=industry,
                 instagram_link=data.get('instagram_link'),
                 tiktok_link=data.get('tiktok_link'),
-                linkedin_link=data.get('linkedin_link')
+                linkedin_link=data.get('linkedin_link'),
+                visualizzazioni_medie=data.get('visualizzazioni_medie'),
+                localita=data.get('localita')
             )
             db.session.add(promotore)
             
@@ -72,10 +78,13 @@ def register():
                 localita=data['localita']
             )
             db.session.add(azienda)
+            # Gli indici di ricerca di ogni processo si aggiornano dopo il commit
+            registra_azienda_aggiornata(azienda)
         
         db.session.commit()
         
-        # Login automatico dopo registrazione
+        # Login automatico dopo registrazione (nuovo token di sessione)
+        session.clear()
         session['user_id'] = user.id
         session['tipo_utente'] = user.tipo_utente
         
@@ -84,6 +93,9 @@ def register():
             'user': user.to_dict()
         }), 201
         
+    except HasherSaturo as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -101,6 +113,20 @@ def login():
         if not user or not user.check_password(data['password']):
             return jsonify({'error': 'Credenziali non valide'}), 401
         
+        # Account in fase di eliminazione: i dati vengono rimossi in background
+        if EliminazioneAccount.in_corso(user.id):
+            return jsonify({'error': 'Account in fase di eliminazione'}), 403
+        
+        # Aggiorna in modo trasparente gli hash calcolati con parametri obsoleti
+        if user.password_needs_rehash():
+            try:
+                user.set_password(data['password'])
+                db.session.commit()
+            except HasherSaturo:
+                # Il rehash non è indispensabile: verrà ritentato al prossimo login
+                db.session.rollback()
+        
+        session.clear()
         session['user_id'] = user.id
         session['tipo_utente'] = user.tipo_utente
         
@@ -109,6 +135,8 @@ def login():
             'user': user.to_dict()
         }), 200
         
+    except HasherSaturo as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -118,13 +146,7 @@ def logout():
     return jsonify({'message': 'Logout effettuato con successo'}), 200
 
 @auth_bp.route('/me', methods=['GET'])
-def get_current_user():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Non autenticato'}), 401
-    
-    user = User.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'Utente non trovato'}), 404
-    
+@require_auth(carica_utente=True)
+def get_current_user(user):
     return jsonify({'user': user.to_dict()}), 200
 
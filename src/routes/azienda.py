@@ -1,40 +1,39 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify
 from src.models.user import db, User, Promotore, Azienda, Richiesta
+from src.models.contatori import ContatoriRichieste
+from src.models.raccomandazioni import PromotoreConsigliato, StatoClassificaPromotori
+from sqlalchemy.orm import joinedload
+from src.services.current_user import require_auth
+from src.services.pagination import keyset_page, id_page, page_size, CursoreNonValido
+from src.services.ricerca_aziende import registra_azienda_aggiornata
+from src.services.facette import facette_promotori
+from src.services.matching import classifiche_promotori
+from src.services.stato_richieste import (
+    AZIONI_MULTIPLE, TRANSIZIONI_MULTIPLE_MAX, TransizioneNonValida,
+    applica_transizione, applica_transizione_multipla, nuovo_stato
+)
 from datetime import datetime
 
 azienda_bp = Blueprint('azienda', __name__)
 
-def require_azienda():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Non autenticato'}), 401
-    if session.get('tipo_utente') != 'Azienda':
-        return jsonify({'error': 'Accesso riservato alle aziende'}), 403
-    return None
-
 @azienda_bp.route('/me', methods=['GET'])
-def get_azienda_profile():
-    auth_error = require_azienda()
-    if auth_error:
-        return auth_error
-    
-    azienda = Azienda.query.get(session['user_id'])
+@require_auth('Azienda', carica_utente=True)
+def get_azienda_profile(current_user):
+    azienda = current_user.azienda
     if not azienda:
         return jsonify({'error': 'Profilo azienda non trovato'}), 404
     
     return jsonify({
         'azienda': azienda.to_dict(),
-        'user': azienda.user.to_dict()
+        'user': current_user.to_dict()
     }), 200
 
 @azienda_bp.route('/me', methods=['PUT'])
-def update_azienda_profile():
-    auth_error = require_azienda()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Azienda', carica_utente=True)
+def update_azienda_profile(current_user):
     try:
         data = request.get_json()
-        azienda = Azienda.query.get(session['user_id'])
+        azienda = current_user.azienda
         
         if not azienda:
             return jsonify({'error': 'Profilo azienda non trovato'}), 404
@@ -49,6 +48,9 @@ def update_azienda_profile():
         if 'localita' in data:
             azienda.localita = data['localita']
         
+        # La classifica dei promotori consigliati verrà ricalcolata alla prossima lettura
+        StatoClassificaPromotori.segna_obsoleta(azienda.id)
+        registra_azienda_aggiornata(azienda)
         db.session.commit()
         
         return jsonify({
@@ -61,20 +63,23 @@ def update_azienda_profile():
         return jsonify({'error': str(e)}), 500
 
 @azienda_bp.route('/richieste', methods=['GET'])
-def get_richieste_ricevute():
-    auth_error = require_azienda()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Azienda')
+def get_richieste_ricevute(current_user):
     try:
         stato = request.args.get('stato')  # Filtro opzionale per stato
         
-        query = Richiesta.query.filter_by(azienda_id=session['user_id'])
+        query = Richiesta.query_con_dettagli().filter_by(azienda_id=current_user.id)
         
         if stato:
             query = query.filter_by(stato=stato)
         
-        richieste = query.order_by(Richiesta.data_creazione.desc()).all()
+        richieste, next_cursor = keyset_page(
+            query,
+            Richiesta.data_creazione,
+            Richiesta.id,
+            cursor=request.args.get('cursor'),
+            limit=page_size(request.args.get('limit', type=int))
+        )
         
         # Aggiungi informazioni sul promotore a ogni richiesta
         richieste_with_promotore = []
@@ -85,18 +90,18 @@ def get_richieste_ricevute():
             richieste_with_promotore.append(richiesta_dict)
         
         return jsonify({
-            'richieste': richieste_with_promotore
+            'richieste': richieste_with_promotore,
+            'next_cursor': next_cursor
         }), 200
         
+    except CursoreNonValido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @azienda_bp.route('/richieste/<int:richiesta_id>', methods=['PUT'])
-def gestisci_richiesta(richiesta_id):
-    auth_error = require_azienda()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Azienda')
+def gestisci_richiesta(current_user, richiesta_id):
     try:
         data = request.get_json()
         
@@ -105,32 +110,22 @@ def gestisci_richiesta(richiesta_id):
         
         richiesta = Richiesta.query.filter_by(
             id=richiesta_id,
-            azienda_id=session['user_id']
+            azienda_id=current_user.id
         ).first()
         
         if not richiesta:
             return jsonify({'error': 'Richiesta non trovata'}), 404
         
-        if richiesta.stato != 'In sospeso':
-            return jsonify({'error': 'La richiesta è già stata gestita'}), 400
-        
         azione = data['azione'].lower()
-        
-        if azione == 'accetta':
-            richiesta.stato = 'Accettata'
-            richiesta.messaggio_azienda = data.get('messaggio_azienda', 'Richiesta accettata')
-        elif azione == 'rifiuta':
-            richiesta.stato = 'Rifiutata'
-            richiesta.messaggio_azienda = data.get('messaggio_azienda', 'Richiesta rifiutata')
-        elif azione == 'controproposta':
-            if not data.get('messaggio_azienda'):
-                return jsonify({'error': 'Messaggio obbligatorio per la controproposta'}), 400
-            richiesta.stato = 'Controproposta'
-            richiesta.messaggio_azienda = data['messaggio_azienda']
-        else:
+        if azione not in ('accetta', 'rifiuta', 'controproposta'):
             return jsonify({'error': 'Azione non valida'}), 400
+        if azione == 'controproposta' and not data.get('messaggio_azienda'):
+            return jsonify({'error': 'Messaggio obbligatorio per la controproposta'}), 400
+        
+        if not nuovo_stato(richiesta.stato, azione):
+            return jsonify({'error': 'La richiesta è già stata gestita'}), 400
         
-        richiesta.data_aggiornamento = datetime.utcnow()
+        applica_transizione(richiesta, azione)
         db.session.commit()
         
         return jsonify({
@@ -138,45 +133,53 @@ def gestisci_richiesta(richiesta_id):
             'richiesta': richiesta.to_dict()
         }), 200
         
+    except TransizioneNonValida as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-@azienda_bp.route('/dashboard', methods=['GET'])
-def get_dashboard():
-    auth_error = require_azienda()
-    if auth_error:
-        return auth_error
-    
+@azienda_bp.route('/richieste/gestisci', methods=['POST'])
+@require_auth('Azienda')
+def gestisci_richieste_multiple(current_user):
+    """Accetta o rifiuta più richieste dell'inbox con un'unica operazione"""
     try:
-        # Statistiche richieste
-        richieste_in_sospeso = Richiesta.query.filter_by(
-            azienda_id=session['user_id'],
-            stato='In sospeso'
-        ).count()
-        
-        richieste_accettate = Richiesta.query.filter_by(
-            azienda_id=session['user_id'],
-            stato='Accettata'
-        ).count()
-        
-        richieste_rifiutate = Richiesta.query.filter_by(
-            azienda_id=session['user_id'],
-            stato='Rifiutata'
-        ).count()
-        
-        richieste_controproposta = Richiesta.query.filter_by(
-            azienda_id=session['user_id'],
-            stato='Controproposta'
-        ).count()
+        data = request.get_json() or {}
+        
+        azione = (data.get('azione') or '').lower()
+        if azione not in AZIONI_MULTIPLE:
+            return jsonify({'error': 'Azione non valida (accetta, rifiuta)'}), 400
+        
+        ids = data.get('richiesta_ids')
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) for i in ids):
+            return jsonify({'error': 'richiesta_ids deve essere una lista di ID'}), 400
+        if len(ids) > TRANSIZIONI_MULTIPLE_MAX:
+            return jsonify({'error': f'Al massimo {TRANSIZIONI_MULTIPLE_MAX} richieste per operazione'}), 400
         
+        aggiornate = applica_transizione_multipla(current_user.id, set(ids), azione)
+        db.session.commit()
+        
+        stato = nuovo_stato('In sospeso', azione)
+        aggiornate_ids = {richiesta_id for richiesta_id, _ in aggiornate}
+        return jsonify({
+            'stato': stato,
+            'aggiornate': sorted(aggiornate_ids),
+            # Richieste inesistenti, di altre aziende o già chiuse
+            'ignorate': sorted(set(ids) - aggiornate_ids)
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@azienda_bp.route('/dashboard', methods=['GET'])
+@require_auth('Azienda')
+def get_dashboard(current_user):
+    try:
+        # Statistiche richieste: lettura per chiave primaria dei contatori mantenuti a ogni transizione
         return jsonify({
-            'statistiche': {
-                'in_sospeso': richieste_in_sospeso,
-                'accettate': richieste_accettate,
-                'rifiutate': richieste_rifiutate,
-                'controproposta': richieste_controproposta
-            }
+            'statistiche': ContatoriRichieste.statistiche(current_user.id)
         }), 200
         
     except Exception as e:
@@ -185,11 +188,8 @@ def get_dashboard():
 
 
 @azienda_bp.route("/promotori", methods=["GET"])
-def get_promotori():
-    auth_error = require_azienda()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Azienda')
+def get_promotori(current_user):
     try:
         # Parametri di ricerca opzionali
         industry = request.args.get("industry")
@@ -198,18 +198,28 @@ def get_promotori():
         linkedin_link = request.args.get("linkedin_link")
         # Aggiungere filtri per follower se implementati nel modello Promotore
         
-        query = Promotore.query
-        
+        condizioni = {}
+        # Confronto esatto: usa l'indice su (industry, id)
         if industry:
-            query = query.filter(Promotore.industry.ilike(f"%{industry}%"))
+            condizioni['industry'] = Promotore.industry == industry
+        # Le condizioni coincidono con quelle degli indici parziali
         if instagram_link == "true":
-            query = query.filter(Promotore.instagram_link.isnot(None))
+            condizioni['instagram'] = Promotore.instagram_link.isnot(None)
         if tiktok_link == "true":
-            query = query.filter(Promotore.tiktok_link.isnot(None))
+            condizioni['tiktok'] = Promotore.tiktok_link.isnot(None)
         if linkedin_link == "true":
-            query = query.filter(Promotore.linkedin_link.isnot(None))
+            condizioni['linkedin'] = Promotore.linkedin_link.isnot(None)
+        
+        # L'email arriva con la stessa SELECT dei promotori
+        query = Promotore.query.options(joinedload(Promotore.user)).filter(*condizioni.values())
         
-        promotori = query.all()
+        cursor = request.args.get("cursor")
+        promotori, next_cursor = id_page(
+            query,
+            Promotore.id,
+            cursor=cursor,
+            limit=page_size(request.args.get("limit", type=int))
+        )
         
         # Prepara i dati dei promotori includendo l'email dell'utente associato
         promotori_data = []
@@ -219,11 +229,60 @@ def get_promotori():
                 promotore_dict["email"] = promotore.user.email
             promotori_data.append(promotore_dict)
         
+        risposta = {
+            "promotori": promotori_data,
+            "next_cursor": next_cursor
+        }
+        # I conteggi dei filtri servono solo alla prima pagina
+        if not cursor:
+            risposta["facette"] = facette_promotori(condizioni)
+        
+        return jsonify(risposta), 200
+        
+    except CursoreNonValido as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@azienda_bp.route("/promotori/consigliati", methods=["GET"])
+@require_auth('Azienda', carica_utente=True)
+def get_promotori_consigliati(current_user):
+    """Promotori più adatti all'azienda, dalla classifica materializzata"""
+    try:
+        azienda = current_user.azienda
+        if not azienda:
+            return jsonify({"error": "Profilo azienda non trovato"}), 404
+        
+        classifiche_promotori.assicura_aggiornata(azienda)
+        
+        query = PromotoreConsigliato.query.options(
+            joinedload(PromotoreConsigliato.promotore).joinedload(Promotore.user)
+        ).filter_by(azienda_id=azienda.id)
+        
+        consigliati, next_cursor = id_page(
+            query,
+            PromotoreConsigliato.posizione,
+            cursor=request.args.get("cursor"),
+            limit=page_size(request.args.get("limit", type=int)),
+            desc=False
+        )
+        
+        promotori_data = []
+        for consigliato in consigliati:
+            promotore_dict = consigliato.promotore.to_dict()
+            if consigliato.promotore.user:
+                promotore_dict["email"] = consigliato.promotore.user.email
+            promotore_dict["posizione"] = consigliato.posizione
+            promotore_dict["punteggio"] = round(consigliato.punteggio, 4)
+            promotori_data.append(promotore_dict)
+        
         return jsonify({
-            "promotori": promotori_data
+            "promotori": promotori_data,
+            "next_cursor": next_cursor
         }), 200
         
+    except CursoreNonValido as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 500
-
-
@@ -1,9 +1,15 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify
 from src.models.user import db, User, Promotore, Richiesta
 from src.models.leaderboard import LeaderboardEntry
+from src.services.current_user import require_auth
+from src.services.tasks import task, accoda
+from src.models.task import PRIORITA_NORMALE
 from datetime import datetime, timedelta
 from sqlalchemy import func, desc
 import calendar
+import logging
+
+logger = logging.getLogger(__name__)
 
 leaderboard_bp = Blueprint('leaderboard', __name__)
 
@@ -88,17 +94,14 @@ def get_leaderboard_history():
         return jsonify({'error': str(e)}), 500
 
 @leaderboard_bp.route('/my-position', methods=['GET'])
-def get_my_position():
+@require_auth(carica_utente=True)
+def get_my_position(user):
     """Ottiene la posizione dell'utente corrente nella leaderboard"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
-        if not user or user.tipo_utente != 'promotore':
+        if user.tipo_utente != 'promotore':
             return jsonify({'error': 'Solo i content creator hanno una posizione in leaderboard'}), 403
         
-        promotore = Promotore.query.filter_by(user_id=user.id).first()
+        promotore = user.promotore
         if not promotore:
             return jsonify({'error': 'Profilo content creator non trovato'}), 404
         
@@ -134,44 +137,52 @@ def get_my_position():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@task('aggiorna_leaderboard', priorita=PRIORITA_NORMALE)
+def aggiorna_leaderboard_corrente():
+    """Aggiorna tutte le entry della leaderboard del mese corrente e le posizioni"""
+    mese, anno = LeaderboardEntry.get_current_month_year()
+    
+    # Ottieni tutti i promotori attivi
+    promotori = Promotore.query.join(User).all()
+    
+    for promotore in promotori:
+        # Ottieni o crea l'entry
+        entry = LeaderboardEntry.get_or_create_entry(promotore.id, mese, anno)
+        
+        # Aggiorna le metriche
+        update_promotore_metrics(promotore.id, mese, anno)
+        
+        # Ricalcola il punteggio
+        entry.calcola_punteggio()
+    
+    # Aggiorna le posizioni
+    entries = LeaderboardEntry.query.filter_by(
+        mese=mese,
+        anno=anno
+    ).order_by(desc(LeaderboardEntry.punteggio_totale)).all()
+    
+    for i, entry in enumerate(entries, 1):
+        entry.posizione = i
+    
+    db.session.commit()
+    logger.info(f"Leaderboard {mese}/{anno} aggiornata per {len(promotori)} content creator")
+
 @leaderboard_bp.route('/update-all', methods=['POST'])
 def update_all_leaderboard():
-    """Aggiorna tutte le entry della leaderboard del mese corrente (per cron job)"""
+    """Accoda l'aggiornamento della leaderboard del mese corrente (per cron job)"""
     try:
         mese, anno = LeaderboardEntry.get_current_month_year()
         
-        # Ottieni tutti i promotori attivi
-        promotori = Promotore.query.join(User).all()
-        
-        updated_count = 0
-        for promotore in promotori:
-            # Ottieni o crea l'entry
-            entry = LeaderboardEntry.get_or_create_entry(promotore.id, mese, anno)
-            
-            # Aggiorna le metriche
-            update_promotore_metrics(promotore.id, mese, anno)
-            
-            # Ricalcola il punteggio
-            entry.calcola_punteggio()
-            updated_count += 1
-        
-        # Aggiorna le posizioni
-        entries = LeaderboardEntry.query.filter_by(
-            mese=mese,
-            anno=anno
-        ).order_by(desc(LeaderboardEntry.punteggio_totale)).all()
-        
-        for i, entry in enumerate(entries, 1):
-            entry.posizione = i
-        
+        # Se un aggiornamento è già in coda non ne serve un secondo
+        nuovo = accoda('aggiorna_leaderboard', chiave='aggiorna_leaderboard')
         db.session.commit()
         
         return jsonify({
-            'message': f'Leaderboard aggiornata per {updated_count} content creator',
+            'message': 'Aggiornamento leaderboard accodato' if nuovo else 'Aggiornamento leaderboard già in coda',
             'mese': mese,
             'anno': anno,
-            'updated_count': updated_count
-        }), 200
+            'task_id': nuovo.id if nuovo else None
+        }), 202
         
     except Exception as e:
         db.session.rollback()
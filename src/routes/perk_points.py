@@ -1,30 +1,46 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify
 from flask_cors import cross_origin
-from src.models.user import db, User
+from src.models.user import db
+from src.services.current_user import require_auth
 from src.models.perk_points import (
     PerkPointsBalance, PerkPointsTransaction, ActivePerk, PerkPackage,
-    PerkType, TransactionType, get_points_pricing, calculate_perk_priority_score,
-    cleanup_expired_perks
+    PerkType, TransactionType, get_points_pricing, calculate_perk_priority_score
 )
+from src.services.tasks import task, accoda
+from src.services.outbox import registra_evento
+from src.models.task import PRIORITA_BASSA
 from datetime import datetime
+import time
 
 perk_points_bp = Blueprint('perk_points', __name__)
 
-def require_auth():
-    """Decorator per richiedere autenticazione"""
-    def decorator(f):
-        def wrapper(*args, **kwargs):
-            if 'user_id' not in session:
-                return jsonify({'error': 'Non autenticato'}), 401
-            
-            user = User.query.get(session['user_id'])
-            if not user:
-                return jsonify({'error': 'Utente non trovato'}), 404
-            
-            return f(user, *args, **kwargs)
-        wrapper.__name__ = f.__name__
-        return wrapper
-    return decorator
+# Le letture accodano la pulizia dei perk scaduti al più una volta per intervallo (per processo)
+INTERVALLO_PULIZIA_PERK_SECONDI = 300
+_ultima_pulizia_perk = 0.0
+
+@task('pulizia_perk_scaduti', priorita=PRIORITA_BASSA)
+def pulizia_perk_scaduti():
+    """Task del pool: disattiva i perk scaduti e lo notifica con un evento per azienda"""
+    scaduti = ActivePerk.query.filter(
+        ActivePerk.is_active == True,
+        ActivePerk.end_date < datetime.utcnow()
+    ).all()
+    
+    for perk in scaduti:
+        perk.deactivate()
+    for azienda_id in {perk.azienda_id for perk in scaduti}:
+        registra_evento('azienda', azienda_id, 'perk_scaduto')
+    
+    db.session.commit()
+
+def pianifica_pulizia_perk():
+    """Accoda la pulizia dei perk scaduti fuori dal percorso della richiesta"""
+    global _ultima_pulizia_perk
+    if time.monotonic() - _ultima_pulizia_perk < INTERVALLO_PULIZIA_PERK_SECONDI:
+        return
+    _ultima_pulizia_perk = time.monotonic()
+    accoda('pulizia_perk_scaduti', chiave='pulizia_perk_scaduti')
+    db.session.commit()
 
 @perk_points_bp.route('/balance', methods=['GET'])
 @cross_origin()
@@ -124,8 +140,8 @@ def purchase_points(current_user):
 def get_perk_packages():
     """Ottiene tutti i pacchetti perk disponibili"""
     try:
-        # Pulisci i perk scaduti
-        cleanup_expired_perks()
+        # Pulizia dei perk scaduti in background
+        pianifica_pulizia_perk()
         
         packages = PerkPackage.query.filter_by(is_active=True).all()
         
@@ -221,6 +237,7 @@ def activate_perk(current_user):
         )
         
         db.session.add(active_perk)
+        registra_evento('azienda', current_user.id, 'perk_attivato', perk_type=package.perk_type.value)
         db.session.commit()
         
         return jsonify({
@@ -244,8 +261,8 @@ def get_active_perks(current_user):
         if current_user.tipo_utente != 'azienda':
             return jsonify({'error': 'Solo le aziende possono avere perk attivi'}), 403
         
-        # Pulisci i perk scaduti
-        cleanup_expired_perks()
+        # Pulizia dei perk scaduti in background: la query filtra comunque per end_date
+        pianifica_pulizia_perk()
         
         active_perks = ActivePerk.query.filter_by(
             azienda_id=current_user.id,
@@ -334,6 +351,7 @@ def deactivate_perk(current_user, perk_id):
             return jsonify({'error': 'Perk attivo non trovato'}), 404
         
         active_perk.deactivate()
+        registra_evento('azienda', current_user.id, 'perk_disattivato', perk_type=active_perk.perk_type.value)
         db.session.commit()
         
         return jsonify({
@@ -1,41 +1,36 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify
 from src.models.user import db, User, Promotore, Azienda, Richiesta
+from src.models.messaggio import LetturaConversazione
+from src.services.current_user import require_auth
+from src.services.pagination import keyset_page, page_size, CursoreNonValido
+from src.services.eventi import registra_evento_richiesta
+from src.services.ricerca_aziende import FiltriAziende, cerca_aziende, facette_aziende, cerca_vicine
+from src.services.geo import geocodifica
+from src.services.matching import motore_matching, RACCOMANDAZIONI_MAX
+from src.services.autocompletamento import indice_autocompletamento, CAMPI_AUTOCOMPLETAMENTO, SUGGERIMENTI_DEFAULT, SUGGERIMENTI_MAX
 from datetime import datetime
 import os
 
 promotore_bp = Blueprint('promotore', __name__)
 
-def require_promotore():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Non autenticato'}), 401
-    if session.get('tipo_utente') != 'Promotore':
-        return jsonify({'error': 'Accesso riservato ai promotori'}), 403
-    return None
-
 @promotore_bp.route('/me', methods=['GET'])
-def get_promotore_profile():
-    auth_error = require_promotore()
-    if auth_error:
-        return auth_error
-    
-    promotore = Promotore.query.get(session['user_id'])
+@require_auth('Promotore', carica_utente=True)
+def get_promotore_profile(current_user):
+    promotore = current_user.promotore
     if not promotore:
         return jsonify({'error': 'Profilo promotore non trovato'}), 404
     
     return jsonify({
         'promotore': promotore.to_dict(),
-        'user': promotore.user.to_dict()
+        'user': current_user.to_dict()
     }), 200
 
 @promotore_bp.route('/me', methods=['PUT'])
-def update_promotore_profile():
-    auth_error = require_promotore()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Promotore', carica_utente=True)
+def update_promotore_profile(current_user):
     try:
         data = request.get_json()
-        promotore = Promotore.query.get(session['user_id'])
+        promotore = current_user.promotore
         
         if not promotore:
             return jsonify({'error': 'Profilo promotore non trovato'}), 404
@@ -48,6 +43,12 @@ def update_promotore_profile():
         if 'linkedin_link' in data:
             promotore.linkedin_link = data['linkedin_link']
         
+        # Dati usati per consigliare le aziende
+        if 'visualizzazioni_medie' in data:
+            promotore.visualizzazioni_medie = data['visualizzazioni_medie']
+        if 'localita' in data:
+            promotore.localita = data['localita']
+        
         # Aggiorna percorsi file (in un'implementazione reale, qui gestiresti l'upload dei file)
         if 'insight_screenshot_path' in data:
             promotore.insight_screenshot_path = data['insight_screenshot_path']
@@ -63,6 +64,7 @@ def update_promotore_profile():
             promotore.ultimo_aggiornamento_insight = datetime.utcnow()
         
         db.session.commit()
+        motore_matching.invalida_promotore(promotore.id)
         
         return jsonify({
             'message': 'Profilo aggiornato con successo',
@@ -74,44 +76,151 @@ def update_promotore_profile():
         return jsonify({'error': str(e)}), 500
 
 @promotore_bp.route('/aziende', methods=['GET'])
-def get_aziende():
-    auth_error = require_promotore()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Promotore')
+def get_aziende(current_user):
+    try:
+        # Parametri di ricerca opzionali: q è una ricerca libera tollerante agli errori di battitura
+        filtri = FiltriAziende(
+            q=request.args.get("q"),
+            tipo_attivita=request.args.get("tipo_attivita"),
+            localita=request.args.get("localita"),
+            nome_attivita=request.args.get("nome_attivita"),
+            min_visualizzazioni=request.args.get("min_visualizzazioni", type=int)
+        )
+        
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = page_size(request.args.get('per_page', type=int))
+        
+        risultati, has_next = cerca_aziende(filtri, page, per_page)
+        
+        aziende = []
+        for azienda, rilevanza in risultati:
+            azienda_dict = azienda.to_dict()
+            if rilevanza is not None:
+                azienda_dict['rilevanza'] = round(float(rilevanza), 4)
+            aziende.append(azienda_dict)
+        
+        risposta = {
+            'aziende': aziende,
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'has_next': has_next,
+                'has_prev': page > 1
+            }
+        }
+        # I conteggi dei filtri servono solo alla prima pagina
+        if page == 1:
+            risposta['facette'] = facette_aziende(filtri)
+        
+        return jsonify(risposta), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@promotore_bp.route('/aziende/consigliate', methods=['GET'])
+@require_auth('Promotore', carica_utente=True)
+def get_aziende_consigliate(current_user):
+    """Aziende più compatibili con il profilo del promotore, con il dettaglio del punteggio"""
+    try:
+        promotore = current_user.promotore
+        if not promotore:
+            return jsonify({'error': 'Profilo promotore non trovato'}), 404
+        
+        limite = page_size(request.args.get('limit', type=int), massimo=RACCOMANDAZIONI_MAX)
+        raccomandazioni = motore_matching.raccomandazioni(promotore, limite)
+        
+        aziende = {a.id: a for a in Azienda.query.filter(Azienda.id.in_([r[0] for r in raccomandazioni]))}
+        
+        risultati = []
+        for azienda_id, punteggio, componenti in raccomandazioni:
+            if azienda_id not in aziende:
+                continue  # Eliminata dopo il calcolo
+            azienda_dict = aziende[azienda_id].to_dict()
+            azienda_dict['punteggio'] = round(punteggio, 4)
+            azienda_dict['componenti'] = componenti
+            risultati.append(azienda_dict)
+        
+        return jsonify({'aziende': risultati}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@promotore_bp.route('/aziende/vicine', methods=['GET'])
+@require_auth('Promotore')
+def get_aziende_vicine(current_user):
+    """Aziende ordinate per distanza da un punto (lat/lon oppure una località), entro raggio_km se indicato"""
     try:
-        # Parametri di ricerca opzionali
-        tipo_attivita = request.args.get("tipo_attivita")
-        localita = request.args.get("localita")
-        min_visualizzazioni = request.args.get("min_visualizzazioni")
-        nome_attivita = request.args.get("nome_attivita")
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
+        if lat is None or lon is None:
+            localita = request.args.get('localita')
+            if not localita:
+                return jsonify({'error': 'Indicare lat e lon oppure una località'}), 400
+            coordinate = geocodifica(localita)
+            if not coordinate:
+                return jsonify({'error': 'Località non riconosciuta'}), 400
+            lat, lon = coordinate
+        
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({'error': 'Coordinate non valide'}), 400
+        
+        raggio_km = request.args.get('raggio_km', type=float)
+        if raggio_km is not None and raggio_km <= 0:
+            return jsonify({'error': 'Il raggio deve essere positivo'}), 400
         
-        query = Azienda.query
+        filtri = FiltriAziende(
+            tipo_attivita=request.args.get("tipo_attivita"),
+            nome_attivita=request.args.get("nome_attivita"),
+            min_visualizzazioni=request.args.get("min_visualizzazioni", type=int)
+        )
+        
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = page_size(request.args.get('per_page', type=int))
         
-        if tipo_attivita:
-            query = query.filter(Azienda.tipo_attivita.ilike(f"%{tipo_attivita}%"))
-        if localita:
-            query = query.filter(Azienda.localita.ilike(f"%{localita}%"))
-        if min_visualizzazioni:
-            query = query.filter(Azienda.min_visualizzazioni_richieste <= int(min_visualizzazioni))
-        if nome_attivita:
-            query = query.filter(Azienda.nome_attivita.ilike(f"%{nome_attivita}%"))
+        risultati, has_next = cerca_vicine(lat, lon, filtri, raggio_km, page, per_page)
         
-        aziende = query.all()
+        aziende = []
+        for azienda, distanza in risultati:
+            azienda_dict = azienda.to_dict()
+            azienda_dict['distanza_km'] = round(distanza, 2)
+            aziende.append(azienda_dict)
         
         return jsonify({
-            'aziende': [azienda.to_dict() for azienda in aziende]
+            'aziende': aziende,
+            'centro': {'lat': lat, 'lon': lon},
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'has_next': has_next,
+                'has_prev': page > 1
+            }
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@promotore_bp.route('/aziende/suggerimenti', methods=['GET'])
+@require_auth()
+def suggerimenti_aziende(current_user):
+    """Completamento dei campi di ricerca delle aziende a partire dalle lettere digitate"""
+    try:
+        campo = request.args.get('campo')
+        if campo not in CAMPI_AUTOCOMPLETAMENTO:
+            return jsonify({'error': f"Campo non valido, valori ammessi: {', '.join(CAMPI_AUTOCOMPLETAMENTO)}"}), 400
+        
+        limite = page_size(request.args.get('limit', type=int), default=SUGGERIMENTI_DEFAULT, massimo=SUGGERIMENTI_MAX)
+        
+        return jsonify({
+            'suggerimenti': indice_autocompletamento.suggerisci(campo, request.args.get('q', ''), limite)
         }), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @promotore_bp.route('/richieste', methods=['POST'])
-def invia_richiesta():
-    auth_error = require_promotore()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Promotore')
+def invia_richiesta(current_user):
     try:
         data = request.get_json()
         
@@ -123,23 +232,15 @@ def invia_richiesta():
         if not azienda:
             return jsonify({'error': 'Azienda non trovata'}), 404
         
-        # Verifica che non esista già una richiesta in sospeso
-        existing_request = Richiesta.query.filter_by(
-            promotore_id=session['user_id'],
-            azienda_id=data['azienda_id'],
-            stato='In sospeso'
-        ).first()
+        # L'indice univoco parziale rifiuta una seconda richiesta attiva per la stessa azienda
+        richiesta = Richiesta.crea(current_user.id, azienda.id, data['messaggio_promotore'])
+        if richiesta is None:
+            db.session.rollback()
+            return jsonify({'error': 'Hai già una richiesta attiva per questa azienda'}), 400
         
-        if existing_request:
-            return jsonify({'error': 'Hai già una richiesta in sospeso per questa azienda'}), 400
-        
-        richiesta = Richiesta(
-            promotore_id=session['user_id'],
-            azienda_id=data['azienda_id'],
-            messaggio_promotore=data['messaggio_promotore']
-        )
-        
-        db.session.add(richiesta)
+        # Il messaggio iniziale conta come non letto per l'azienda
+        LetturaConversazione.incrementa(richiesta.azienda_id, richiesta.id)
+        registra_evento_richiesta(richiesta, 'richiesta_nuova', testo=richiesta.messaggio_iniziale)
         db.session.commit()
         
         return jsonify({
@@ -152,20 +253,23 @@ def invia_richiesta():
         return jsonify({'error': str(e)}), 500
 
 @promotore_bp.route('/richieste', methods=['GET'])
-def get_richieste_inviate():
-    auth_error = require_promotore()
-    if auth_error:
-        return auth_error
-    
+@require_auth('Promotore')
+def get_richieste_inviate(current_user):
     try:
         stato = request.args.get('stato')  # Filtro opzionale per stato
         
-        query = Richiesta.query.filter_by(promotore_id=session['user_id'])
+        query = Richiesta.query_con_dettagli().filter_by(promotore_id=current_user.id)
         
         if stato:
             query = query.filter_by(stato=stato)
         
-        richieste = query.order_by(Richiesta.data_creazione.desc()).all()
+        richieste, next_cursor = keyset_page(
+            query,
+            Richiesta.data_creazione,
+            Richiesta.id,
+            cursor=request.args.get('cursor'),
+            limit=page_size(request.args.get('limit', type=int))
+        )
         
         # Aggiungi informazioni sull'azienda a ogni richiesta
         richieste_with_azienda = []
@@ -175,9 +279,12 @@ def get_richieste_inviate():
             richieste_with_azienda.append(richiesta_dict)
         
         return jsonify({
-            'richieste': richieste_with_azienda
+            'richieste': richieste_with_azienda,
+            'next_cursor': next_cursor
         }), 200
         
+    except CursoreNonValido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
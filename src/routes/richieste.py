@@ -1,21 +1,21 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, Response, request, jsonify
 from src.models.user import db, User, Promotore, Azienda, Richiesta
-from src.models.messaggio import Messaggio
+from src.models.messaggio import Messaggio, LetturaConversazione
+from src.services.current_user import require_auth
+from src.services.pagination import keyset_page, keyset_filter, page_size, id_ancora, CursoreNonValido
+from src.services.eventi import get_broker, canale_utente, registra_evento_richiesta
+from src.services.ricerca import cerca_conversazioni
+from src.services.stato_richieste import AZIONE_PER_TIPO_MESSAGGIO, TransizioneNonValida, applica_transizione, nuovo_stato
 from datetime import datetime
+import json
 
 richieste_bp = Blueprint('richieste', __name__)
 
 @richieste_bp.route('/invia', methods=['POST'])
-def invia_richiesta():
+@require_auth('Promotore', 'Solo i content creator possono inviare richieste')
+def invia_richiesta(user):
     """Invia una nuova richiesta da un content creator a un'azienda"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
-        if not user or user.tipo_utente != 'Promotore':
-            return jsonify({'error': 'Solo i content creator possono inviare richieste'}), 403
-        
         data = request.get_json()
         if not data.get('azienda_id') or not data.get('messaggio'):
             return jsonify({'error': 'ID azienda e messaggio sono obbligatori'}), 400
@@ -25,24 +25,15 @@ def invia_richiesta():
         if not azienda:
             return jsonify({'error': 'Azienda non trovata'}), 404
         
-        # Verifica che non esista già una richiesta attiva
-        richiesta_esistente = Richiesta.query.filter_by(
-            promotore_id=user.id,
-            azienda_id=data['azienda_id']
-        ).filter(Richiesta.stato.in_(['In sospeso', 'In negoziazione'])).first()
-        
-        if richiesta_esistente:
+        # Crea la nuova richiesta: l'indice univoco parziale rifiuta i duplicati attivi
+        richiesta = Richiesta.crea(user.id, azienda.id, data['messaggio'])
+        if richiesta is None:
+            db.session.rollback()
             return jsonify({'error': 'Hai già una richiesta attiva con questa azienda'}), 400
         
-        # Crea la nuova richiesta
-        richiesta = Richiesta(
-            promotore_id=user.id,
-            azienda_id=data['azienda_id'],
-            messaggio_iniziale=data['messaggio'],
-            stato='In sospeso'
-        )
-        
-        db.session.add(richiesta)
+        # Il messaggio iniziale conta come non letto per l'azienda
+        LetturaConversazione.incrementa(richiesta.azienda_id, richiesta.id)
+        registra_evento_richiesta(richiesta, 'richiesta_nuova', testo=richiesta.messaggio_iniziale)
         db.session.commit()
         
         return jsonify({
@@ -55,13 +46,10 @@ def invia_richiesta():
         return jsonify({'error': str(e)}), 500
 
 @richieste_bp.route('/messaggio', methods=['POST'])
-def invia_messaggio():
+@require_auth()
+def invia_messaggio(user):
     """Invia un messaggio in una richiesta esistente"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
         data = request.get_json()
         
         if not data.get('richiesta_id') or not data.get('contenuto'):
@@ -91,20 +79,25 @@ def invia_messaggio():
             tipo_messaggio=tipo_messaggio
         )
         
-        # Aggiorna lo stato della richiesta in base al tipo di messaggio
-        if tipo_messaggio == 'accettazione':
-            richiesta.stato = 'Accettata'
-            richiesta.data_accettazione = datetime.utcnow()
-        elif tipo_messaggio == 'rifiuto':
-            richiesta.stato = 'Rifiutata'
-        elif tipo_messaggio == 'controproposta':
-            richiesta.stato = 'In negoziazione'
-        elif richiesta.stato == 'In sospeso':
-            richiesta.stato = 'In negoziazione'
-        
-        richiesta.data_aggiornamento = datetime.utcnow()
+        # Aggiorna lo stato della richiesta in base al tipo di messaggio: i messaggi semplici
+        # non cambiano le richieste già chiuse, gli altri tipi devono essere transizioni ammesse
+        azione = AZIONE_PER_TIPO_MESSAGGIO[tipo_messaggio]
+        if nuovo_stato(richiesta.stato, azione):
+            applica_transizione(richiesta, azione)
+        elif tipo_messaggio == 'messaggio':
+            richiesta.data_aggiornamento = datetime.utcnow()
+        else:
+            return jsonify({'error': f"Messaggio di tipo '{tipo_messaggio}' non consentito per una richiesta {richiesta.stato.lower()}"}), 400
         
         db.session.add(messaggio)
+        
+        # Un messaggio non letto in più per l'altra parte
+        destinatario_id = richiesta.azienda_id if user.tipo_utente == 'Promotore' else richiesta.promotore_id
+        LetturaConversazione.incrementa(destinatario_id, richiesta.id)
+        db.session.flush()
+        
+        # Notifica push dopo il commit: i client scaricano il messaggio con since_id
+        registra_evento_richiesta(richiesta, 'messaggio_nuovo', messaggio_id=messaggio.id, testo=messaggio.contenuto)
         db.session.commit()
         
         return jsonify({
@@ -113,29 +106,36 @@ def invia_messaggio():
             'richiesta': richiesta.to_dict(include_sensitive_data=(richiesta.stato == 'Accettata'))
         }), 201
         
+    except TransizioneNonValida as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @richieste_bp.route('/lista', methods=['GET'])
-def get_richieste():
+@require_auth()
+def get_richieste(user):
     """Ottiene la lista delle richieste per l'utente corrente"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
         stato_filter = request.args.get('stato')
         
         if user.tipo_utente == 'Promotore':
-            query = Richiesta.query.filter_by(promotore_id=user.id)
+            query = Richiesta.query_con_dettagli().filter_by(promotore_id=user.id)
         else:
-            query = Richiesta.query.filter_by(azienda_id=user.id)
+            query = Richiesta.query_con_dettagli().filter_by(azienda_id=user.id)
         
         if stato_filter:
             query = query.filter_by(stato=stato_filter)
         
-        richieste = query.order_by(Richiesta.data_aggiornamento.desc()).all()
+        # Le richieste più recentemente aggiornate per prime, una pagina alla volta
+        richieste, next_cursor = keyset_page(
+            query,
+            Richiesta.data_aggiornamento,
+            Richiesta.id,
+            cursor=request.args.get('cursor'),
+            limit=page_size(request.args.get('limit', type=int))
+        )
         
         # Include dati sensibili solo per richieste accettate
         richieste_data = []
@@ -143,20 +143,32 @@ def get_richieste():
             include_sensitive = (richiesta.stato == 'Accettata')
             richieste_data.append(richiesta.to_dict(include_sensitive_data=include_sensitive))
         
-        return jsonify({'richieste': richieste_data}), 200
+        return jsonify({'richieste': richieste_data, 'next_cursor': next_cursor}), 200
         
+    except CursoreNonValido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @richieste_bp.route('/<int:richiesta_id>/messaggi', methods=['GET'])
-def get_messaggi_richiesta(richiesta_id):
-    """Ottiene tutti i messaggi di una richiesta"""
+@require_auth()
+def get_messaggi_richiesta(user, richiesta_id):
+    """
+    Ottiene i messaggi di una richiesta, una pagina alla volta.
+    since_id: solo i messaggi successivi (polling incrementale, senza i dati della richiesta)
+    before_id: la pagina di messaggi precedenti (scorrimento della cronologia)
+    senza parametri: gli ultimi messaggi insieme ai dati della richiesta
+    """
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
+        since_id = id_ancora(request.args.get('since_id'), 'since_id')
+        before_id = id_ancora(request.args.get('before_id'), 'before_id')
+        limit = page_size(request.args.get('limit', type=int))
+        include_richiesta = since_id is None or request.args.get('include_richiesta') == 'true'
         
-        user = User.query.get(session['user_id'])
-        richiesta = Richiesta.query.get(richiesta_id)
+        if include_richiesta:
+            richiesta = Richiesta.query_con_dettagli().filter_by(id=richiesta_id).first()
+        else:
+            richiesta = Richiesta.query.get(richiesta_id)
         
         if not richiesta:
             return jsonify({'error': 'Richiesta non trovata'}), 404
@@ -167,13 +179,150 @@ def get_messaggi_richiesta(richiesta_id):
         elif user.tipo_utente == 'Azienda' and richiesta.azienda_id != user.id:
             return jsonify({'error': 'Non autorizzato'}), 403
         
-        messaggi = Messaggio.query.filter_by(richiesta_id=richiesta_id).order_by(Messaggio.data_creazione.asc()).all()
+        query = Messaggio.query.filter_by(richiesta_id=richiesta_id)
+        ancora_id = since_id if since_id is not None else before_id
+        
+        if ancora_id is not None:
+            # Il messaggio di riferimento deve appartenere a questa richiesta: altrimenti la pagina
+            # risulterebbe vuota e il client smetterebbe di chiedere messaggi
+            ancora_data = db.session.query(Messaggio.data_creazione).filter(
+                Messaggio.id == ancora_id,
+                Messaggio.richiesta_id == richiesta_id
+            ).scalar()
+            if ancora_data is None:
+                raise CursoreNonValido('Messaggio di riferimento non trovato in questa richiesta')
+            query = query.filter(keyset_filter(
+                Messaggio.data_creazione, Messaggio.id, ancora_data, ancora_id, desc=(since_id is None)
+            ))
+        
+        if since_id is not None:
+            # Messaggi nuovi, dal più vecchio al più recente
+            messaggi = query.order_by(Messaggio.data_creazione.asc(), Messaggio.id.asc()).limit(limit + 1).all()
+            has_more = len(messaggi) > limit
+            messaggi = messaggi[:limit]
+        else:
+            # Ultima pagina (o quella precedente a before_id), restituita in ordine cronologico
+            messaggi = query.order_by(Messaggio.data_creazione.desc(), Messaggio.id.desc()).limit(limit + 1).all()
+            has_more = len(messaggi) > limit
+            messaggi = list(reversed(messaggi[:limit]))
+        
+        result = {
+            'messaggi': [msg.to_dict() for msg in messaggi],
+            'has_more': has_more
+        }
+        if include_richiesta:
+            result['richiesta'] = richiesta.to_dict(include_sensitive_data=(richiesta.stato == 'Accettata'))
+        
+        return jsonify(result), 200
+        
+    except CursoreNonValido as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@richieste_bp.route('/<int:richiesta_id>/letti', methods=['POST'])
+@require_auth()
+def segna_messaggi_letti(user, richiesta_id):
+    """Segna come letti tutti i messaggi di una richiesta per l'utente corrente"""
+    try:
+        richiesta = Richiesta.query.get(richiesta_id)
+        
+        if not richiesta:
+            return jsonify({'error': 'Richiesta non trovata'}), 404
+        
+        # Verifica che l'utente sia coinvolto nella richiesta
+        if user.id not in (richiesta.promotore_id, richiesta.azienda_id):
+            return jsonify({'error': 'Non autorizzato'}), 403
+        
+        ultimo_letto_id = LetturaConversazione.segna_letti(user.id, richiesta_id)
+        db.session.commit()
         
         return jsonify({
-            'richiesta': richiesta.to_dict(include_sensitive_data=(richiesta.stato == 'Accettata')),
-            'messaggi': [msg.to_dict() for msg in messaggi]
+            'richiesta_id': richiesta_id,
+            'ultimo_letto_id': ultimo_letto_id
         }), 200
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@richieste_bp.route('/non-letti', methods=['GET'])
+@require_auth()
+def get_non_letti(user):
+    """Restituisce i messaggi non letti dell'utente per ogni richiesta, con una sola query sull'indice"""
+    try:
+        righe = db.session.query(
+            LetturaConversazione.richiesta_id, LetturaConversazione.non_letti
+        ).filter(
+            LetturaConversazione.utente_id == user.id,
+            LetturaConversazione.non_letti > 0
+        ).all()
+        
+        non_letti = {str(richiesta_id): n for richiesta_id, n in righe}
+        
+        return jsonify({
+            'non_letti': non_letti,
+            'totale': sum(non_letti.values())
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@richieste_bp.route('/cerca', methods=['GET'])
+@require_auth()
+def cerca(user):
+    """Ricerca full-text nei messaggi e nelle richieste dell'utente, ordinata per rilevanza"""
+    try:
+        testo = (request.args.get('q') or '').strip()
+        if not testo:
+            return jsonify({'error': 'Testo di ricerca obbligatorio'}), 400
+        
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = page_size(request.args.get('per_page', type=int))
+        
+        risultati, totale = cerca_conversazioni(user.id, testo, page, per_page)
+        
+        return jsonify({
+            'risultati': risultati,
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'total': totale,
+                'pages': (totale + per_page - 1) // per_page,
+                'has_next': page * per_page < totale,
+                'has_prev': page > 1
+            }
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Intervallo dei commenti keep-alive inviati sulle connessioni SSE inattive
+SSE_HEARTBEAT = 15  # secondi
+
+@richieste_bp.route('/stream', methods=['GET'])
+@require_auth()
+def stream_eventi(user):
+    """
+    Canale Server-Sent Events con i nuovi messaggi e i cambi di stato delle richieste dell'utente.
+    Un client inattivo tiene aperta una connessione invece di interrogare il database a ogni polling
+    """
+    sottoscrizione = get_broker().subscribe([canale_utente(user.id)])
+    
+    def genera():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                evento = sottoscrizione.get(timeout=SSE_HEARTBEAT)
+                if evento is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            sottoscrizione.close()
+    
+    return Response(genera(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
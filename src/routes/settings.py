@@ -1,28 +1,35 @@
 from flask import Blueprint, request, jsonify, session
-from werkzeug.security import generate_password_hash, check_password_hash
 from src.models.user import db, User, Promotore, Azienda
+from src.services.current_user import require_auth, invalidate_identity
+from src.services.password_hasher import HasherSaturo
+from src.services.session_store import revoke_user_sessions
+from src.services.ricerca_aziende import registra_azienda_aggiornata, registra_azienda_eliminata
+from src.services.matching import motore_matching
+from src.models.raccomandazioni import StatoClassificaPromotori
+from src.models.eliminazione import EliminazioneAccount
+from src.services.eliminazione_account import elimina_account  # Registra il task 'eliminazione_account'
+from src.services.tasks import accoda
+from src.models.screenshot import Screenshot
+from src.services.archivio_screenshot import archivia, elimina_screenshot, percorso_blob
+from src.services.caricamenti import ricevi_immagini, CaricamentoRifiutato
+from flask import send_file
+from sqlalchemy.orm import joinedload
 import os
-from werkzeug.utils import secure_filename
 
 settings_bp = Blueprint('settings', __name__)
 
+# Cartella dei caricamenti precedenti all'archivio per hash (vedi update_db_screenshot.py)
 UPLOAD_FOLDER = 'uploads/screenshots'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# I blob sono immutabili: il browser può tenerli in cache a lungo
+CACHE_SCREENSHOT_SECONDI = 30 * 24 * 3600
 
 @settings_bp.route('/profile', methods=['PUT'])
-def update_profile():
+@require_auth(carica_utente=True)
+def update_profile(user):
     """Aggiorna il profilo utente"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
-        if not user:
-            return jsonify({'error': 'Utente non trovato'}), 404
-        
         data = request.get_json()
         
         # Aggiorna email se fornita
@@ -35,7 +42,7 @@ def update_profile():
         
         # Aggiorna dati specifici per tipo utente
         if user.tipo_utente == 'Promotore':
-            promotore = Promotore.query.filter_by(user_id=user.id).first()
+            promotore = user.promotore
             if promotore:
                 if 'industry' in data:
                     promotore.industry = data['industry']
@@ -47,9 +54,13 @@ def update_profile():
                     promotore.tiktok_link = data['tiktok_link']
                 if 'linkedin_link' in data:
                     promotore.linkedin_link = data['linkedin_link']
+                if 'visualizzazioni_medie' in data:
+                    promotore.visualizzazioni_medie = data['visualizzazioni_medie']
+                if 'localita' in data:
+                    promotore.localita = data['localita']
         
         elif user.tipo_utente == 'Azienda':
-            azienda = Azienda.query.filter_by(user_id=user.id).first()
+            azienda = user.azienda
             if azienda:
                 if 'nome_attivita' in data:
                     azienda.nome_attivita = data['nome_attivita']
@@ -59,8 +70,13 @@ def update_profile():
                     azienda.localita = data['localita']
                 if 'min_visualizzazioni_richieste' in data:
                     azienda.min_visualizzazioni_richieste = data['min_visualizzazioni_richieste']
+                StatoClassificaPromotori.segna_obsoleta(azienda.id)
+                registra_azienda_aggiornata(azienda)
         
         db.session.commit()
+        invalidate_identity(user.id)
+        if user.tipo_utente != 'Azienda':
+            motore_matching.invalida_promotore(user.id)
         
         return jsonify({'message': 'Profilo aggiornato con successo'}), 200
         
@@ -69,165 +85,182 @@ def update_profile():
         return jsonify({'error': str(e)}), 500
 
 @settings_bp.route('/password', methods=['PUT'])
-def change_password():
+@require_auth(carica_utente=True)
+def change_password(user):
     """Cambia la password dell'utente"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
-        if not user:
-            return jsonify({'error': 'Utente non trovato'}), 404
-        
         data = request.get_json()
         
         if not data.get('current_password') or not data.get('new_password'):
             return jsonify({'error': 'Password attuale e nuova password sono obbligatorie'}), 400
         
         # Verifica password attuale
-        if not check_password_hash(user.password_hash, data['current_password']):
+        if not user.check_password(data['current_password']):
             return jsonify({'error': 'Password attuale non corretta'}), 400
         
         # Aggiorna password
-        user.password_hash = generate_password_hash(data['new_password'])
+        user.set_password(data['new_password'])
         db.session.commit()
+        invalidate_identity(user.id)
+        
+        # Disconnette le altre sessioni attive dell'utente
+        revoke_user_sessions(user.id, tranne=getattr(session, 'token', None))
         
         return jsonify({'message': 'Password cambiata con successo'}), 200
         
+    except HasherSaturo as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @settings_bp.route('/screenshots', methods=['POST'])
-def upload_screenshots():
+@require_auth('Promotore', 'Solo i content creator possono caricare screenshot')
+def upload_screenshots(user):
     """Carica screenshot degli insights (solo per content creator)"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
-        if not user or user.tipo_utente != 'Promotore':
-            return jsonify({'error': 'Solo i content creator possono caricare screenshot'}), 403
-        
-        # Crea directory se non esiste
-        upload_path = os.path.join(UPLOAD_FOLDER, str(user.id))
-        os.makedirs(upload_path, exist_ok=True)
+        # Il corpo viene letto a blocchi: i file non passano da request.files né restano in memoria
+        validi, scartati = ricevi_immagini(request, ALLOWED_EXTENSIONS)
+    except CaricamentoRifiutato as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    try:
+        file_scartati = [{'filename': f.nome_file, 'motivo': f.motivo_scarto} for f in scartati]
+        if not validi:
+            return jsonify({'error': 'Nessun file valido caricato', 'scartati': file_scartati}), 400
         
         uploaded_files = []
+        for file in validi:
+            # Salvataggio per hash del contenuto: una nuova copia dello stesso file non occupa altro spazio
+            screenshot, nuovo = archivia(file.scrittura, user.id, file.tipo_mime, file.nome_file)
+            uploaded_files.append({**screenshot.to_dict(), 'duplicato': not nuovo})
         
-        for key in request.files:
-            file = request.files[key]
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                # Aggiungi timestamp per evitare conflitti
-                import time
-                timestamp = str(int(time.time()))
-                filename = f"{timestamp}_{filename}"
-                
-                file_path = os.path.join(upload_path, filename)
-                file.save(file_path)
-                uploaded_files.append({
-                    'filename': filename,
-                    'path': file_path,
-                    'url': f'/uploads/screenshots/{user.id}/{filename}'
-                })
-        
-        if not uploaded_files:
-            return jsonify({'error': 'Nessun file valido caricato'}), 400
+        db.session.commit()
         
         return jsonify({
             'message': f'{len(uploaded_files)} screenshot caricati con successo',
-            'files': uploaded_files
+            'files': uploaded_files,
+            'scartati': file_scartati
         }), 201
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    finally:
+        # File temporanei mai passati ad archivia (errori a metà); gli altri li gestisce la sessione
+        for file in validi:
+            file.annulla()
 
 @settings_bp.route('/screenshots', methods=['GET'])
-def get_screenshots():
+@require_auth('Promotore', 'Solo i content creator possono visualizzare screenshot')
+def get_screenshots(user):
     """Ottiene la lista degli screenshot caricati"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
+        screenshots = Screenshot.query.options(joinedload(Screenshot.blob)).filter_by(
+            user_id=user.id
+        ).order_by(Screenshot.created_at.desc(), Screenshot.id.desc()).all()
+        
+        return jsonify({'screenshots': [s.to_dict() for s in screenshots]}), 200
         
-        user = User.query.get(session['user_id'])
-        if not user or user.tipo_utente != 'Promotore':
-            return jsonify({'error': 'Solo i content creator possono visualizzare screenshot'}), 403
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@settings_bp.route('/screenshots/<int:screenshot_id>/file', methods=['GET'])
+@require_auth('Promotore', 'Solo i content creator possono visualizzare screenshot')
+def get_screenshot_file(user, screenshot_id):
+    """Restituisce il file di uno screenshot dell'utente"""
+    try:
+        screenshot = Screenshot.query.filter_by(id=screenshot_id, user_id=user.id).first()
+        if not screenshot:
+            return jsonify({'error': 'Screenshot non trovato'}), 404
+        
+        percorso = percorso_blob(screenshot.blob_hash)
+        if not os.path.exists(percorso):
+            return jsonify({'error': 'File non disponibile'}), 404
+        
+        # Il contenuto di un hash non cambia mai: l'hash fa da ETag e la risposta può restare in cache
+        return send_file(
+            percorso,
+            mimetype=screenshot.blob.tipo_mime,
+            download_name=screenshot.nome_file,
+            etag=screenshot.blob_hash,
+            max_age=CACHE_SCREENSHOT_SECONDI,
+            conditional=True
+        )
         
-        upload_path = os.path.join(UPLOAD_FOLDER, str(user.id))
-        screenshots = []
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@settings_bp.route('/screenshots/<int:screenshot_id>', methods=['DELETE'])
+@require_auth('Promotore', 'Solo i content creator possono eliminare screenshot')
+def delete_screenshot(user, screenshot_id):
+    """Elimina uno screenshot; il file viene rimosso quando nessun altro utente lo usa"""
+    try:
+        screenshot = Screenshot.query.filter_by(id=screenshot_id, user_id=user.id).first()
+        if not screenshot:
+            return jsonify({'error': 'Screenshot non trovato'}), 404
         
-        if os.path.exists(upload_path):
-            for filename in os.listdir(upload_path):
-                if allowed_file(filename):
-                    screenshots.append({
-                        'filename': filename,
-                        'url': f'/uploads/screenshots/{user.id}/{filename}'
-                    })
+        elimina_screenshot(screenshot)
+        db.session.commit()
         
-        return jsonify({'screenshots': screenshots}), 200
+        return jsonify({'message': 'Screenshot eliminato con successo'}), 200
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @settings_bp.route('/account', methods=['DELETE'])
-def delete_account():
+@require_auth(carica_utente=True)
+def delete_account(user):
     """Elimina l'account utente"""
     try:
-        if 'user_id' not in session:
-            return jsonify({'error': 'Non autenticato'}), 401
-        
-        user = User.query.get(session['user_id'])
-        if not user:
-            return jsonify({'error': 'Utente non trovato'}), 404
-        
-        # Elimina dati correlati
-        if user.tipo_utente == 'Promotore':
-            promotore = Promotore.query.filter_by(user_id=user.id).first()
-            if promotore:
-                # Elimina richieste associate
-                from src.models.user import Richiesta
-                from src.models.messaggio import Messaggio
-                
-                richieste = Richiesta.query.filter_by(promotore_id=promotore.id).all()
-                for richiesta in richieste:
-                    # Elimina messaggi associati
-                    Messaggio.query.filter_by(richiesta_id=richiesta.id).delete()
-                    db.session.delete(richiesta)
-                
-                db.session.delete(promotore)
-        
-        elif user.tipo_utente == 'Azienda':
-            azienda = Azienda.query.filter_by(user_id=user.id).first()
-            if azienda:
-                # Elimina richieste associate
-                from src.models.user import Richiesta
-                from src.models.messaggio import Messaggio
-                
-                richieste = Richiesta.query.filter_by(azienda_id=azienda.id).all()
-                for richiesta in richieste:
-                    # Elimina messaggi associati
-                    Messaggio.query.filter_by(richiesta_id=richiesta.id).delete()
-                    db.session.delete(richiesta)
-                
-                db.session.delete(azienda)
-        
-        # Elimina screenshot se esistono
-        upload_path = os.path.join(UPLOAD_FOLDER, str(user.id))
-        if os.path.exists(upload_path):
-            import shutil
-            shutil.rmtree(upload_path)
-        
-        # Elimina utente
-        db.session.delete(user)
-        db.session.commit()
-        
-        # Rimuovi dalla sessione
+        # L'eliminazione dei dati avviene in background: qui si crea solo il job
+        job = EliminazioneAccount.in_corso(user.id)
+        if not job:
+            job = EliminazioneAccount(
+                user_id=user.id,
+                tipo_utente=user.tipo_utente,
+                percorso_file=os.path.abspath(os.path.join(UPLOAD_FOLDER, str(user.id)))
+            )
+            db.session.add(job)
+            db.session.flush()
+            # Job e task nella stessa transazione: nessun job resta senza chi lo esegue
+            accoda('eliminazione_account', job_id=job.id, chiave=f'eliminazione_account:{user.id}')
+            if user.tipo_utente == 'Azienda':
+                # Le aziende spariscono dagli indici di ricerca di ogni processo dopo il commit
+                registra_azienda_eliminata(user.id)
+            db.session.commit()
+        
+        # L'account sparisce subito da ricerche e cache
+        invalidate_identity(user.id)
+        motore_matching.invalida_promotore(user.id)
+        
+        # Revoca tutte le sessioni dell'utente e rimuovi quella corrente
+        revoke_user_sessions(user.id)
         session.clear()
         
-        return jsonify({'message': 'Account eliminato con successo'}), 200
+        return jsonify({
+            'message': 'Eliminazione dell\'account avviata',
+            'eliminazione': job.to_dict(),
+            'stato_url': f'/api/settings/account/eliminazione/{job.id}'
+        }), 202
         
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@settings_bp.route('/account/eliminazione/<string:job_id>', methods=['GET'])
+def get_stato_eliminazione(job_id):
+    """Avanzamento dell'eliminazione di un account (l'id del job fa da credenziale)"""
+    try:
+        job = db.session.get(EliminazioneAccount, job_id)
+        if not job:
+            return jsonify({'error': 'Eliminazione non trovata'}), 404
+        
+        return jsonify({'eliminazione': job.to_dict()}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
@@ -1,27 +1,13 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify
 from flask_cors import cross_origin
-from src.models.user import db, User
+from src.models.user import db
+from src.services.current_user import require_auth
 from src.models.subscription import Subscription, PlanType, SubscriptionStatus
+from src.services.outbox import registra_evento
 from datetime import datetime
 
 subscription_bp = Blueprint('subscription', __name__)
 
-def require_auth():
-    """Decorator per richiedere autenticazione"""
-    def decorator(f):
-        def wrapper(*args, **kwargs):
-            if 'user_id' not in session:
-                return jsonify({'error': 'Non autenticato'}), 401
-            
-            user = User.query.get(session['user_id'])
-            if not user:
-                return jsonify({'error': 'Utente non trovato'}), 404
-            
-            return f(user, *args, **kwargs)
-        wrapper.__name__ = f.__name__
-        return wrapper
-    return decorator
-
 @subscription_bp.route('/current', methods=['GET'])
 @cross_origin()
 @require_auth()
@@ -118,6 +104,10 @@ def upgrade_subscription(current_user):
         
         # Aggiorna il piano
         if subscription.upgrade_plan(new_plan_type):
+            registra_evento(
+                'azienda', current_user.id, 'abbonamento_aggiornato',
+                plan_type=subscription.plan_type.value, status=subscription.status.value
+            )
             db.session.commit()
             
             return jsonify({
@@ -151,6 +141,10 @@ def cancel_subscription(current_user):
             return jsonify({'error': 'Il piano Basic non può essere cancellato'}), 400
         
         subscription.cancel_subscription()
+        registra_evento(
+            'azienda', current_user.id, 'abbonamento_aggiornato',
+            plan_type=subscription.plan_type.value, status=subscription.status.value
+        )
         db.session.commit()
         
         return jsonify({
@@ -0,0 +1,226 @@
+import hashlib
+import logging
+import os
+import tempfile
+from sqlalchemy import delete, event, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from src.models.user import db, violazione_unicita
+from src.models.screenshot import BlobScreenshot, Screenshot
+from src.services.tasks import task, accoda
+
+logger = logging.getLogger(__name__)
+
+# Radice dei blob: <radice>/ab/cd/<sha256>, due livelli da 256 directory tengono piccola ogni cartella
+RADICE_BLOB = os.environ.get('SCREENSHOT_STORAGE', 'uploads/blob')
+
+# Classe degli advisory lock Postgres sugli hash dei blob (la chiave è ricavata dall'hash)
+BLOB_LOCK_CLASSE = 49_001
+
+# Byte letti e scritti per volta: la memoria usata non dipende dalla dimensione del file
+BLOCCO_LETTURA = 64 * 1024
+
+TIPI_MIME = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+}
+
+def percorso_blob(hash_contenuto):
+    """Percorso assoluto del blob con l'hash indicato"""
+    return os.path.abspath(os.path.join(RADICE_BLOB, hash_contenuto[:2], hash_contenuto[2:4], hash_contenuto))
+
+class ScritturaBlob:
+    """
+    File temporaneo in cui un contenuto viene scritto e hashato a blocchi.
+    Entra nell'archivio solo con pubblica(): fino ad allora può essere scartato senza lasciare residui
+    """
+
+    def __init__(self):
+        cartella_temporanea = os.path.join(RADICE_BLOB, 'tmp')
+        os.makedirs(cartella_temporanea, exist_ok=True)
+        descrittore, self.percorso_temporaneo = tempfile.mkstemp(dir=cartella_temporanea)
+        self._file = os.fdopen(descrittore, 'wb')
+        self._digest = hashlib.sha256()
+        self.dimensione = 0
+        self.hash = None
+
+    def scrivi(self, blocco):
+        self._digest.update(blocco)
+        self._file.write(blocco)
+        self.dimensione += len(blocco)
+
+    def chiudi(self):
+        """Termina la scrittura e restituisce l'hash del contenuto"""
+        if self.hash is None:
+            self._file.close()
+            self.hash = self._digest.hexdigest()
+        return self.hash
+
+    def pubblica(self):
+        """
+        Sposta il file nel percorso del blob. Se il blob esiste già il contenuto è identico:
+        la rinomina lo sostituisce senza occupare altro spazio. Restituisce (hash, dimensione)
+        """
+        hash_contenuto = self.chiudi()
+        percorso = percorso_blob(hash_contenuto)
+        os.makedirs(os.path.dirname(percorso), exist_ok=True)
+        os.replace(self.percorso_temporaneo, percorso)
+        return hash_contenuto, self.dimensione
+
+    def annulla(self):
+        """Rimuove il file temporaneo (nessun effetto dopo pubblica)"""
+        self._file.close()
+        if os.path.exists(self.percorso_temporaneo):
+            os.unlink(self.percorso_temporaneo)
+
+def scrivi_stream(stream):
+    """Copia lo stream in una ScritturaBlob a blocchi di BLOCCO_LETTURA byte (da passare ad archivia)"""
+    scrittura = ScritturaBlob()
+    try:
+        while blocco := stream.read(BLOCCO_LETTURA):
+            scrittura.scrivi(blocco)
+        scrittura.chiudi()
+    except BaseException:
+        scrittura.annulla()
+        raise
+    return scrittura
+
+def _blocca_hash(hash_contenuto):
+    """
+    Advisory lock Postgres sull'hash fino alla fine della transazione: serializza la pubblicazione
+    di un file con la sua rimozione dal disco. Su SQLite le transazioni di scrittura sono già serializzate
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            text('SELECT pg_advisory_xact_lock(:classe, :chiave)'),
+            {'classe': BLOB_LOCK_CLASSE, 'chiave': int(hash_contenuto[:8], 16) - 2 ** 31}
+        )
+
+def _incrementa_riferimenti(hash_contenuto, dimensione, tipo_mime):
+    """
+    Aggiunge un riferimento al blob, creando la riga se manca. L'UPDATE blocca la riga,
+    quindi un'eliminazione concorrente non può cancellarla prima del commit (il file è protetto da _blocca_hash)
+    """
+    for _ in range(2):
+        risultato = db.session.execute(
+            update(BlobScreenshot)
+            .where(BlobScreenshot.hash == hash_contenuto)
+            .values(riferimenti=BlobScreenshot.riferimenti + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if risultato.rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(BlobScreenshot(
+                    hash=hash_contenuto, dimensione=dimensione, tipo_mime=tipo_mime, riferimenti=1
+                ))
+            return
+        except IntegrityError as e:
+            # Creato nel frattempo da un altro caricamento: si riprova con l'UPDATE
+            if not violazione_unicita(e):
+                raise
+    raise RuntimeError(f"Impossibile registrare il blob {hash_contenuto}")
+
+def archivia(scrittura, user_id, tipo_mime, nome_file):
+    """
+    Collega il file scritto all'utente nella transazione corrente; da qui la scrittura appartiene alla sessione.
+    Il file entra nell'archivio solo dopo il commit e viene scartato con il rollback:
+    nessun blob resta su disco senza la sua riga. Il task di rimozione trova la riga e lascia il file.
+    Restituisce (screenshot, nuovo): se l'utente aveva già caricato lo stesso contenuto restituisce quello esistente
+    """
+    # Pubblicato anche per uno screenshot già esistente: ripristina un file eventualmente mancante
+    db.session.info.setdefault('blob_da_pubblicare', []).append(scrittura)
+    hash_contenuto = scrittura.chiudi()
+    _blocca_hash(hash_contenuto)
+    return _registra_screenshot(user_id, hash_contenuto, scrittura.dimensione, tipo_mime, nome_file)
+
+@event.listens_for(Session, 'after_commit')
+def _pubblica_blob(session):
+    if session.in_nested_transaction():
+        # Rilascio di un savepoint: la transazione non è ancora confermata
+        return
+    for scrittura in session.info.pop('blob_da_pubblicare', []):
+        try:
+            scrittura.pubblica()
+        except OSError as e:
+            # La riga è confermata: ricaricare lo stesso contenuto ripristina il file
+            logger.error(f"Pubblicazione del blob {scrittura.hash} non riuscita: {e}")
+            scrittura.annulla()
+
+@event.listens_for(Session, 'after_transaction_end')
+def _scarta_blob(session, transaction):
+    # Alla fine della transazione principale restano solo le scritture non confermate (rollback o chiusura)
+    if transaction.parent is None:
+        for scrittura in session.info.pop('blob_da_pubblicare', []):
+            scrittura.annulla()
+
+def _registra_screenshot(user_id, hash_contenuto, dimensione, tipo_mime, nome_file):
+    esistente = Screenshot.query.filter_by(user_id=user_id, blob_hash=hash_contenuto).first()
+    if esistente is not None:
+        return esistente, False
+
+    _incrementa_riferimenti(hash_contenuto, dimensione, tipo_mime)
+    screenshot = Screenshot(user_id=user_id, blob_hash=hash_contenuto, nome_file=nome_file)
+    try:
+        with db.session.begin_nested():
+            db.session.add(screenshot)
+    except IntegrityError as e:
+        # Stesso contenuto caricato in parallelo dallo stesso utente: il riferimento è già contato
+        if not violazione_unicita(e):
+            raise
+        _rilascia_blob([hash_contenuto])
+        return Screenshot.query.filter_by(user_id=user_id, blob_hash=hash_contenuto).first(), False
+    return screenshot, True
+
+def _rilascia_blob(hashes):
+    """Toglie un riferimento a ciascun blob; quelli rimasti senza riferimenti vengono rimossi dopo il commit"""
+    if not hashes:
+        return
+    db.session.execute(
+        update(BlobScreenshot)
+        .where(BlobScreenshot.hash.in_(hashes))
+        .values(riferimenti=BlobScreenshot.riferimenti - 1)
+        .execution_options(synchronize_session=False)
+    )
+    orfani = db.session.scalars(
+        select(BlobScreenshot.hash).where(BlobScreenshot.hash.in_(hashes), BlobScreenshot.riferimenti <= 0)
+    ).all()
+    if orfani:
+        db.session.execute(
+            delete(BlobScreenshot)
+            .where(BlobScreenshot.hash.in_(orfani), BlobScreenshot.riferimenti <= 0)
+            .execution_options(synchronize_session=False)
+        )
+        for hash_contenuto in orfani:
+            accoda('rimuovi_blob_screenshot', chiave=f'blob:{hash_contenuto}', hash_contenuto=hash_contenuto)
+
+def elimina_screenshot(screenshot):
+    """Elimina lo screenshot nella transazione corrente; il file resta finché altri utenti lo usano"""
+    hash_contenuto = screenshot.blob_hash
+    db.session.delete(screenshot)
+    db.session.flush()
+    _rilascia_blob([hash_contenuto])
+
+def elimina_screenshot_utente(user_id):
+    """Elimina tutti gli screenshot dell'utente (eliminazione dell'account). Restituisce le righe eliminate"""
+    hashes = db.session.scalars(select(Screenshot.blob_hash).where(Screenshot.user_id == user_id)).all()
+    righe = db.session.execute(delete(Screenshot).where(Screenshot.user_id == user_id)).rowcount
+    # Un solo screenshot per utente e blob: ogni hash vale esattamente un riferimento
+    _rilascia_blob(hashes)
+    return righe
+
+@task('rimuovi_blob_screenshot')
+def rimuovi_blob(hash_contenuto):
+    """Task del pool: rimuove dal disco un blob senza più riferimenti"""
+    # Stesso lock di archivia: un caricamento concorrente dello stesso contenuto attende il commit o viene atteso
+    _blocca_hash(hash_contenuto)
+    if db.session.get(BlobScreenshot, hash_contenuto) is not None:
+        # Ricaricato dopo l'eliminazione: il file serve di nuovo
+        return
+    try:
+        os.unlink(percorso_blob(hash_contenuto))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,138 @@
+import bisect
+import heapq
+import threading
+from collections import Counter
+from src.models.user import db, Azienda
+from src.services.indice_testuale import normalizza
+
+# Campi delle aziende per cui sono disponibili i suggerimenti
+CAMPI_AUTOCOMPLETAMENTO = ('nome_attivita', 'tipo_attivita', 'localita')
+
+SUGGERIMENTI_DEFAULT = 10
+SUGGERIMENTI_MAX = 20
+
+# I prefissi fino a questa lunghezza coprono molti valori: i loro risultati vengono memorizzati
+PREFISSO_MEMO_MAX = 2
+
+class IndicePrefissi:
+    """
+    Valori distinti di un campo con il numero di aziende che li usano, in un array ordinato.
+    Ogni valore è indicizzato dall'inizio di ciascuna sua parola ("Pizzeria Da Mario" si trova anche con "mar")
+    """
+
+    def __init__(self):
+        self._chiavi = []  # [(chiave normalizzata, valore)] ordinato
+        self._conteggi = {}  # valore -> numero di aziende
+        self._memo = {}  # (prefisso, limite) -> suggerimenti
+
+    @staticmethod
+    def _chiavi_valore(valore):
+        parole = normalizza(valore).split()
+        return {' '.join(parole[i:]) for i in range(len(parole))}
+
+    def carica(self, valori):
+        """Costruzione iniziale: un solo ordinamento invece di un inserimento per valore"""
+        self._conteggi = dict(Counter(v for v in valori if v))
+        self._chiavi = sorted(
+            (chiave, valore) for valore in self._conteggi for chiave in self._chiavi_valore(valore)
+        )
+        self._memo = {}
+
+    def aggiungi(self, valore):
+        if not valore:
+            return
+        self._memo.clear()
+        if valore in self._conteggi:
+            self._conteggi[valore] += 1
+            return
+        self._conteggi[valore] = 1
+        for chiave in self._chiavi_valore(valore):
+            bisect.insort(self._chiavi, (chiave, valore))
+
+    def rimuovi(self, valore):
+        if valore not in self._conteggi:
+            return
+        self._memo.clear()
+        self._conteggi[valore] -= 1
+        if self._conteggi[valore] > 0:
+            return
+        del self._conteggi[valore]
+        for chiave in self._chiavi_valore(valore):
+            i = bisect.bisect_left(self._chiavi, (chiave, valore))
+            if i < len(self._chiavi) and self._chiavi[i] == (chiave, valore):
+                del self._chiavi[i]
+
+    def suggerisci(self, prefisso, limite):
+        """I valori più usati che hanno una parola che inizia con il prefisso"""
+        prefisso = ' '.join(normalizza(prefisso).split())
+        if not prefisso:
+            return []
+
+        memo = len(prefisso) <= PREFISSO_MEMO_MAX
+        if memo and (prefisso, limite) in self._memo:
+            return self._memo[(prefisso, limite)]
+
+        # Le chiavi con il prefisso sono contigue nell'array ordinato
+        inizio = bisect.bisect_left(self._chiavi, (prefisso,))
+        fine = bisect.bisect_left(self._chiavi, (prefisso + '\uffff',))
+        valori = {valore for _, valore in self._chiavi[inizio:fine]}
+        risultato = [
+            {'valore': valore, 'conteggio': self._conteggi[valore]}
+            for valore in heapq.nsmallest(limite, valori, key=lambda v: (-self._conteggi[v], v))
+        ]
+
+        if memo:
+            self._memo[(prefisso, limite)] = risultato
+        return risultato
+
+class IndiceAutocompletamento:
+    """Indici dei prefissi dei campi delle aziende, costruiti all'avvio e aggiornati a ogni modifica"""
+
+    def __init__(self):
+        self._campi = {campo: IndicePrefissi() for campo in CAMPI_AUTOCOMPLETAMENTO}
+        self._valori_azienda = {}  # azienda_id -> {campo: valore}, per togliere i valori vecchi
+        self.pronto = False
+        self._lock = threading.Lock()
+
+    def costruisci(self):
+        """Carica i valori di tutte le aziende (da chiamare in un app context)"""
+        colonne = [getattr(Azienda, campo) for campo in CAMPI_AUTOCOMPLETAMENTO]
+        righe = db.session.query(Azienda.id, *colonne).all()
+        with self._lock:
+            self._valori_azienda = {
+                azienda_id: dict(zip(CAMPI_AUTOCOMPLETAMENTO, valori)) for azienda_id, *valori in righe
+            }
+            for campo, indice in self._campi.items():
+                indice.carica(valori[campo] for valori in self._valori_azienda.values())
+            self.pronto = True
+
+    def _aggiungi(self, azienda_id, valori):
+        self._valori_azienda[azienda_id] = valori
+        for campo, valore in valori.items():
+            self._campi[campo].aggiungi(valore)
+
+    def _rimuovi(self, azienda_id):
+        for campo, valore in self._valori_azienda.pop(azienda_id, {}).items():
+            self._campi[campo].rimuovi(valore)
+
+    def aggiorna(self, azienda_id, campi):
+        """Sostituisce i valori di un'azienda dopo registrazione o modifica del profilo"""
+        if not self.pronto:
+            return
+        with self._lock:
+            self._rimuovi(azienda_id)
+            self._aggiungi(azienda_id, {campo: campi[campo] for campo in CAMPI_AUTOCOMPLETAMENTO})
+
+    def rimuovi(self, azienda_id):
+        if not self.pronto:
+            return
+        with self._lock:
+            self._rimuovi(azienda_id)
+
+    def suggerisci(self, campo, prefisso, limite=SUGGERIMENTI_DEFAULT):
+        if not self.pronto:
+            self.costruisci()
+        with self._lock:
+            return self._campi[campo].suggerisci(prefisso, limite)
+
+indice_autocompletamento = IndiceAutocompletamento()
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MANCANTE = object()
+
+class TTLCache:
+    """
+    Cache LRU limitata con scadenza (TTL) per voce, sicura tra thread.
+    Le voci scadute vengono scartate alla lettura; oltre maxsize viene rimossa la meno usata.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._dati = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chiave, default=None):
+        """Restituisce il valore associato alla chiave se presente e non scaduto"""
+        with self._lock:
+            voce = self._dati.get(chiave, _MANCANTE)
+            if voce is _MANCANTE:
+                return default
+
+            scadenza, valore = voce
+            if scadenza < time.monotonic():
+                del self._dati[chiave]
+                return default
+
+            self._dati.move_to_end(chiave)
+            return valore
+
+    def set(self, chiave, valore, ttl=None):
+        """Inserisce o aggiorna una voce"""
+        scadenza = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._dati[chiave] = (scadenza, valore)
+            self._dati.move_to_end(chiave)
+            while len(self._dati) > self.maxsize:
+                self._dati.popitem(last=False)
+
+    def pop(self, chiave, default=None):
+        """Rimuove una voce restituendone il valore"""
+        with self._lock:
+            voce = self._dati.pop(chiave, _MANCANTE)
+        if voce is _MANCANTE:
+            return default
+        return voce[1]
+
+    def invalidate(self, chiave):
+        """Rimuove una voce, se presente"""
+        self.pop(chiave)
+
+    def clear(self):
+        """Svuota la cache"""
+        with self._lock:
+            self._dati.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._dati)
@@ -0,0 +1,162 @@
+import os
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, Field, File, Data
+from werkzeug.utils import secure_filename
+from src.services.archivio_screenshot import ScritturaBlob, BLOCCO_LETTURA
+
+# Limiti dei caricamenti (variabili d'ambiente in MB)
+MAX_DIMENSIONE_FILE = int(os.environ.get('UPLOAD_MAX_FILE_MB', 10)) * 1024 * 1024
+MAX_DIMENSIONE_RICHIESTA = int(os.environ.get('UPLOAD_MAX_RICHIESTA_MB', 30)) * 1024 * 1024
+MAX_FILE_PER_RICHIESTA = 10
+
+# Intestazioni delle parti e campi di testo restano in memoria: oltre questa soglia la richiesta è rifiutata
+MAX_BUFFER_MULTIPART = 4 * BLOCCO_LETTURA
+
+# Firme (magic bytes) dei formati ammessi: il tipo si ricava dal contenuto, non dal nome
+FIRME_IMMAGINI = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+LUNGHEZZA_FIRMA = max(len(firma) for firma, _ in FIRME_IMMAGINI)
+
+class CaricamentoRifiutato(ValueError):
+    """Richiesta di caricamento non accettabile; status è il codice HTTP da restituire"""
+
+    def __init__(self, messaggio, status=400):
+        super().__init__(messaggio)
+        self.status = status
+
+def tipo_immagine(intestazione):
+    """Tipo MIME dell'immagine riconosciuto dai primi byte, None se non è un formato ammesso"""
+    for firma, tipo_mime in FIRME_IMMAGINI:
+        if intestazione.startswith(firma):
+            return tipo_mime
+    return None
+
+class FileRicevuto:
+    """Parte file della richiesta: i dati vanno direttamente su disco, in memoria resta solo l'intestazione"""
+
+    def __init__(self, nome_originale, estensioni_ammesse):
+        self.nome_file = secure_filename(nome_originale or '')
+        self.tipo_mime = None
+        self.scrittura = None
+        self.motivo_scarto = None
+        self._intestazione = b''
+
+        estensione = self.nome_file.rsplit('.', 1)[1].lower() if '.' in self.nome_file else ''
+        if estensione not in estensioni_ammesse:
+            self.motivo_scarto = 'Estensione non ammessa'
+
+    def ricevi(self, dati):
+        if self.motivo_scarto:
+            # Parte scartata: i dati vengono letti (vanno consumati) ma non salvati
+            return
+        if self.scrittura is None:
+            self._intestazione += dati
+            if len(self._intestazione) < LUNGHEZZA_FIRMA:
+                return
+            self._verifica_intestazione()
+            return
+        self._scrivi(dati)
+
+    def termina(self):
+        """Fine della parte: restituisce True se il file è valido e pronto per l'archivio"""
+        if not self.motivo_scarto and self.scrittura is None:
+            # File più corto della firma più lunga
+            self._verifica_intestazione()
+        if self.motivo_scarto:
+            return False
+        self.scrittura.chiudi()
+        return True
+
+    def annulla(self):
+        if self.scrittura is not None:
+            self.scrittura.annulla()
+
+    def _verifica_intestazione(self):
+        self.tipo_mime = tipo_immagine(self._intestazione)
+        if self.tipo_mime is None:
+            self.motivo_scarto = 'Il contenuto non è un\'immagine PNG, JPEG o GIF'
+            return
+        self.scrittura = ScritturaBlob()
+        dati, self._intestazione = self._intestazione, b''
+        self._scrivi(dati)
+
+    def _scrivi(self, dati):
+        if self.scrittura.dimensione + len(dati) > MAX_DIMENSIONE_FILE:
+            raise CaricamentoRifiutato(
+                f'Il file {self.nome_file} supera il limite di {MAX_DIMENSIONE_FILE // (1024 * 1024)} MB', 413
+            )
+        self.scrittura.scrivi(dati)
+
+def ricevi_immagini(richiesta, estensioni_ammesse):
+    """
+    Legge il corpo multipart della richiesta a blocchi di BLOCCO_LETTURA byte, senza passare da request.files:
+    ogni file viene validato dai primi byte e scritto e hashato mentre arriva.
+    Una richiesta dichiarata troppo grande è rifiutata prima di leggerne il corpo.
+    Restituisce (validi, scartati) come liste di FileRicevuto; i validi vanno pubblicati o annullati dal chiamante
+    """
+    if richiesta.mimetype != 'multipart/form-data':
+        raise CaricamentoRifiutato('La richiesta deve essere multipart/form-data', 415)
+    boundary = richiesta.mimetype_params.get('boundary')
+    if not boundary:
+        raise CaricamentoRifiutato('Boundary multipart mancante')
+
+    limite_mb = MAX_DIMENSIONE_RICHIESTA // (1024 * 1024)
+    if richiesta.content_length is not None and richiesta.content_length > MAX_DIMENSIONE_RICHIESTA:
+        raise CaricamentoRifiutato(f'La richiesta supera il limite di {limite_mb} MB', 413)
+
+    # Una parte per file più eventuali campi di testo
+    decoder = MultipartDecoder(
+        boundary.encode(), max_form_memory_size=MAX_BUFFER_MULTIPART, max_parts=2 * MAX_FILE_PER_RICHIESTA
+    )
+    stream = richiesta.stream
+    letti = 0
+    validi, scartati = [], []
+    corrente = None
+    try:
+        while True:
+            evento = decoder.next_event()
+            if isinstance(evento, NeedData):
+                blocco = stream.read(BLOCCO_LETTURA)
+                letti += len(blocco)
+                # Senza Content-Length (chunked) il limite si controlla durante la lettura
+                if letti > MAX_DIMENSIONE_RICHIESTA:
+                    raise CaricamentoRifiutato(f'La richiesta supera il limite di {limite_mb} MB', 413)
+                decoder.receive_data(blocco or None)
+            elif isinstance(evento, File):
+                if len(validi) + len(scartati) >= MAX_FILE_PER_RICHIESTA:
+                    raise CaricamentoRifiutato(f'Massimo {MAX_FILE_PER_RICHIESTA} file per richiesta', 413)
+                corrente = FileRicevuto(evento.filename, estensioni_ammesse)
+            elif isinstance(evento, Field):
+                corrente = None
+            elif isinstance(evento, Data):
+                if corrente is None:
+                    continue
+                corrente.ricevi(evento.data)
+                if not evento.more_data:
+                    (validi if corrente.termina() else scartati).append(corrente)
+                    corrente = None
+            elif isinstance(evento, Epilogue):
+                break
+    except CaricamentoRifiutato:
+        _annulla(validi, corrente)
+        raise
+    except RequestEntityTooLarge:
+        _annulla(validi, corrente)
+        raise CaricamentoRifiutato('Intestazioni o campi multipart troppo grandi', 413)
+    except ValueError as e:
+        _annulla(validi, corrente)
+        raise CaricamentoRifiutato(f'Corpo multipart non valido: {e}')
+    except BaseException:
+        _annulla(validi, corrente)
+        raise
+    return validi, scartati
+
+def _annulla(validi, corrente):
+    for ricevuto in validi:
+        ricevuto.annulla()
+    if corrente is not None:
+        corrente.annulla()
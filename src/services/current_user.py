@@ -0,0 +1,105 @@
+from collections import namedtuple
+from functools import wraps
+from flask import g, jsonify, session
+from sqlalchemy.orm import joinedload
+from src.models.user import db, User, Promotore, Azienda
+from src.services.cache import TTLCache
+
+# Messaggi di errore predefiniti per i controlli sul tipo utente
+MESSAGGI_TIPO_UTENTE = {
+    'Promotore': 'Accesso riservato ai promotori',
+    'Azienda': 'Accesso riservato alle aziende',
+}
+
+# Cache delle identità: gli utenti cambiano raramente, un TTL breve limita i dati obsoleti
+# tra worker diversi; le scritture locali invalidano la voce esplicitamente
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 30  # secondi
+
+Identita = namedtuple('Identita', ['id', 'email', 'tipo_utente', 'profilo_id'])
+
+identity_cache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+
+def invalidate_identity(user_id):
+    """Rimuove l'identità dell'utente dalla cache (da chiamare dopo ogni modifica all'utente)"""
+    identity_cache.invalidate(user_id)
+    g.pop('current_identity', None)
+
+def _load_identity(user_id):
+    """Legge dal database solo i campi necessari all'identità"""
+    row = db.session.query(
+        User.id, User.email, User.tipo_utente, Promotore.id, Azienda.id
+    ).outerjoin(Promotore, Promotore.id == User.id).outerjoin(
+        Azienda, Azienda.id == User.id
+    ).filter(User.id == user_id).first()
+
+    if not row:
+        return None
+
+    user_id, email, tipo_utente, promotore_id, azienda_id = row
+    return Identita(user_id, email, tipo_utente, promotore_id or azienda_id)
+
+def get_current_identity():
+    """
+    Restituisce l'identità (immutabile) dell'utente della sessione.
+    Viene letta dalla cache quando possibile e memorizzata su flask.g per la richiesta
+    """
+    if 'current_identity' not in g:
+        user_id = session.get('user_id')
+        identita = None
+        if user_id is not None:
+            identita = identity_cache.get(user_id)
+            if identita is None:
+                identita = _load_identity(user_id)
+                if identita is not None:
+                    identity_cache.set(user_id, identita)
+        g.current_identity = identita
+    return g.current_identity
+
+def get_current_user():
+    """
+    Restituisce l'utente della sessione con il profilo (promotore o azienda) già caricato.
+    La query viene eseguita una sola volta per richiesta e il risultato è memorizzato su flask.g
+    """
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        g.current_user = None
+        if user_id is not None:
+            g.current_user = User.query.options(
+                joinedload(User.promotore),
+                joinedload(User.azienda)
+            ).filter_by(id=user_id).first()
+    return g.current_user
+
+def require_auth(tipo_utente=None, messaggio_errore=None, carica_utente=False):
+    """
+    Decorator per richiedere autenticazione.
+    tipo_utente: se indicato ('Promotore' o 'Azienda'), limita l'accesso a quel tipo di utente
+    messaggio_errore: messaggio restituito con il 403 al posto di quello predefinito
+    carica_utente: se True passa al handler l'oggetto User (con profilo) invece dell'Identita in cache
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if 'user_id' not in session:
+                return jsonify({'error': 'Non autenticato'}), 401
+
+            identita = get_current_identity()
+            if not identita:
+                return jsonify({'error': 'Utente non trovato'}), 404
+
+            if tipo_utente and identita.tipo_utente != tipo_utente:
+                messaggio = messaggio_errore or MESSAGGI_TIPO_UTENTE.get(tipo_utente, 'Non autorizzato')
+                return jsonify({'error': messaggio}), 403
+
+            if not carica_utente:
+                return f(identita, *args, **kwargs)
+
+            user = get_current_user()
+            if not user:
+                invalidate_identity(identita.id)
+                return jsonify({'error': 'Utente non trovato'}), 404
+
+            return f(user, *args, **kwargs)
+        return wrapper
+    return decorator
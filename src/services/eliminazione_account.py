@@ -0,0 +1,149 @@
+import logging
+import os
+import shutil
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import delete, func, inspect, select, update
+from src.models.user import db, User, Promotore, Azienda, Richiesta
+from src.models.messaggio import Messaggio, LetturaConversazione
+from src.models.contatori import ContatoriRichieste, applica_delta
+from src.models.raccomandazioni import PromotoreConsigliato, StatoClassificaPromotori
+from src.models.leaderboard import LeaderboardEntry
+from src.models.perk_points import PerkPointsBalance, PerkPointsTransaction, ActivePerk
+from src.models.subscription import Subscription
+from src.models.eliminazione import EliminazioneAccount
+from src.models.task import PRIORITA_BASSA
+from src.services.tasks import task
+from src.services.archivio_screenshot import elimina_screenshot_utente
+
+logger = logging.getLogger(__name__)
+
+# Righe eliminate per transazione: limita la durata dei lock e la dimensione del WAL
+BLOCCO_ELIMINAZIONE = 500
+
+def _aggiorna_avanzamento(job, fase, righe=0):
+    job.fase = fase
+    job.righe_eliminate += righe
+    db.session.commit()
+
+def _elimina_a_blocchi(job, fase, modello, condizione):
+    """DELETE in blocchi di BLOCCO_ELIMINAZIONE righe, con un commit (e l'avanzamento) per blocco"""
+    while True:
+        ids = db.session.scalars(select(modello.id).where(condizione).limit(BLOCCO_ELIMINAZIONE)).all()
+        if not ids:
+            return
+        db.session.execute(delete(modello).where(modello.id.in_(ids)))
+        _aggiorna_avanzamento(job, fase, len(ids))
+
+def _elimina_richieste(job, condizione):
+    """
+    Elimina a blocchi le richieste che soddisfano la condizione con i relativi messaggi e cursori di lettura.
+    I contatori delle aziende vengono corretti nella stessa transazione di ciascun blocco
+    """
+    while True:
+        ids = db.session.scalars(select(Richiesta.id).where(condizione).limit(BLOCCO_ELIMINAZIONE)).all()
+        if not ids:
+            return
+
+        delta = defaultdict(lambda: defaultdict(int))
+        for azienda_id, stato, totale in db.session.execute(
+            select(Richiesta.azienda_id, Richiesta.stato, func.count())
+            .where(Richiesta.id.in_(ids))
+            .group_by(Richiesta.azienda_id, Richiesta.stato)
+        ):
+            delta[azienda_id][stato] -= totale
+
+        messaggi = db.session.execute(delete(Messaggio).where(Messaggio.richiesta_id.in_(ids))).rowcount
+        letture = db.session.execute(
+            delete(LetturaConversazione).where(LetturaConversazione.richiesta_id.in_(ids))
+        ).rowcount
+        db.session.execute(delete(Richiesta).where(Richiesta.id.in_(ids)))
+        applica_delta(db.session.connection(), delta)
+        _aggiorna_avanzamento(job, 'richieste', len(ids) + messaggi + letture)
+
+def _condizione_richieste(job):
+    if job.tipo_utente == 'Promotore':
+        return Richiesta.promotore_id == job.user_id
+    return Richiesta.azienda_id == job.user_id
+
+def _rimuovi_file(job):
+    if job.percorso_file and os.path.exists(job.percorso_file):
+        try:
+            shutil.rmtree(job.percorso_file)
+        except OSError as e:
+            # I dati sono già eliminati: i file residui non fanno fallire il job
+            logger.warning(f"Impossibile rimuovere {job.percorso_file}: {e}")
+
+def esegui_eliminazione(job):
+    """
+    Esegue tutte le fasi dell'eliminazione. Ogni fase è idempotente,
+    quindi un job interrotto può ripartire dall'inizio senza effetti collaterali
+    """
+    user_id = job.user_id
+    job.stato = 'In corso'
+    db.session.commit()
+
+    # Richieste, messaggi e cursori di lettura di entrambe le parti
+    _elimina_richieste(job, _condizione_richieste(job))
+
+    # Cursori di lettura residui dell'utente
+    righe = db.session.execute(delete(LetturaConversazione).where(LetturaConversazione.utente_id == user_id)).rowcount
+    _aggiorna_avanzamento(job, 'letture', righe)
+
+    # Classifiche dei promotori consigliati: quelle delle aziende in cui compariva l'utente vanno ricalcolate
+    aziende_coinvolte = select(PromotoreConsigliato.azienda_id).where(PromotoreConsigliato.promotore_id == user_id)
+    db.session.execute(
+        update(StatoClassificaPromotori)
+        .where(StatoClassificaPromotori.azienda_id.in_(aziende_coinvolte))
+        .values(obsoleta=True)
+    )
+    righe = db.session.execute(delete(PromotoreConsigliato).where(
+        db.or_(PromotoreConsigliato.azienda_id == user_id, PromotoreConsigliato.promotore_id == user_id)
+    )).rowcount
+    righe += db.session.execute(delete(StatoClassificaPromotori).where(StatoClassificaPromotori.azienda_id == user_id)).rowcount
+    _aggiorna_avanzamento(job, 'classifiche', righe)
+
+    _elimina_a_blocchi(job, 'leaderboard', LeaderboardEntry, LeaderboardEntry.promotore_id == user_id)
+    _aggiorna_avanzamento(job, 'leaderboard')
+
+    _elimina_a_blocchi(job, 'perk', PerkPointsTransaction, PerkPointsTransaction.azienda_id == user_id)
+    _elimina_a_blocchi(job, 'perk', ActivePerk, ActivePerk.azienda_id == user_id)
+    _elimina_a_blocchi(job, 'perk', PerkPointsBalance, PerkPointsBalance.azienda_id == user_id)
+    _aggiorna_avanzamento(job, 'perk')
+
+    # Subscription è registrato su un'istanza SQLAlchemy separata: la tabella può non esistere
+    if inspect(db.engine).has_table(Subscription.__tablename__):
+        _elimina_a_blocchi(job, 'abbonamenti', Subscription, Subscription.azienda_id == user_id)
+    _aggiorna_avanzamento(job, 'abbonamenti')
+
+    # Screenshot dell'utente: i blob senza altri riferimenti vengono rimossi dal pool dei task
+    _aggiorna_avanzamento(job, 'screenshot', elimina_screenshot_utente(user_id))
+
+    # Richieste arrivate durante il job, poi profilo e utente in un'unica transazione
+    _elimina_richieste(job, _condizione_richieste(job))
+    righe = db.session.execute(delete(ContatoriRichieste).where(ContatoriRichieste.azienda_id == user_id)).rowcount
+    righe += db.session.execute(delete(Promotore).where(Promotore.id == user_id)).rowcount
+    righe += db.session.execute(delete(Azienda).where(Azienda.id == user_id)).rowcount
+    righe += db.session.execute(delete(User).where(User.id == user_id)).rowcount
+    _aggiorna_avanzamento(job, 'profilo', righe)
+
+    _aggiorna_avanzamento(job, 'file')
+    _rimuovi_file(job)
+
+    job.stato = 'Completata'
+    job.completed_at = datetime.utcnow()
+    db.session.commit()
+
+def _eliminazione_fallita(job_id, errore):
+    job = db.session.get(EliminazioneAccount, job_id)
+    if job is not None:
+        job.stato = 'Fallita'
+        job.errore = errore
+
+@task('eliminazione_account', priorita=PRIORITA_BASSA, al_fallimento=_eliminazione_fallita)
+def elimina_account(job_id):
+    """Task del pool: esegue (o riprende) l'eliminazione registrata in eliminazione_account"""
+    job = db.session.get(EliminazioneAccount, job_id)
+    if job is None or job.stato not in ('In coda', 'In corso'):
+        return
+    esegui_eliminazione(job)
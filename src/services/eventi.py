@@ -0,0 +1,191 @@
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from sqlalchemy import text
+from src.models.user import db
+from src.services.outbox import registra_evento
+
+logger = logging.getLogger(__name__)
+
+# Eventi in coda per ciascun client prima di considerarlo troppo lento
+CODA_MAX_EVENTI = 100
+
+def canale_utente(user_id):
+    """Nome del canale su cui vengono pubblicati gli eventi destinati a un utente"""
+    return f'utente:{user_id}'
+
+class Sottoscrizione:
+    """Coda di eventi di un client collegato"""
+
+    def __init__(self, canali, broker):
+        self.canali = set(canali)
+        self.broker = broker
+        self.coda = queue.Queue(maxsize=CODA_MAX_EVENTI)
+        self.eventi_persi = False
+
+    def consegna(self, evento):
+        try:
+            self.coda.put_nowait(evento)
+        except queue.Full:
+            # Client troppo lento: si scartano gli eventi e gli si chiede di risincronizzarsi
+            self.eventi_persi = True
+
+    def get(self, timeout=None):
+        """Attende il prossimo evento; restituisce None allo scadere del timeout"""
+        if self.eventi_persi:
+            self.eventi_persi = False
+            return {'tipo': 'resync'}
+        try:
+            return self.coda.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class Broker:
+    """Interfaccia del sistema pub/sub usato per le notifiche push"""
+
+    def publish(self, canale, evento):
+        raise NotImplementedError
+
+    def subscribe(self, canali):
+        raise NotImplementedError
+
+    def unsubscribe(self, sottoscrizione):
+        raise NotImplementedError
+
+class InProcessBroker(Broker):
+    """Pub/sub in memoria: sufficiente con un solo processo server"""
+
+    def __init__(self):
+        self._sottoscrizioni = {}
+        self._lock = threading.Lock()
+
+    def publish(self, canale, evento):
+        with self._lock:
+            destinatari = list(self._sottoscrizioni.get(canale, ()))
+        for sottoscrizione in destinatari:
+            sottoscrizione.consegna(evento)
+
+    def subscribe(self, canali):
+        sottoscrizione = Sottoscrizione(canali, self)
+        with self._lock:
+            for canale in sottoscrizione.canali:
+                self._sottoscrizioni.setdefault(canale, set()).add(sottoscrizione)
+        return sottoscrizione
+
+    def unsubscribe(self, sottoscrizione):
+        with self._lock:
+            for canale in sottoscrizione.canali:
+                iscritti = self._sottoscrizioni.get(canale)
+                if iscritti:
+                    iscritti.discard(sottoscrizione)
+                    if not iscritti:
+                        del self._sottoscrizioni[canale]
+
+class PostgresBroker(Broker):
+    """
+    Distribuisce gli eventi tra più worker con NOTIFY/LISTEN di Postgres.
+    La pubblicazione passa dal database; un thread per processo riceve le notifiche
+    e le inoltra ai client collegati tramite un InProcessBroker locale.
+    Il DSN di ascolto deve essere una connessione diretta: i pooler in transaction mode non supportano LISTEN
+    """
+
+    CANALE_PG = 'uss_eventi'
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.locale = InProcessBroker()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, canale, evento):
+        payload = json.dumps({'canale': canale, 'evento': evento})
+        with db.engine.begin() as conn:
+            conn.execute(text('SELECT pg_notify(:canale, :payload)'), {'canale': self.CANALE_PG, 'payload': payload})
+
+    def subscribe(self, canali):
+        self._avvia_ascolto()
+        return self.locale.subscribe(canali)
+
+    def unsubscribe(self, sottoscrizione):
+        self.locale.unsubscribe(sottoscrizione)
+
+    def _avvia_ascolto(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._ascolta, daemon=True)
+                self._thread.start()
+
+    def _ascolta(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {self.CANALE_PG}')
+                logger.info("Broker eventi in ascolto su Postgres")
+
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notifica = conn.notifies.pop(0)
+                        messaggio = json.loads(notifica.payload)
+                        self.locale.publish(messaggio['canale'], messaggio['evento'])
+
+            except Exception as e:
+                logger.error(f"Errore nel broker eventi Postgres, nuovo tentativo tra 5 secondi: {e}")
+            finally:
+                # Ogni tentativo apre una nuova connessione: quella precedente va chiusa
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(5)
+
+# Broker globale (sostituibile all'avvio con set_broker)
+broker = InProcessBroker()
+
+def set_broker(nuovo_broker):
+    """Sostituisce il broker usato dall'applicazione"""
+    global broker
+    broker = nuovo_broker
+
+def get_broker():
+    return broker
+
+def pubblica(user_ids, tipo, **dati):
+    """
+    Pubblica un evento sui canali degli utenti indicati.
+    Da chiamare dopo il commit, così i client non ricevono eventi per modifiche annullate
+    """
+    evento = {'tipo': tipo, **dati}
+    for user_id in set(user_ids):
+        try:
+            broker.publish(canale_utente(user_id), evento)
+        except Exception as e:
+            # Le notifiche push non devono mai far fallire la richiesta che le genera
+            logger.error(f"Errore nella pubblicazione dell'evento {tipo}: {e}")
+
+def registra_evento_richiesta(richiesta, tipo, **dati):
+    """
+    Scrive nell'outbox un evento relativo a una richiesta, nella transazione corrente:
+    dopo il commit i sottoscrittori notificano entrambe le parti e aggiornano gli indici
+    """
+    return registra_evento(
+        'richiesta', richiesta.id, tipo,
+        promotore_id=richiesta.promotore_id,
+        azienda_id=richiesta.azienda_id,
+        stato=richiesta.stato,
+        **dati
+    )
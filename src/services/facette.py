@@ -0,0 +1,66 @@
+from collections import Counter
+from sqlalchemy import func, literal, union_all
+from src.models.user import db, Promotore
+
+# Valori restituiti per ciascuna facetta (i più frequenti)
+FACETTE_MAX_VALORI = 20
+
+# Facette di presenza dei link social dei promotori: nome -> colonna
+SOCIAL_PROMOTORE = {
+    'instagram': Promotore.instagram_link,
+    'tiktok': Promotore.tiktok_link,
+    'linkedin': Promotore.linkedin_link,
+}
+
+def formatta_facetta(conteggi, massimo=FACETTE_MAX_VALORI):
+    """Da {valore: conteggio} alla lista ordinata per conteggio restituita dalle API"""
+    return [
+        {'valore': valore, 'conteggio': conteggio}
+        for valore, conteggio in Counter(conteggi).most_common(massimo)
+        if valore is not None and conteggio > 0
+    ]
+
+def conta_facette(rami):
+    """
+    Esegue in un'unica query (UNION ALL) i conteggi di più facette.
+    rami: [(nome facetta, select con colonne 'valore' e 'conteggio')]
+    """
+    if not rami:
+        return {}
+
+    query = union_all(*[
+        select.add_columns(literal(nome).label('facetta')) for nome, select in rami
+    ])
+
+    conteggi = {nome: {} for nome, _ in rami}
+    for riga in db.session.execute(query):
+        conteggi[riga.facetta][riga.valore] = riga.conteggio
+    return {nome: formatta_facetta(valori) for nome, valori in conteggi.items()}
+
+def facette_promotori(condizioni):
+    """
+    Conteggi per industry e presenza dei link social dei promotori.
+    condizioni: {nome filtro: condizione SQL}; ogni facetta ignora il proprio filtro,
+    così i conteggi mostrano cosa si otterrebbe cambiandolo
+    """
+    def altre(escluso):
+        return [c for nome, c in condizioni.items() if nome != escluso]
+
+    facette = conta_facette([(
+        'industry',
+        db.select(Promotore.industry.label('valore'), func.count().label('conteggio'))
+        .where(*altre('industry'))
+        .group_by(Promotore.industry)
+    )])
+
+    # Presenza dei link social: un COUNT filtrato per facetta nella stessa SELECT
+    # (come rami della UNION darebbero una colonna booleana incompatibile con industry su Postgres)
+    social = db.session.execute(db.select(*[
+        func.count().filter(db.and_(colonna.isnot(None), *altre(nome))).label(nome)
+        for nome, colonna in SOCIAL_PROMOTORE.items()
+    ]).select_from(Promotore)).one()
+
+    return {
+        'industry': facette['industry'],
+        'social': {nome: getattr(social, nome) for nome in SOCIAL_PROMOTORE}
+    }
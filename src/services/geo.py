@@ -0,0 +1,129 @@
+import csv
+import math
+import os
+import re
+from src.services.indice_testuale import normalizza
+
+# Gazetteer offline delle località italiane (nome, sigla provincia, coordinate)
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'localita_it.csv')
+
+RAGGIO_TERRA_KM = 6371.0
+KM_PER_GRADO_LAT = 111.32
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISIONE = 9  # celle di circa 5 m: abbastanza per qualsiasi prefisso di ricerca
+
+# Numero massimo di celle geohash interrogate per coprire un cerchio di ricerca
+CELLE_MAX = 16
+
+_gazetteer = None
+
+def _chiave(nome):
+    return ' '.join(re.findall(r"\w+", normalizza(nome)))
+
+def _carica_gazetteer():
+    global _gazetteer
+    if _gazetteer is None:
+        gazetteer = {}
+        with open(GAZETTEER_PATH, encoding='utf-8') as f:
+            for riga in csv.DictReader(f):
+                coordinate = (float(riga['latitudine']), float(riga['longitudine']))
+                gazetteer[_chiave(riga['nome'])] = coordinate
+        _gazetteer = gazetteer
+    return _gazetteer
+
+def geocodifica(localita):
+    """
+    Coordinate (lat, lon) di una località testuale secondo il gazetteer, None se sconosciuta.
+    Accetta anche forme come "Milano (MI)", "Roma, Lazio" o "Sesto San Giovanni - MI"
+    """
+    if not localita:
+        return None
+    gazetteer = _carica_gazetteer()
+
+    chiave = _chiave(localita)
+    if chiave in gazetteer:
+        return gazetteer[chiave]
+
+    # Solo la parte prima di provincia/regione
+    principale = _chiave(re.split(r'[,(/\-]', localita)[0])
+    return gazetteer.get(principale)
+
+def distanza_km(lat1, lon1, lat2, lon2):
+    """Distanza sul globo tra due punti (formula dell'emisenoverso)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * RAGGIO_TERRA_KM * math.asin(math.sqrt(a))
+
+def geohash(lat, lon, precisione=GEOHASH_PRECISIONE):
+    """Codifica le coordinate in un geohash: punti vicini condividono un prefisso"""
+    intervallo_lat, intervallo_lon = [-90.0, 90.0], [-180.0, 180.0]
+    risultato = []
+    bit, carattere, pari = 0, 0, True
+    while len(risultato) < precisione:
+        intervallo, valore = (intervallo_lon, lon) if pari else (intervallo_lat, lat)
+        medio = (intervallo[0] + intervallo[1]) / 2
+        if valore >= medio:
+            carattere = carattere * 2 + 1
+            intervallo[0] = medio
+        else:
+            carattere = carattere * 2
+            intervallo[1] = medio
+        pari = not pari
+        bit += 1
+        if bit == 5:
+            risultato.append(GEOHASH_BASE32[carattere])
+            bit, carattere = 0, 0
+    return ''.join(risultato)
+
+def _dimensioni_cella(precisione):
+    """Altezza e larghezza in gradi di una cella geohash"""
+    bit = 5 * precisione
+    return 180.0 / 2 ** (bit // 2), 360.0 / 2 ** ((bit + 1) // 2)
+
+def celle_copertura(lat, lon, raggio_km):
+    """
+    Prefissi geohash che coprono il cerchio di ricerca: la precisione più fine
+    per cui bastano al massimo CELLE_MAX celle. Restituisce un insieme di prefissi
+    """
+    dlat = raggio_km / KM_PER_GRADO_LAT
+    dlon = raggio_km / (KM_PER_GRADO_LAT * max(math.cos(math.radians(lat)), 0.01))
+    lat_min, lat_max = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    lon_min, lon_max = max(lon - dlon, -180.0), min(lon + dlon, 180.0)
+
+    precisione = 1
+    for p in range(GEOHASH_PRECISIONE, 0, -1):
+        altezza, larghezza = _dimensioni_cella(p)
+        celle = (math.ceil((lat_max - lat_min) / altezza) + 1) * (math.ceil((lon_max - lon_min) / larghezza) + 1)
+        if celle <= CELLE_MAX:
+            precisione = p
+            break
+
+    # Campiona il riquadro a passi di mezza cella, così nessuna cella intersecata viene saltata
+    altezza, larghezza = _dimensioni_cella(precisione)
+    celle = set()
+    passi_lat = math.ceil((lat_max - lat_min) / (altezza / 2)) + 1
+    passi_lon = math.ceil((lon_max - lon_min) / (larghezza / 2)) + 1
+    for i in range(passi_lat):
+        punto_lat = min(lat_min + i * altezza / 2, lat_max)
+        for j in range(passi_lon):
+            punto_lon = min(lon_min + j * larghezza / 2, lon_max)
+            celle.add(geohash(punto_lat, punto_lon, precisione))
+    return celle
+
+def intervallo_prefisso(prefisso):
+    """
+    Intervallo [inizio, fine) dei geohash con il prefisso dato, utilizzabile su un indice B-tree.
+    La fine è il prefisso successivo nell'alfabeto base32 (cifre e minuscole hanno lo stesso ordine
+    in qualsiasi collation), None se il prefisso è l'ultimo possibile
+    """
+    caratteri = list(prefisso)
+    while caratteri:
+        posizione = GEOHASH_BASE32.index(caratteri[-1])
+        if posizione + 1 < len(GEOHASH_BASE32):
+            caratteri[-1] = GEOHASH_BASE32[posizione + 1]
+            return prefisso, ''.join(caratteri)
+        caratteri.pop()
+    return prefisso, None
@@ -0,0 +1,130 @@
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+# Parametri BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_PAROLA = re.compile(r'\w+', re.UNICODE)
+
+def normalizza(testo):
+    """Minuscolo e senza accenti, per confronti indipendenti da maiuscole e accentate"""
+    testo = unicodedata.normalize('NFKD', testo or '')
+    return ''.join(c for c in testo if not unicodedata.combining(c)).lower()
+
+def tokenizza(testo):
+    """Divide il testo normalizzato in termini di almeno due caratteri"""
+    return [t for t in _PAROLA.findall(normalizza(testo)) if len(t) > 1]
+
+class IndiceTestuale:
+    """
+    Indice invertito in memoria con ranking BM25.
+    Usato come alternativa locale agli indici full-text di Postgres (sviluppo, test, SQLite):
+    ogni documento ha un id e dei metadati liberi usati per filtrare i risultati
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(dict)  # termine -> {doc_id: frequenza}
+        self._termini_doc = {}  # doc_id -> termini del documento (per rimozione e aggiornamento)
+        self._lunghezze = {}  # doc_id -> numero di termini
+        self._metadati = {}
+        self._lunghezza_totale = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._lunghezze)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._lunghezze
+
+    def aggiungi(self, doc_id, testo, **metadati):
+        """Indicizza (o reindicizza) un documento"""
+        termini = Counter(tokenizza(testo))
+        with self._lock:
+            self._rimuovi(doc_id)
+            for termine, frequenza in termini.items():
+                self._postings[termine][doc_id] = frequenza
+            self._termini_doc[doc_id] = tuple(termini)
+            lunghezza = sum(termini.values())
+            self._lunghezze[doc_id] = lunghezza
+            self._lunghezza_totale += lunghezza
+            self._metadati[doc_id] = metadati
+
+    def rimuovi(self, doc_id):
+        """Rimuove un documento dall'indice"""
+        with self._lock:
+            self._rimuovi(doc_id)
+
+    def _rimuovi(self, doc_id):
+        for termine in self._termini_doc.pop(doc_id, ()):
+            documenti = self._postings.get(termine)
+            if documenti is not None:
+                documenti.pop(doc_id, None)
+                if not documenti:
+                    del self._postings[termine]
+        self._lunghezza_totale -= self._lunghezze.pop(doc_id, 0)
+        self._metadati.pop(doc_id, None)
+
+    def metadati(self, doc_id):
+        return self._metadati.get(doc_id, {})
+
+    def cerca(self, query, filtro=None):
+        """
+        Restituisce [(doc_id, punteggio)] dei documenti che contengono tutti i termini della query,
+        ordinati per rilevanza. filtro(metadati) permette di limitare i documenti ammessi
+        """
+        termini = set(tokenizza(query))
+        if not termini:
+            return []
+
+        with self._lock:
+            liste = [self._postings.get(t, {}) for t in termini]
+            if not all(liste):
+                return []
+
+            # Si parte dalla lista più corta e si interseca con le altre
+            liste.sort(key=len)
+            candidati = set(liste[0])
+            for documenti in liste[1:]:
+                candidati &= documenti.keys()
+                if not candidati:
+                    return []
+
+            if filtro is not None:
+                candidati = {d for d in candidati if filtro(self._metadati[d])}
+
+            n_doc = len(self._lunghezze)
+            media = self._lunghezza_totale / n_doc if n_doc else 0
+            risultati = []
+            for doc_id in candidati:
+                lunghezza = self._lunghezze[doc_id]
+                punteggio = 0.0
+                for documenti in liste:
+                    frequenza = documenti[doc_id]
+                    idf = math.log(1 + (n_doc - len(documenti) + 0.5) / (len(documenti) + 0.5))
+                    norma = frequenza + BM25_K1 * (1 - BM25_B + BM25_B * lunghezza / (media or 1))
+                    punteggio += idf * frequenza * (BM25_K1 + 1) / norma
+                risultati.append((doc_id, punteggio))
+
+        risultati.sort(key=lambda r: r[1], reverse=True)
+        return risultati
+
+def estratto(testo, query, lunghezza=160):
+    """Porzione del testo centrata sul primo termine della query trovato"""
+    testo = testo or ''
+    if len(testo) <= lunghezza:
+        return testo
+
+    normalizzato = normalizza(testo)
+    posizione = -1
+    for termine in tokenizza(query):
+        posizione = normalizzato.find(termine)
+        if posizione >= 0:
+            break
+
+    inizio = max(0, posizione - lunghezza // 3) if posizione >= 0 else 0
+    frammento = testo[inizio:inizio + lunghezza]
+    return ('…' if inizio > 0 else '') + frammento + ('…' if inizio + lunghezza < len(testo) else '')
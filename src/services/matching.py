@@ -0,0 +1,410 @@
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from sqlalchemy import case, func, insert, text
+from src.models.user import db, Azienda, Promotore, Richiesta
+from src.models.leaderboard import LeaderboardEntry
+from src.models.perk_points import calculate_perk_priority_scores
+from src.models.raccomandazioni import PromotoreConsigliato, StatoClassificaPromotori
+from src.services.cache import TTLCache
+from src.services.geo import RAGGIO_TERRA_KM
+from src.services.indice_testuale import tokenizza
+from src.services.tasks import task, accoda
+from src.models.task import PRIORITA_BASSA
+
+# Peso di ciascuna componente nel punteggio di compatibilità (somma 1)
+PESI_MATCH = {
+    'industry': 0.35,
+    'visualizzazioni': 0.25,
+    'distanza': 0.20,
+    'accettazione': 0.15,
+    'perk': 0.05,
+}
+
+# Radici delle parole di tipo_attivita / nome_attivita affini a ciascuna industry dei promotori
+AFFINITA_INDUSTRY = {
+    'Beauty': ('beauty', 'bellezza', 'estetic', 'parrucch', 'barbier', 'cosmet', 'spa', 'nail', 'unghie', 'trucco', 'benessere', 'profum'),
+    'Food & Restaurant': ('food', 'ristor', 'pizz', 'trattoria', 'osteria', 'bar', 'caff', 'pasticc', 'gelat', 'pub', 'enoteca', 'vino', 'panific', 'forno', 'cucina', 'bistrot', 'sushi'),
+    'Fashion': ('fashion', 'moda', 'abbigliamento', 'boutique', 'scarpe', 'calzatur', 'gioiell', 'accessori', 'sartoria', 'outlet', 'vintage'),
+    'Travel': ('travel', 'viagg', 'hotel', 'albergo', 'resort', 'turism', 'agriturismo', 'ostello', 'campeggio', 'villaggio', 'tour', 'bnb'),
+    'Tech': ('tech', 'tecnolog', 'informatic', 'software', 'elettronic', 'digital', 'telefonia', 'computer', 'gaming'),
+}
+
+# Distanza alla quale la componente di vicinanza si dimezza
+DISTANZA_DIMEZZAMENTO_KM = 30
+
+# Valore delle componenti per cui manca il dato (né premiate né penalizzate)
+NEUTRO = 0.5
+
+# Durata delle caratteristiche delle aziende in memoria (accettazioni e perk cambiano nel tempo)
+MATRICE_TTL = 300  # secondi
+
+RACCOMANDAZIONI_MAX = 100
+RACCOMANDAZIONI_CACHE_TTL = 300  # secondi
+
+# Peso di ciascuna componente nella classifica dei promotori per un'azienda (somma 1)
+PESI_CLASSIFICA_PROMOTORI = {
+    'industry': 0.30,
+    'leaderboard': 0.35,
+    'accettazione': 0.25,
+    'social': 0.10,
+}
+
+# Posizioni materializzate per ciascuna azienda
+CLASSIFICA_TOP_N = 50
+
+# Aziende ricalcolate per transazione durante l'aggiornamento notturno
+CLASSIFICA_BLOCCO = 200
+
+# Classe degli advisory lock Postgres sulle classifiche (la chiave è l'id dell'azienda)
+CLASSIFICA_LOCK_CLASSE = 43_001
+
+logger = logging.getLogger(__name__)
+
+def _radici_industry(industry):
+    if industry in AFFINITA_INDUSTRY:
+        return AFFINITA_INDUSTRY[industry]
+    # Industry personalizzata: si usano le sue parole
+    return tuple(tokenizza(industry))
+
+def _contiene_radice(testo, radici):
+    return any(parola.startswith(radice) for parola in testo.split() for radice in radici)
+
+def affinita_industry(industry, tipo, nome):
+    """Affinità tra un'industry e un'azienda (testi già tokenizzati): 1 sul tipo di attività, 0.5 solo sul nome"""
+    radici = _radici_industry(industry or '')
+    if _contiene_radice(tipo, radici):
+        return 1.0
+    if _contiene_radice(nome, radici):
+        return 0.5
+    return 0.0
+
+class MatriceAziende:
+    """
+    Caratteristiche di tutte le aziende organizzate per colonne (un vettore numpy per caratteristica):
+    il punteggio di un promotore si calcola con operazioni su colonne intere, senza cicli per azienda
+    """
+
+    def __init__(self):
+        self.creata = time.monotonic()
+
+        righe = db.session.query(
+            Azienda.id, Azienda.tipo_attivita, Azienda.nome_attivita,
+            Azienda.min_visualizzazioni_richieste, Azienda.latitudine, Azienda.longitudine
+        ).order_by(Azienda.id).all()
+        # Storico delle richieste decise per azienda, con una sola GROUP BY (come in MatricePromotori)
+        decise = {
+            azienda_id: (accettate or 0, totale)
+            for azienda_id, accettate, totale in db.session.query(
+                Richiesta.azienda_id,
+                func.sum(case((Richiesta.stato == 'Accettata', 1), else_=0)),
+                func.count(Richiesta.id)
+            ).filter(Richiesta.stato.in_(['Accettata', 'Rifiutata'])).group_by(Richiesta.azienda_id)
+        }
+        priorita = calculate_perk_priority_scores()
+        priorita_max = max(priorita.values(), default=0) or 1
+
+        self.ids = np.array([r.id for r in righe], dtype=np.int64)
+        self.tipi = [' '.join(tokenizza(r.tipo_attivita)) for r in righe]
+        self.nomi = [' '.join(tokenizza(r.nome_attivita)) for r in righe]
+        self.min_visualizzazioni = np.array([r.min_visualizzazioni_richieste or 0 for r in righe], dtype=np.float64)
+        self.con_coordinate = np.array([r.latitudine is not None and r.longitudine is not None for r in righe], dtype=bool)
+        self.latitudini = np.radians(np.array([r.latitudine or 0.0 for r in righe], dtype=np.float64))
+        self.longitudini = np.radians(np.array([r.longitudine or 0.0 for r in righe], dtype=np.float64))
+
+        # Tasso di accettazione con correzione di Laplace: senza storico vale 0.5
+        accettate = np.array([decise.get(r.id, (0, 0))[0] for r in righe], dtype=np.float64)
+        totali = np.array([decise.get(r.id, (0, 0))[1] for r in righe], dtype=np.float64)
+        self.accettazione = (accettate + 1) / (totali + 2)
+        self.perk = np.array([priorita.get(r.id, 0) for r in righe], dtype=np.float64) / priorita_max
+
+        self._industry = {}  # industry -> colonna di affinità (condivisa tra i promotori)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def scaduta(self):
+        return time.monotonic() - self.creata > MATRICE_TTL
+
+    def colonna_industry(self, industry):
+        """
+        Affinità di ogni azienda con l'industry: 1 sul tipo di attività, 0.5 solo sul nome.
+        È un confronto tra testi, quindi per azienda, ma si calcola una volta per industry e matrice
+        """
+        with self._lock:
+            colonna = self._industry.get(industry)
+        if colonna is None:
+            colonna = np.fromiter(
+                (affinita_industry(industry, tipo, nome) for tipo, nome in zip(self.tipi, self.nomi)),
+                dtype=np.float64, count=len(self.ids)
+            )
+            with self._lock:
+                self._industry[industry] = colonna
+        return colonna
+
+    def colonna_visualizzazioni(self, visualizzazioni):
+        """Quanto il pubblico del promotore copre il minimo richiesto da ciascuna azienda"""
+        minimi = self.min_visualizzazioni
+        if visualizzazioni is None:
+            return np.where(minimi <= 0, 1.0, NEUTRO)
+        # np.maximum evita la divisione per zero nel ramo che np.where scarta comunque
+        return np.where(minimi <= visualizzazioni, 1.0, visualizzazioni / np.maximum(minimi, 1))
+
+    def colonna_distanza(self, lat, lon):
+        """Vicinanza: 1 nello stesso punto, dimezzata ogni DISTANZA_DIMEZZAMENTO_KM"""
+        if lat is None or lon is None:
+            return np.full(len(self.ids), NEUTRO)
+        # Formula dell'emisenoverso (come geo.distanza_km) su tutte le aziende insieme
+        phi = math.radians(lat)
+        dphi = self.latitudini - phi
+        dlambda = self.longitudini - math.radians(lon)
+        a = np.sin(dphi / 2) ** 2 + math.cos(phi) * np.cos(self.latitudini) * np.sin(dlambda / 2) ** 2
+        distanze = 2 * RAGGIO_TERRA_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+        decadimento = math.log(2) / DISTANZA_DIMEZZAMENTO_KM
+        return np.where(self.con_coordinate, np.exp(-decadimento * distanze), NEUTRO)
+
+def migliori_indici(punteggi, n):
+    """Indici dei primi n punteggi in ordine decrescente (a parità, indice minore): argpartition senza ordinare tutto"""
+    if len(punteggi) > n:
+        candidati = np.argpartition(-punteggi, n - 1)[:n]
+    else:
+        candidati = np.arange(len(punteggi))
+    return candidati[np.lexsort((candidati, -punteggi[candidati]))]
+
+class MotoreMatching:
+    """Punteggi di compatibilità aziende-promotore, con i migliori risultati in cache per promotore"""
+
+    def __init__(self):
+        self._matrice = None
+        self._lock = threading.Lock()
+        self.cache = TTLCache(maxsize=5000, ttl=RACCOMANDAZIONI_CACHE_TTL)
+
+    def matrice(self):
+        with self._lock:
+            if self._matrice is None or self._matrice.scaduta():
+                self._matrice = MatriceAziende()
+            return self._matrice
+
+    def invalida_aziende(self):
+        """Le aziende sono cambiate: matrice e raccomandazioni vanno ricalcolate"""
+        with self._lock:
+            self._matrice = None
+        self.cache.clear()
+
+    def invalida_promotore(self, promotore_id):
+        """Il profilo del promotore è cambiato"""
+        self.cache.invalidate(promotore_id)
+
+    def _calcola(self, promotore):
+        matrice = self.matrice()
+        colonne = {
+            'industry': matrice.colonna_industry(promotore.industry),
+            'visualizzazioni': matrice.colonna_visualizzazioni(promotore.visualizzazioni_medie),
+            'distanza': matrice.colonna_distanza(promotore.latitudine, promotore.longitudine),
+            'accettazione': matrice.accettazione,
+            'perk': matrice.perk,
+        }
+        nomi = list(colonne)
+        pesi = np.array([PESI_MATCH[nome] for nome in nomi])
+
+        # Combinazione lineare delle colonne (prodotto pesi x matrice), poi selezione dei migliori
+        componenti = np.vstack([colonne[nome] for nome in nomi])
+        punteggi = pesi @ componenti
+        migliori = migliori_indici(punteggi, RACCOMANDAZIONI_MAX)
+
+        return [
+            (int(matrice.ids[i]), float(punteggi[i]), {nome: round(float(componenti[j, i]), 3) for j, nome in enumerate(nomi)})
+            for i in migliori
+        ]
+
+    def raccomandazioni(self, promotore, limite=20):
+        """[(azienda_id, punteggio, componenti)] delle aziende più compatibili con il promotore"""
+        risultati = self.cache.get(promotore.id)
+        if risultati is None:
+            risultati = self._calcola(promotore)
+            self.cache.set(promotore.id, risultati)
+        return risultati[:limite]
+
+motore_matching = MotoreMatching()
+
+class MatricePromotori:
+    """Caratteristiche di tutti i promotori per colonne, usate per la classifica di ciascuna azienda"""
+
+    def __init__(self):
+        self.creata = time.monotonic()
+
+        righe = db.session.query(
+            Promotore.id, Promotore.industry,
+            Promotore.instagram_link, Promotore.tiktok_link, Promotore.linkedin_link
+        ).order_by(Promotore.id).all()
+
+        mese, anno = LeaderboardEntry.get_current_month_year()
+        leaderboard = dict(db.session.query(LeaderboardEntry.promotore_id, LeaderboardEntry.punteggio_totale).filter_by(
+            mese=mese, anno=anno
+        ))
+        leaderboard_max = max((p or 0 for p in leaderboard.values()), default=0) or 1
+
+        decise = {
+            promotore_id: (accettate or 0, totale)
+            for promotore_id, accettate, totale in db.session.query(
+                Richiesta.promotore_id,
+                func.sum(case((Richiesta.stato == 'Accettata', 1), else_=0)),
+                func.count(Richiesta.id)
+            ).filter(Richiesta.stato.in_(['Accettata', 'Rifiutata'])).group_by(Richiesta.promotore_id)
+        }
+
+        self.ids = np.array([r.id for r in righe], dtype=np.int64)
+        # Industry come codici: l'affinità si calcola per valore distinto e si espande con un'indicizzazione
+        self.industry_distinte, self.codici_industry = np.unique(
+            np.array([r.industry or '' for r in righe], dtype=object), return_inverse=True
+        )
+        self.leaderboard = np.array([leaderboard.get(r.id) or 0 for r in righe], dtype=np.float64) / leaderboard_max
+        accettate = np.array([decise.get(r.id, (0, 0))[0] for r in righe], dtype=np.float64)
+        totali = np.array([decise.get(r.id, (0, 0))[1] for r in righe], dtype=np.float64)
+        self.accettazione = (accettate + 1) / (totali + 2)
+        self.social = np.array([
+            sum(1 for link in (r.instagram_link, r.tiktok_link, r.linkedin_link) if link) for r in righe
+        ], dtype=np.float64) / 3
+
+    def scaduta(self):
+        return time.monotonic() - self.creata > MATRICE_TTL
+
+    def classifica(self, tipo_attivita, nome_attivita):
+        """[(promotore_id, punteggio)] dei migliori CLASSIFICA_TOP_N promotori per un'azienda"""
+        tipo = ' '.join(tokenizza(tipo_attivita))
+        nome = ' '.join(tokenizza(nome_attivita))
+
+        # L'affinità dipende solo dall'industry: si calcola una volta per valore distinto
+        per_industry = np.array([affinita_industry(i, tipo, nome) for i in self.industry_distinte], dtype=np.float64)
+        pesi = PESI_CLASSIFICA_PROMOTORI
+        punteggi = (
+            pesi['industry'] * per_industry[self.codici_industry]
+            + pesi['leaderboard'] * self.leaderboard
+            + pesi['accettazione'] * self.accettazione
+            + pesi['social'] * self.social
+        )
+        migliori = migliori_indici(punteggi, CLASSIFICA_TOP_N)
+        return [(int(self.ids[i]), float(punteggi[i])) for i in migliori]
+
+def _blocca_classifiche(azienda_ids):
+    """
+    Advisory lock Postgres per azienda fino alla fine della transazione: due ricalcoli della stessa
+    classifica non eseguono insieme DELETE e INSERT (l'ordine fisso evita i deadlock).
+    Su SQLite le transazioni di scrittura sono già serializzate
+    """
+    if db.engine.dialect.name == 'postgresql':
+        for azienda_id in sorted(azienda_ids):
+            db.session.execute(
+                text('SELECT pg_advisory_xact_lock(:classe, :chiave)'),
+                {'classe': CLASSIFICA_LOCK_CLASSE, 'chiave': azienda_id}
+            )
+
+class ClassifichePromotori:
+    """
+    Classifiche dei promotori per azienda materializzate nella tabella promotore_consigliato:
+    ricalcolate tutte ogni notte e, su richiesta, solo per le aziende il cui profilo è cambiato
+    """
+
+    def __init__(self):
+        self._matrice = None
+        self._lock = threading.Lock()
+
+    def matrice(self, nuova=False):
+        with self._lock:
+            if nuova or self._matrice is None or self._matrice.scaduta():
+                self._matrice = MatricePromotori()
+            return self._matrice
+
+    def _salva(self, matrice, aziende, verifica_promotori=False, solo_da_aggiornare=False):
+        """
+        Sostituisce le classifiche delle aziende indicate ([(id, tipo_attivita, nome_attivita)]).
+        verifica_promotori scarta i promotori eliminati dopo il caricamento della matrice;
+        solo_da_aggiornare salta le aziende la cui classifica è stata ricalcolata nel frattempo
+        """
+        _blocca_classifiche([azienda_id for azienda_id, _, _ in aziende])
+        if solo_da_aggiornare:
+            aggiornate = {
+                azienda_id for (azienda_id,) in db.session.query(StatoClassificaPromotori.azienda_id).filter(
+                    StatoClassificaPromotori.azienda_id.in_([azienda_id for azienda_id, _, _ in aziende]),
+                    StatoClassificaPromotori.obsoleta.is_(False)
+                )
+            }
+            aziende = [azienda for azienda in aziende if azienda[0] not in aggiornate]
+            if not aziende:
+                db.session.commit()
+                return
+
+        ids = [azienda_id for azienda_id, _, _ in aziende]
+        classifiche = [(azienda_id, matrice.classifica(tipo, nome)) for azienda_id, tipo, nome in aziende]
+
+        if verifica_promotori:
+            candidati = {promotore_id for _, classifica in classifiche for promotore_id, _ in classifica}
+            esistenti = {i for (i,) in db.session.query(Promotore.id).filter(Promotore.id.in_(candidati))}
+            classifiche = [
+                (azienda_id, [(p, punteggio) for p, punteggio in classifica if p in esistenti])
+                for azienda_id, classifica in classifiche
+            ]
+
+        righe = [
+            {'azienda_id': azienda_id, 'posizione': posizione, 'promotore_id': promotore_id, 'punteggio': punteggio}
+            for azienda_id, classifica in classifiche
+            for posizione, (promotore_id, punteggio) in enumerate(classifica, 1)
+        ]
+        adesso = datetime.utcnow()
+
+        db.session.query(PromotoreConsigliato).filter(PromotoreConsigliato.azienda_id.in_(ids)).delete(synchronize_session=False)
+        db.session.query(StatoClassificaPromotori).filter(StatoClassificaPromotori.azienda_id.in_(ids)).delete(synchronize_session=False)
+        if righe:
+            db.session.execute(insert(PromotoreConsigliato), righe)
+        db.session.execute(insert(StatoClassificaPromotori), [
+            {'azienda_id': azienda_id, 'calcolata_at': adesso, 'obsoleta': False} for azienda_id in ids
+        ])
+        db.session.commit()
+
+    def aggiorna_tutte(self):
+        """Ricalcolo notturno di tutte le classifiche, a blocchi di CLASSIFICA_BLOCCO aziende per transazione"""
+        matrice = self.matrice(nuova=True)
+        aziende = db.session.query(Azienda.id, Azienda.tipo_attivita, Azienda.nome_attivita).order_by(Azienda.id).all()
+        for inizio in range(0, len(aziende), CLASSIFICA_BLOCCO):
+            self._salva(matrice, aziende[inizio:inizio + CLASSIFICA_BLOCCO])
+        logger.info(f"Classifiche promotori aggiornate per {len(aziende)} aziende")
+        return len(aziende)
+
+    def aggiorna_azienda(self, azienda_id):
+        """Ricalcola la classifica di un'azienda se manca o è obsoleta"""
+        azienda = db.session.get(Azienda, azienda_id)
+        if azienda is None:
+            return
+        # La matrice può avere qualche minuto: si verifica che i promotori esistano ancora
+        self._salva(
+            self.matrice(), [(azienda.id, azienda.tipo_attivita, azienda.nome_attivita)],
+            verifica_promotori=True, solo_da_aggiornare=True
+        )
+
+    def assicura_aggiornata(self, azienda):
+        """
+        Alla prima lettura la classifica viene calcolata subito (non c'è nulla da mostrare).
+        Se è obsoleta si continua a mostrare la precedente e il ricalcolo va al pool dei task
+        """
+        stato = db.session.get(StatoClassificaPromotori, azienda.id)
+        if stato is None:
+            self.aggiorna_azienda(azienda.id)
+        elif stato.obsoleta:
+            accoda('aggiorna_classifica_azienda', chiave=f'classifica_azienda:{azienda.id}', azienda_id=azienda.id)
+            db.session.commit()
+
+classifiche_promotori = ClassifichePromotori()
+
+@task('aggiorna_classifica_azienda')
+def aggiorna_classifica_azienda(azienda_id):
+    """Task del pool: ricalcolo della classifica di un'azienda il cui profilo è cambiato"""
+    classifiche_promotori.aggiorna_azienda(azienda_id)
+
+@task('aggiorna_classifiche_promotori', priorita=PRIORITA_BASSA)
+def aggiorna_classifiche_promotori():
+    """Task del pool per il ricalcolo notturno delle classifiche"""
+    classifiche_promotori.aggiorna_tutte()
@@ -0,0 +1,251 @@
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import delete, event, select, text
+from sqlalchemy.orm import Session
+from src.models.user import db
+from src.models.outbox import EventoOutbox
+
+logger = logging.getLogger(__name__)
+
+# Eventi letti per ciclo del dispatcher
+OUTBOX_BATCH = 100
+
+# Tentativi di consegna prima di considerare un evento perso (resta registrato con l'errore)
+OUTBOX_MAX_TENTATIVI = 10
+BACKOFF_BASE_SECONDI = 2
+BACKOFF_MAX_SECONDI = 600
+
+# Attesa massima tra due cicli quando non arrivano notifiche di commit
+INTERVALLO_POLLING_SECONDI = 2.0
+
+# Un id mancante nella sequenza oltre questo tempo è di una transazione annullata, non in ritardo
+ATTESA_BUCHI_SECONDI = 30
+
+# Gli eventi consegnati vengono conservati per un po' (diagnostica e processi che ripartono)
+CONSERVAZIONE_EVENTI = timedelta(days=7)
+INTERVALLO_PULIZIA_SECONDI = 3600
+
+# Chiave dell'advisory lock Postgres: un solo dispatcher alla volta consegna gli eventi globali
+OUTBOX_LOCK_ID = 48_001
+
+Evento = namedtuple('Evento', ['id', 'aggregato', 'aggregato_id', 'tipo', 'dati'])
+
+_globali = {}
+_locali = {}
+
+def sottoscrivi(aggregato, locale=False):
+    """
+    Registra la funzione decorata per gli eventi dell'aggregato; riceve un Evento.
+    I sottoscrittori globali (notifiche) ricevono ogni evento una volta, con ritentativi.
+    Quelli locali (cache e indici in memoria) lo ricevono in ogni processo, subito dopo il commit
+    nel processo che lo ha scritto e con il polling dell'outbox negli altri: non possono usare il database
+    """
+    def decoratore(funzione):
+        (_locali if locale else _globali).setdefault(aggregato, []).append(funzione)
+        return funzione
+    return decoratore
+
+def registra_evento(aggregato, aggregato_id, tipo, **dati):
+    """Aggiunge l'evento alla transazione corrente: esiste solo se il chiamante fa commit"""
+    evento = EventoOutbox(aggregato=aggregato, aggregato_id=aggregato_id, tipo=tipo, payload=json.dumps(dati))
+    db.session.add(evento)
+    db.session.info.setdefault('outbox_in_attesa', []).append(evento)
+    return evento
+
+def _da_riga(riga):
+    return Evento(riga.id, riga.aggregato, riga.aggregato_id, riga.tipo, riga.dati)
+
+@event.listens_for(Session, 'after_flush')
+def _eventi_scritti(session, flush_context):
+    # Dopo il flush gli id sono noti: si conserva una copia che non richiede il database dopo il commit
+    in_attesa = session.info.pop('outbox_in_attesa', None)
+    if in_attesa:
+        session.info.setdefault('outbox_scritti', []).extend(_da_riga(riga) for riga in in_attesa)
+
+@event.listens_for(Session, 'after_commit')
+def _eventi_confermati(session):
+    scritti = session.info.pop('outbox_scritti', None)
+    if scritti:
+        dispatcher_outbox.consegna_locale(scritti)
+        dispatcher_outbox.sveglia()
+
+@event.listens_for(Session, 'after_rollback')
+def _eventi_annullati(session):
+    session.info.pop('outbox_in_attesa', None)
+    session.info.pop('outbox_scritti', None)
+
+def _chiama(sottoscrittori, evento):
+    for funzione in sottoscrittori.get(evento.aggregato, []):
+        funzione(evento)
+
+def _backoff(tentativi):
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDI * 2 ** (tentativi - 1), BACKOFF_MAX_SECONDI))
+
+def consegna_globale():
+    """
+    Consegna un blocco di eventi ai sottoscrittori globali in ordine di id.
+    Se un evento fallisce, i successivi dello stesso aggregato attendono il suo ritentativo
+    (ordine per aggregato); gli altri aggregati proseguono. Restituisce il numero di eventi consegnati
+    """
+    if db.engine.dialect.name == 'postgresql':
+        # Con più processi un solo dispatcher consegna: l'ordine per aggregato resta garantito
+        if not db.session.execute(text('SELECT pg_try_advisory_xact_lock(:k)'), {'k': OUTBOX_LOCK_ID}).scalar():
+            db.session.rollback()
+            return 0
+
+    adesso = datetime.utcnow()
+    righe = db.session.scalars(
+        select(EventoOutbox).where(EventoOutbox.consegnato_at.is_(None)).order_by(EventoOutbox.id).limit(OUTBOX_BATCH)
+    ).all()
+
+    bloccati = set()
+    consegnati = 0
+    for riga in righe:
+        chiave = (riga.aggregato, riga.aggregato_id)
+        if chiave in bloccati:
+            continue
+        if riga.prossimo_tentativo and riga.prossimo_tentativo > adesso:
+            bloccati.add(chiave)
+            continue
+        try:
+            _chiama(_globali, _da_riga(riga))
+        except Exception as e:
+            riga.tentativi += 1
+            riga.errore = str(e)
+            if riga.tentativi >= OUTBOX_MAX_TENTATIVI:
+                logger.error(f"Evento {riga.id} ({riga.tipo}) non consegnato dopo {riga.tentativi} tentativi: {e}")
+                riga.consegnato_at = adesso
+            else:
+                logger.warning(f"Consegna dell'evento {riga.id} ({riga.tipo}) fallita: {e}")
+                riga.prossimo_tentativo = adesso + _backoff(riga.tentativi)
+                bloccati.add(chiave)
+            continue
+        riga.consegnato_at = adesso
+        consegnati += 1
+
+    db.session.commit()
+    return consegnati
+
+def pulisci_consegnati():
+    """Elimina gli eventi consegnati da più di CONSERVAZIONE_EVENTI"""
+    risultato = db.session.execute(
+        delete(EventoOutbox).where(EventoOutbox.consegnato_at < datetime.utcnow() - CONSERVAZIONE_EVENTI)
+    )
+    db.session.commit()
+    return risultato.rowcount
+
+class DispatcherOutbox:
+    """
+    Thread che consegna gli eventi dell'outbox. In ogni processo segue anche la sequenza degli id
+    per applicare i sottoscrittori locali agli eventi scritti dagli altri processi
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sveglia = threading.Event()
+        self._fermo = threading.Event()
+        self._thread = None
+        self._app = None
+        # Sottoscrittori locali: tutti gli id <= _ultimo_continuo sono stati applicati;
+        # oltre, _visti contiene quelli applicati e _buchi l'istante in cui un id mancante è stato notato
+        self._ultimo_continuo = None
+        self._visti = set()
+        self._buchi = {}
+        self._ultima_pulizia = 0.0
+
+    def avvia(self, app):
+        """Avvia il dispatcher (una sola volta): gli eventi locali precedenti all'avvio sono già nello stato iniziale"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            with app.app_context():
+                self._inizializza_sequenza()
+            self._fermo.clear()
+            self._thread = threading.Thread(target=self._ciclo, name='dispatcher-outbox', daemon=True)
+            self._thread.start()
+
+    def ferma(self):
+        self._fermo.set()
+        self._sveglia.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def sveglia(self):
+        self._sveglia.set()
+
+    def elabora(self, app=None):
+        """Esegue un ciclo completo nel thread corrente (script di manutenzione e test)"""
+        with (app or self._app).app_context():
+            if self._ultimo_continuo is None:
+                self._inizializza_sequenza()
+            self._segui_sequenza()
+            while consegna_globale():
+                pass
+
+    def consegna_locale(self, eventi):
+        """Applica i sottoscrittori locali a eventi appena confermati, una sola volta per processo"""
+        with self._lock:
+            if self._ultimo_continuo is None:
+                # Dispatcher non avviato (script): nessuna sequenza da seguire
+                nuovi = list(eventi)
+            else:
+                nuovi = [e for e in eventi if e.id > self._ultimo_continuo and e.id not in self._visti]
+                self._visti.update(e.id for e in nuovi)
+        for evento in nuovi:
+            try:
+                _chiama(_locali, evento)
+            except Exception as e:
+                logger.error(f"Errore nel sottoscrittore locale dell'evento {evento.id} ({evento.tipo}): {e}")
+
+    def _inizializza_sequenza(self):
+        ultimo = db.session.scalar(select(db.func.max(EventoOutbox.id)))
+        db.session.rollback()
+        with self._lock:
+            self._ultimo_continuo = ultimo or 0
+
+    def _segui_sequenza(self):
+        """Applica i sottoscrittori locali agli eventi scritti da altri processi"""
+        righe = db.session.scalars(
+            select(EventoOutbox).where(EventoOutbox.id > self._ultimo_continuo).order_by(EventoOutbox.id).limit(OUTBOX_BATCH)
+        ).all()
+        eventi = [_da_riga(riga) for riga in righe]
+        db.session.rollback()
+        self.consegna_locale(eventi)
+
+        # Avanza finché la sequenza è continua; un buco più vecchio di ATTESA_BUCHI_SECONDI viene saltato
+        adesso = time.monotonic()
+        with self._lock:
+            while self._visti:
+                successivo = self._ultimo_continuo + 1
+                if successivo in self._visti:
+                    self._visti.discard(successivo)
+                    self._buchi.pop(successivo, None)
+                elif adesso - self._buchi.setdefault(successivo, adesso) > ATTESA_BUCHI_SECONDI:
+                    self._buchi.pop(successivo)
+                else:
+                    break
+                self._ultimo_continuo = successivo
+
+    def _ciclo(self):
+        while not self._fermo.is_set():
+            try:
+                with self._app.app_context():
+                    self._segui_sequenza()
+                    consegnati = consegna_globale()
+                    if time.monotonic() - self._ultima_pulizia > INTERVALLO_PULIZIA_SECONDI:
+                        self._ultima_pulizia = time.monotonic()
+                        pulisci_consegnati()
+                    if consegnati == OUTBOX_BATCH:
+                        continue
+            except Exception as e:
+                logger.error(f"Errore nel dispatcher dell'outbox: {e}")
+            self._sveglia.wait(INTERVALLO_POLLING_SECONDI)
+            self._sveglia.clear()
+
+dispatcher_outbox = DispatcherOutbox()
@@ -0,0 +1,102 @@
+import base64
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+# Dimensione delle pagine restituite dagli endpoint paginati
+PAGE_SIZE_DEFAULT = 20
+PAGE_SIZE_MAX = 100
+
+class CursoreNonValido(ValueError):
+    """Il cursore ricevuto dal client non è decodificabile"""
+    pass
+
+def page_size(valore, default=PAGE_SIZE_DEFAULT, massimo=PAGE_SIZE_MAX):
+    """Normalizza il parametro 'limit' della richiesta tra 1 e il massimo consentito"""
+    if valore is None:
+        return default
+    return max(1, min(valore, massimo))
+
+def id_ancora(valore, nome):
+    """Id di riferimento passato come parametro (since_id, before_id): un valore non intero è un cursore non valido"""
+    if valore is None:
+        return None
+    try:
+        row_id = int(valore)
+    except ValueError as e:
+        raise CursoreNonValido(f'{nome} non valido') from e
+    if row_id <= 0:
+        raise CursoreNonValido(f'{nome} non valido')
+    return row_id
+
+def encode_cursor(valore, row_id):
+    """Codifica la chiave (valore di ordinamento, id) dell'ultima riga in un cursore opaco"""
+    if isinstance(valore, datetime):
+        valore = valore.isoformat()
+    grezzo = f'{valore}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(grezzo).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decodifica un cursore generato da encode_cursor in (datetime, id)"""
+    try:
+        grezzo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        valore, row_id = grezzo.rsplit('|', 1)
+        return datetime.fromisoformat(valore), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise CursoreNonValido('Cursore non valido') from e
+
+def keyset_filter(colonna, colonna_id, valore, row_id, desc=True):
+    """Condizione che seleziona le righe successive alla chiave (valore, row_id) nell'ordinamento"""
+    if desc:
+        return or_(colonna < valore, and_(colonna == valore, colonna_id < row_id))
+    return or_(colonna > valore, and_(colonna == valore, colonna_id > row_id))
+
+def keyset_page(query, colonna, colonna_id, cursor=None, limit=PAGE_SIZE_DEFAULT, desc=True):
+    """
+    Restituisce una pagina della query ordinata per (colonna, colonna_id) e il cursore della successiva.
+    Con un indice che termina con (colonna, id) ogni pagina è una scansione di un intervallo dell'indice
+    """
+    if cursor:
+        valore, row_id = decode_cursor(cursor)
+        query = query.filter(keyset_filter(colonna, colonna_id, valore, row_id, desc))
+
+    if desc:
+        query = query.order_by(colonna.desc(), colonna_id.desc())
+    else:
+        query = query.order_by(colonna.asc(), colonna_id.asc())
+
+    righe = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(righe) > limit:
+        righe = righe[:limit]
+        ultima = righe[-1]
+        next_cursor = encode_cursor(getattr(ultima, colonna.key), getattr(ultima, colonna_id.key))
+
+    return righe, next_cursor
+
+def encode_id_cursor(row_id):
+    """Cursore opaco per le liste ordinate solo per id"""
+    return base64.urlsafe_b64encode(str(row_id).encode()).decode().rstrip('=')
+
+def decode_id_cursor(cursor):
+    """Decodifica un cursore generato da encode_id_cursor"""
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise CursoreNonValido('Cursore non valido') from e
+
+def id_page(query, colonna_id, cursor=None, limit=PAGE_SIZE_DEFAULT, desc=True):
+    """Come keyset_page, per le tabelle senza una colonna temporale: ordina e pagina solo per id"""
+    if cursor:
+        row_id = decode_id_cursor(cursor)
+        query = query.filter(colonna_id < row_id if desc else colonna_id > row_id)
+
+    query = query.order_by(colonna_id.desc() if desc else colonna_id.asc())
+    righe = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(righe) > limit:
+        righe = righe[:limit]
+        next_cursor = encode_id_cursor(getattr(righe[-1], colonna_id.key))
+
+    return righe, next_cursor
@@ -0,0 +1,85 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Configurazione del pool di hashing (sovrascrivibile da variabili d'ambiente)
+HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', HASH_WORKERS * 4))
+HASH_TIMEOUT = 15  # secondi
+
+# Metodo e parametri correnti: gli hash salvati con parametri diversi vengono aggiornati al login
+HASH_METHOD = 'scrypt:32768:8:1'
+
+class HasherSaturo(Exception):
+    """Il pool di hashing ha raggiunto il limite di lavori in coda"""
+    pass
+
+class PasswordHasher:
+    """
+    Esegue hashing e verifica delle password in un pool di processi limitato,
+    così i login non occupano i thread che servono le altre richieste.
+    Oltre max_pending lavori in corso le nuove richieste vengono rifiutate subito.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Il pool viene creato al primo utilizzo, quindi dopo l'eventuale fork del server
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherSaturo('Troppe richieste di autenticazione in corso, riprova tra poco')
+
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception as e:
+            self._slots.release()
+            if isinstance(e, BrokenProcessPool):
+                self._reset_executor()
+            raise
+
+        # Lo slot si libera quando il lavoro termina davvero, anche se il chiamante va in timeout
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool:
+            # Un processo del pool è terminato in modo anomalo: il prossimo lavoro ricrea il pool
+            self._reset_executor()
+            raise
+
+    def hash(self, password):
+        """Calcola l'hash della password con i parametri correnti"""
+        return self._run(generate_password_hash, password, HASH_METHOD)
+
+    def verify(self, password_hash, password):
+        """Verifica la password rispetto all'hash salvato"""
+        return self._run(check_password_hash, password_hash, password)
+
+    @staticmethod
+    def needs_rehash(password_hash):
+        """True se l'hash è stato calcolato con un metodo o parametri diversi da quelli correnti"""
+        return password_hash.split('$', 1)[0] != HASH_METHOD
+
+    def shutdown(self):
+        """Ferma il pool di processi"""
+        self._reset_executor()
+
+# Istanza globale del pool
+password_hasher = PasswordHasher()
@@ -0,0 +1,153 @@
+import threading
+from sqlalchemy import func, literal, literal_column, or_, union_all
+from src.models.user import db, Richiesta
+from src.models.messaggio import Messaggio
+from src.services.indice_testuale import IndiceTestuale, estratto
+
+# Configurazione full-text di Postgres: deve coincidere con quella degli indici GIN nei modelli
+FTS_CONFIG = literal_column("'italian'")
+
+def usa_postgres():
+    """True se il database supporta la ricerca full-text di Postgres"""
+    return db.engine.dialect.name == 'postgresql'
+
+def tsvector(colonna):
+    return func.to_tsvector(FTS_CONFIG, colonna)
+
+class IndiceConversazioni:
+    """
+    Indice locale dei testi delle conversazioni, usato quando il database non è Postgres.
+    Viene costruito alla prima ricerca e aggiornato a ogni nuovo messaggio o richiesta
+    """
+
+    def __init__(self):
+        self.indice = IndiceTestuale()
+        self.pronto = False
+        self._lock = threading.Lock()
+
+    def _costruisci(self):
+        with self._lock:
+            if self.pronto:
+                return
+            for richiesta in db.session.query(
+                Richiesta.id, Richiesta.promotore_id, Richiesta.azienda_id, Richiesta.messaggio_iniziale
+            ):
+                self._aggiungi_richiesta(*richiesta)
+            for messaggio in db.session.query(
+                Messaggio.id, Messaggio.contenuto, Richiesta.id, Richiesta.promotore_id, Richiesta.azienda_id
+            ).join(Richiesta, Richiesta.id == Messaggio.richiesta_id):
+                self._aggiungi_messaggio(*messaggio)
+            self.pronto = True
+
+    def _aggiungi_richiesta(self, richiesta_id, promotore_id, azienda_id, testo):
+        self.indice.aggiungi(
+            ('richiesta', richiesta_id), testo,
+            richiesta_id=richiesta_id, partecipanti=(promotore_id, azienda_id)
+        )
+
+    def _aggiungi_messaggio(self, messaggio_id, testo, richiesta_id, promotore_id, azienda_id):
+        self.indice.aggiungi(
+            ('messaggio', messaggio_id), testo,
+            richiesta_id=richiesta_id, partecipanti=(promotore_id, azienda_id)
+        )
+
+    def aggiungi_richiesta(self, richiesta_id, promotore_id, azienda_id, testo):
+        """Indicizza una nuova richiesta (solo se l'indice è già stato costruito)"""
+        if self.pronto:
+            self._aggiungi_richiesta(richiesta_id, promotore_id, azienda_id, testo)
+
+    def aggiungi_messaggio(self, messaggio_id, testo, richiesta_id, promotore_id, azienda_id):
+        """Indicizza un nuovo messaggio (solo se l'indice è già stato costruito)"""
+        if self.pronto:
+            self._aggiungi_messaggio(messaggio_id, testo, richiesta_id, promotore_id, azienda_id)
+
+    def cerca(self, user_id, testo):
+        self._costruisci()
+        return self.indice.cerca(testo, filtro=lambda m: user_id in m['partecipanti'])
+
+indice_conversazioni = IndiceConversazioni()
+
+def _cerca_postgres(user_id, testo, page, per_page):
+    query = func.websearch_to_tsquery(FTS_CONFIG, testo)
+    partecipante = or_(Richiesta.promotore_id == user_id, Richiesta.azienda_id == user_id)
+
+    messaggi = db.select(
+        literal('messaggio').label('tipo'),
+        Messaggio.id.label('id'),
+        Messaggio.richiesta_id.label('richiesta_id'),
+        Messaggio.contenuto.label('testo'),
+        Messaggio.data_creazione.label('data_creazione'),
+        func.ts_rank(tsvector(Messaggio.contenuto), query).label('rank')
+    ).join(Richiesta, Richiesta.id == Messaggio.richiesta_id).where(
+        partecipante, tsvector(Messaggio.contenuto).op('@@')(query)
+    )
+
+    richieste = db.select(
+        literal('richiesta').label('tipo'),
+        Richiesta.id.label('id'),
+        Richiesta.id.label('richiesta_id'),
+        Richiesta.messaggio_iniziale.label('testo'),
+        Richiesta.data_creazione.label('data_creazione'),
+        func.ts_rank(tsvector(Richiesta.messaggio_iniziale), query).label('rank')
+    ).where(
+        partecipante, tsvector(Richiesta.messaggio_iniziale).op('@@')(query)
+    )
+
+    risultati = union_all(messaggi, richieste).subquery()
+    totale = db.session.execute(db.select(func.count()).select_from(risultati)).scalar()
+    righe = db.session.execute(
+        db.select(risultati).order_by(
+            risultati.c.rank.desc(), risultati.c.data_creazione.desc()
+        ).limit(per_page).offset((page - 1) * per_page)
+    ).all()
+
+    return [
+        {
+            'tipo': r.tipo,
+            'id': r.id,
+            'richiesta_id': r.richiesta_id,
+            'estratto': estratto(r.testo, testo),
+            'data_creazione': r.data_creazione.isoformat() if r.data_creazione else None,
+            'rank': round(float(r.rank), 4)
+        }
+        for r in righe
+    ], totale
+
+def _cerca_locale(user_id, testo, page, per_page):
+    trovati = indice_conversazioni.cerca(user_id, testo)
+    pagina = trovati[(page - 1) * per_page:page * per_page]
+
+    # Carica solo i testi della pagina richiesta
+    id_messaggi = [doc_id[1] for doc_id, _ in pagina if doc_id[0] == 'messaggio']
+    id_richieste = [doc_id[1] for doc_id, _ in pagina if doc_id[0] == 'richiesta']
+    righe = {}
+    if id_messaggi:
+        for m in Messaggio.query.filter(Messaggio.id.in_(id_messaggi)):
+            righe[('messaggio', m.id)] = (m.richiesta_id, m.contenuto, m.data_creazione)
+    if id_richieste:
+        for r in Richiesta.query.filter(Richiesta.id.in_(id_richieste)):
+            righe[('richiesta', r.id)] = (r.id, r.messaggio_iniziale, r.data_creazione)
+
+    risultati = []
+    for doc_id, punteggio in pagina:
+        if doc_id not in righe:
+            continue  # Eliminato dopo l'indicizzazione
+        richiesta_id, contenuto, data_creazione = righe[doc_id]
+        risultati.append({
+            'tipo': doc_id[0],
+            'id': doc_id[1],
+            'richiesta_id': richiesta_id,
+            'estratto': estratto(contenuto, testo),
+            'data_creazione': data_creazione.isoformat() if data_creazione else None,
+            'rank': round(punteggio, 4)
+        })
+    return risultati, len(trovati)
+
+def cerca_conversazioni(user_id, testo, page=1, per_page=20):
+    """
+    Cerca nei messaggi e nei messaggi iniziali delle richieste a cui partecipa l'utente.
+    Restituisce (risultati della pagina ordinati per rilevanza, totale dei risultati)
+    """
+    if usa_postgres():
+        return _cerca_postgres(user_id, testo, page, per_page)
+    return _cerca_locale(user_id, testo, page, per_page)
@@ -0,0 +1,305 @@
+import re
+import threading
+from collections import Counter
+from sqlalchemy import func, literal
+from src.models.user import db, Azienda
+from src.services.indice_testuale import normalizza
+from src.services.ricerca import usa_postgres
+from src.services.facette import conta_facette, formatta_facetta
+from src.services.autocompletamento import indice_autocompletamento
+from src.services.matching import motore_matching
+from src.services.geo import celle_copertura, distanza_km, intervallo_prefisso
+from src.services.outbox import registra_evento
+
+# Campi ricercabili e relativo peso nella rilevanza
+PESI_CAMPI = {
+    'nome_attivita': 1.0,
+    'tipo_attivita': 0.8,
+    'localita': 0.6,
+}
+
+# Campi copiati negli indici in memoria (e nel payload degli eventi che li aggiornano)
+CAMPI_INDICIZZATI = ('nome_attivita', 'tipo_attivita', 'localita', 'min_visualizzazioni_richieste')
+
+# Campi per cui la ricerca restituisce i conteggi dei valori
+CAMPI_FACETTE = ('tipo_attivita', 'localita')
+
+# Ricerca delle aziende più vicine senza raggio: si parte da questo raggio e lo si allarga
+# finché non ci sono abbastanza risultati (oltre RAGGIO_MAX_KM si restituisce quanto trovato)
+RAGGIO_INIZIALE_KM = 10
+RAGGIO_MAX_KM = 2000
+
+# Somiglianza minima con almeno un campo perché un'azienda compaia tra i risultati di una ricerca libera.
+# Coincide con pg_trgm.word_similarity_threshold, usato dall'operatore <% su Postgres
+SOGLIA_SOMIGLIANZA = 0.6
+
+_PAROLA = re.compile(r'\w+', re.UNICODE)
+
+def trigrammi(testo):
+    """Trigrammi delle parole del testo, calcolati come pg_trgm (parole con due spazi prima e uno dopo)"""
+    risultato = set()
+    for parola in _PAROLA.findall(normalizza(testo)):
+        parola = f'  {parola} '
+        for i in range(len(parola) - 2):
+            risultato.add(parola[i:i + 3])
+    return risultato
+
+def somiglianza_parola(trigrammi_query, trigrammi_testo):
+    """Frazione dei trigrammi della query presenti nel testo (analoga a word_similarity di pg_trgm)"""
+    if not trigrammi_query:
+        return 0.0
+    return len(trigrammi_query & trigrammi_testo) / len(trigrammi_query)
+
+class FiltriAziende:
+    """Filtri opzionali della ricerca aziende"""
+
+    def __init__(self, q=None, tipo_attivita=None, localita=None, nome_attivita=None, min_visualizzazioni=None):
+        self.q = (q or '').strip() or None
+        self.tipo_attivita = tipo_attivita
+        self.localita = localita
+        self.nome_attivita = nome_attivita
+        self.min_visualizzazioni = min_visualizzazioni
+
+    def senza(self, campo):
+        """Copia dei filtri senza quello sul campo indicato (per i conteggi delle facette)"""
+        filtri = FiltriAziende(self.q, self.tipo_attivita, self.localita, self.nome_attivita, self.min_visualizzazioni)
+        setattr(filtri, campo, None)
+        return filtri
+
+    def applica(self, query):
+        """Applica i filtri a una query SQLAlchemy (con pg_trgm gli ILIKE usano gli indici GIN)"""
+        if self.tipo_attivita:
+            query = query.filter(Azienda.tipo_attivita.ilike(f"%{self.tipo_attivita}%"))
+        if self.localita:
+            query = query.filter(Azienda.localita.ilike(f"%{self.localita}%"))
+        if self.min_visualizzazioni is not None:
+            query = query.filter(Azienda.min_visualizzazioni_richieste <= self.min_visualizzazioni)
+        if self.nome_attivita:
+            query = query.filter(Azienda.nome_attivita.ilike(f"%{self.nome_attivita}%"))
+        return query
+
+    def ammette(self, campi):
+        """Stessi filtri di applica(), valutati sui campi in memoria"""
+        for nome in ('tipo_attivita', 'localita', 'nome_attivita'):
+            valore = getattr(self, nome)
+            if valore and normalizza(valore) not in normalizza(campi[nome]):
+                return False
+        if self.min_visualizzazioni is not None:
+            minimo = campi['min_visualizzazioni_richieste']
+            if minimo is None or minimo > self.min_visualizzazioni:
+                return False
+        return True
+
+class IndiceAziende:
+    """
+    Indice a trigrammi delle aziende in memoria, alternativa locale a pg_trgm.
+    Costruito alla prima ricerca e aggiornato alla registrazione, alla modifica e all'eliminazione
+    """
+
+    def __init__(self):
+        self._postings = {}  # trigramma -> set di azienda_id
+        self._documenti = {}  # azienda_id -> (campi, {campo: trigrammi})
+        self.pronto = False
+        self._lock = threading.RLock()
+
+    def _costruisci(self):
+        with self._lock:
+            if self.pronto:
+                return
+            for azienda in Azienda.query.all():
+                self._aggiungi(azienda.id, campi_indicizzati(azienda))
+            self.pronto = True
+
+    def _aggiungi(self, azienda_id, campi):
+        self._rimuovi(azienda_id)
+        campi = {campo: campi[campo] for campo in CAMPI_INDICIZZATI}
+        trigrammi_campi = {campo: trigrammi(campi[campo]) for campo in PESI_CAMPI}
+        for trg in set().union(*trigrammi_campi.values()):
+            self._postings.setdefault(trg, set()).add(azienda_id)
+        self._documenti[azienda_id] = (campi, trigrammi_campi)
+
+    def _rimuovi(self, azienda_id):
+        documento = self._documenti.pop(azienda_id, None)
+        if not documento:
+            return
+        for trg in set().union(*documento[1].values()):
+            ids = self._postings.get(trg)
+            if ids is not None:
+                ids.discard(azienda_id)
+                if not ids:
+                    del self._postings[trg]
+
+    def aggiorna(self, azienda_id, campi):
+        """Reindicizza un'azienda dopo registrazione o modifica del profilo"""
+        if self.pronto:
+            with self._lock:
+                self._aggiungi(azienda_id, campi)
+
+    def rimuovi(self, azienda_id):
+        if self.pronto:
+            with self._lock:
+                self._rimuovi(azienda_id)
+
+    def facetta(self, filtri, campo):
+        """Conteggi dei valori di un campo tra le aziende che soddisfano i filtri"""
+        trovati = self.cerca(filtri)
+        with self._lock:
+            return Counter(
+                self._documenti[i][0][campo] for i, _ in trovati if i in self._documenti
+            )
+
+    def cerca(self, filtri):
+        """Restituisce [(azienda_id, rilevanza)] ordinati per rilevanza (o per id se non c'è testo libero)"""
+        self._costruisci()
+        with self._lock:
+            if not filtri.q:
+                ids = sorted(self._documenti, reverse=True)
+                return [(i, None) for i in ids if filtri.ammette(self._documenti[i][0])]
+
+            trigrammi_query = trigrammi(filtri.q)
+            candidati = set()
+            for trg in trigrammi_query:
+                candidati |= self._postings.get(trg, set())
+
+            risultati = []
+            for azienda_id in candidati:
+                campi, trigrammi_campi = self._documenti[azienda_id]
+                if not filtri.ammette(campi):
+                    continue
+                somiglianze = {
+                    campo: somiglianza_parola(trigrammi_query, trigrammi_campi[campo])
+                    for campo in PESI_CAMPI
+                }
+                if max(somiglianze.values()) >= SOGLIA_SOMIGLIANZA:
+                    rilevanza = max(somiglianze[campo] * peso for campo, peso in PESI_CAMPI.items())
+                    risultati.append((azienda_id, rilevanza))
+
+        risultati.sort(key=lambda r: (-r[1], -r[0]))
+        return risultati
+
+indice_aziende = IndiceAziende()
+
+def campi_indicizzati(azienda):
+    return {campo: getattr(azienda, campo) for campo in CAMPI_INDICIZZATI}
+
+def registra_azienda_aggiornata(azienda):
+    """
+    Scrive nell'outbox la registrazione o la modifica dell'azienda, nella transazione corrente:
+    dopo il commit ogni processo aggiorna i propri indici con i campi del payload
+    """
+    return registra_evento('azienda', azienda.id, 'azienda_aggiornata', **campi_indicizzati(azienda))
+
+def registra_azienda_eliminata(azienda_id):
+    """Scrive nell'outbox l'eliminazione dell'azienda, nella transazione corrente"""
+    return registra_evento('azienda', azienda_id, 'azienda_eliminata')
+
+def azienda_aggiornata(azienda_id, campi):
+    """Aggiorna gli indici in memoria dopo la registrazione o la modifica di un'azienda (sottoscrittore locale)"""
+    indice_aziende.aggiorna(azienda_id, campi)
+    indice_autocompletamento.aggiorna(azienda_id, campi)
+    motore_matching.invalida_aziende()
+
+def azienda_eliminata(azienda_id):
+    """Toglie un'azienda eliminata dagli indici in memoria (sottoscrittore locale)"""
+    indice_aziende.rimuovi(azienda_id)
+    indice_autocompletamento.rimuovi(azienda_id)
+    motore_matching.invalida_aziende()
+
+def _condizione_testo(q):
+    # L'operatore <% (word_similarity oltre la soglia) è supportato dagli indici GIN gin_trgm_ops
+    return db.or_(*[literal(q).op('<%')(getattr(Azienda, campo)) for campo in PESI_CAMPI])
+
+def _cerca_postgres(filtri, page, per_page):
+    query = filtri.applica(db.session.query(Azienda))
+
+    if filtri.q:
+        rilevanza = func.greatest(*[
+            func.word_similarity(filtri.q, getattr(Azienda, campo)) * peso
+            for campo, peso in PESI_CAMPI.items()
+        ])
+        query = query.add_columns(rilevanza.label('rilevanza')).filter(
+            _condizione_testo(filtri.q)
+        ).order_by(rilevanza.desc(), Azienda.id.desc())
+    else:
+        query = query.add_columns(literal(None).label('rilevanza')).order_by(Azienda.id.desc())
+
+    righe = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    return [(azienda, r) for azienda, r in righe[:per_page]], len(righe) > per_page
+
+def _cerca_locale(filtri, page, per_page):
+    trovati = indice_aziende.cerca(filtri)
+    pagina = trovati[(page - 1) * per_page:page * per_page]
+
+    aziende = {a.id: a for a in Azienda.query.filter(Azienda.id.in_([i for i, _ in pagina]))} if pagina else {}
+    risultati = [(aziende[i], r) for i, r in pagina if i in aziende]
+    return risultati, len(trovati) > page * per_page
+
+def cerca_aziende(filtri, page=1, per_page=20):
+    """
+    Ricerca aziende con filtri e testo libero ordinata per rilevanza.
+    Restituisce ([(azienda, rilevanza)] della pagina, esiste una pagina successiva)
+    """
+    if usa_postgres():
+        return _cerca_postgres(filtri, page, per_page)
+    return _cerca_locale(filtri, page, per_page)
+
+def facette_aziende(filtri):
+    """
+    Conteggi per tipo_attivita e localita delle aziende trovate.
+    Ogni facetta ignora il proprio filtro, così i conteggi mostrano cosa si otterrebbe cambiandolo
+    """
+    if not usa_postgres():
+        return {campo: formatta_facetta(indice_aziende.facetta(filtri.senza(campo), campo)) for campo in CAMPI_FACETTE}
+
+    rami = []
+    for campo in CAMPI_FACETTE:
+        altri = filtri.senza(campo)
+        colonna = getattr(Azienda, campo)
+        select = altri.applica(
+            db.select(colonna.label('valore'), func.count().label('conteggio')).group_by(colonna)
+        )
+        if altri.q:
+            select = select.filter(_condizione_testo(altri.q))
+        rami.append((campo, select))
+    return conta_facette(rami)
+
+def _aziende_nel_raggio(lat, lon, raggio_km, filtri):
+    """[(distanza, azienda_id)] delle aziende entro il raggio, lette solo dalle celle geohash che lo coprono"""
+    celle = []
+    for prefisso in celle_copertura(lat, lon, raggio_km):
+        inizio, fine = intervallo_prefisso(prefisso)
+        celle.append(db.and_(Azienda.geohash >= inizio, Azienda.geohash < fine) if fine else Azienda.geohash >= inizio)
+
+    query = filtri.applica(db.session.query(Azienda.id, Azienda.latitudine, Azienda.longitudine)).filter(db.or_(*celle))
+
+    risultati = []
+    for azienda_id, lat_azienda, lon_azienda in query:
+        distanza = distanza_km(lat, lon, lat_azienda, lon_azienda)
+        if distanza <= raggio_km:
+            risultati.append((distanza, azienda_id))
+    risultati.sort()
+    return risultati
+
+def cerca_vicine(lat, lon, filtri, raggio_km=None, page=1, per_page=20):
+    """
+    Aziende ordinate per distanza dal punto (lat, lon), entro raggio_km se indicato.
+    Senza raggio restituisce le più vicine allargando la ricerca finché la pagina non è completa.
+    Restituisce ([(azienda, distanza_km)] della pagina, esiste una pagina successiva)
+    """
+    necessari = page * per_page + 1
+
+    if raggio_km is not None:
+        trovate = _aziende_nel_raggio(lat, lon, raggio_km, filtri)
+    else:
+        # Le aziende entro il raggio sono esattamente le più vicine: basta che siano abbastanza
+        raggio = RAGGIO_INIZIALE_KM
+        while True:
+            trovate = _aziende_nel_raggio(lat, lon, raggio, filtri)
+            if len(trovate) >= necessari or raggio >= RAGGIO_MAX_KM:
+                break
+            raggio = min(raggio * 4, RAGGIO_MAX_KM)
+
+    pagina = trovate[(page - 1) * per_page:page * per_page]
+    aziende = {a.id: a for a in Azienda.query.filter(Azienda.id.in_([i for _, i in pagina]))} if pagina else {}
+    risultati = [(aziende[i], distanza) for distanza, i in pagina if i in aziende]
+    return risultati, len(trovate) >= necessari
@@ -0,0 +1,215 @@
+import json
+import secrets
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from src.models.user import db
+from src.models.session import ServerSession
+from src.services.cache import TTLCache
+
+# Configurazione
+SESSION_TOKEN_BYTES = 16  # 128 bit -> token di 22 caratteri
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 30  # secondi: limita quanto a lungo un altro worker vede una sessione revocata
+SESSION_SWEEP_INTERVAL = 600  # secondi tra due pulizie delle sessioni scadute
+
+def genera_token():
+    """Genera un token di sessione casuale e compatto"""
+    return secrets.token_urlsafe(SESSION_TOKEN_BYTES)
+
+class SessionStore:
+    """Interfaccia dei backend di sessione"""
+
+    def load(self, token):
+        """Restituisce il dizionario della sessione o None se assente o scaduta"""
+        raise NotImplementedError
+
+    def save(self, token, data, expires_at):
+        """Salva (o sovrascrive) la sessione"""
+        raise NotImplementedError
+
+    def delete(self, token):
+        """Elimina una sessione"""
+        raise NotImplementedError
+
+    def revoke_user(self, user_id, tranne=None):
+        """Elimina tutte le sessioni dell'utente (tranne quella indicata) e restituisce i token revocati"""
+        raise NotImplementedError
+
+    def sweep_expired(self):
+        """Elimina in blocco le sessioni scadute e ne restituisce il numero"""
+        raise NotImplementedError
+
+class DatabaseSessionStore(SessionStore):
+    """
+    Sessioni salvate nella tabella server_session.
+    Usa connessioni Core indipendenti dalla sessione ORM del handler,
+    così salvare la sessione non committa modifiche lasciate in sospeso dalla richiesta
+    """
+
+    table = ServerSession.__table__
+
+    def load(self, token):
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(self.table.c.data, self.table.c.expires_at).where(self.table.c.token == token)
+            ).first()
+        if not row or row.expires_at < datetime.utcnow():
+            return None
+        return json.loads(row.data)
+
+    def save(self, token, data, expires_at):
+        values = {
+            'user_id': data.get('user_id'),
+            'data': json.dumps(data),
+            'expires_at': expires_at,
+            'updated_at': datetime.utcnow(),
+        }
+        with db.engine.begin() as conn:
+            result = conn.execute(self.table.update().where(self.table.c.token == token).values(**values))
+            if result.rowcount == 0:
+                conn.execute(self.table.insert().values(token=token, created_at=datetime.utcnow(), **values))
+
+    def delete(self, token):
+        with db.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.token == token))
+
+    def revoke_user(self, user_id, tranne=None):
+        condizione = self.table.c.user_id == user_id
+        if tranne:
+            condizione = condizione & (self.table.c.token != tranne)
+        with db.engine.begin() as conn:
+            tokens = [row.token for row in conn.execute(db.select(self.table.c.token).where(condizione))]
+            if tokens:
+                conn.execute(self.table.delete().where(self.table.c.token.in_(tokens)))
+        return tokens
+
+    def sweep_expired(self):
+        with db.engine.begin() as conn:
+            result = conn.execute(self.table.delete().where(self.table.c.expires_at < datetime.utcnow()))
+        return result.rowcount
+
+class CachedSessionStore(SessionStore):
+    """Store con una cache LRU in memoria davanti a un backend persistente"""
+
+    def __init__(self, backend, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.backend = backend
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def load(self, token):
+        data = self.cache.get(token)
+        if data is None:
+            data = self.backend.load(token)
+            if data is None:
+                return None
+            self.cache.set(token, data)
+        return dict(data)
+
+    def save(self, token, data, expires_at):
+        self.backend.save(token, data, expires_at)
+        self.cache.set(token, dict(data))
+
+    def delete(self, token):
+        self.cache.invalidate(token)
+        self.backend.delete(token)
+
+    def revoke_user(self, user_id, tranne=None):
+        tokens = self.backend.revoke_user(user_id, tranne=tranne)
+        for token in tokens:
+            self.cache.invalidate(token)
+        return tokens
+
+    def sweep_expired(self):
+        return self.backend.sweep_expired()
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Sessione il cui contenuto vive sul server; nel cookie viaggia solo il token"""
+
+    def __init__(self, initial=None, token=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.token = token
+        self.new = new
+        self.modified = False
+        self.rigenera = False
+
+    def clear(self):
+        # Dopo clear() (login/logout) il token viene sostituito per evitare session fixation
+        super().clear()
+        self.rigenera = True
+
+class ServerSideSessionInterface(SessionInterface):
+    """SessionInterface Flask basata su un SessionStore"""
+
+    def __init__(self, store, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._ultima_pulizia = time.monotonic()
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        token = request.cookies.get(self.get_cookie_name(app))
+        if token:
+            data = self.store.load(token)
+            if data is not None:
+                return ServerSideSession(data, token=token)
+        return ServerSideSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        self._forse_pulisci()
+
+        if session.token and (session.rigenera or not session):
+            self.store.delete(session.token)
+            session.token = None
+
+        if not session:
+            if session.modified:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified and session.token:
+            return
+
+        if session.token is None:
+            session.token = genera_token()
+
+        expires_at = datetime.utcnow() + app.permanent_session_lifetime
+        self.store.save(session.token, dict(session), expires_at)
+
+        response.set_cookie(
+            name,
+            session.token,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def revoke_user_sessions(self, user_id, tranne=None):
+        """Revoca tutte le sessioni dell'utente, eventualmente mantenendo quella corrente"""
+        return self.store.revoke_user(user_id, tranne=tranne)
+
+    def _forse_pulisci(self):
+        # Pulizia periodica delle sessioni scadute, eseguita da una sola richiesta per intervallo
+        with self._lock:
+            if time.monotonic() - self._ultima_pulizia < self.sweep_interval:
+                return
+            self._ultima_pulizia = time.monotonic()
+        self.store.sweep_expired()
+
+def revoke_user_sessions(user_id, tranne=None):
+    """Revoca le sessioni dell'utente se l'app usa le sessioni lato server"""
+    interface = current_app.session_interface
+    if isinstance(interface, ServerSideSessionInterface):
+        return interface.revoke_user_sessions(user_id, tranne=tranne)
+    return []
@@ -0,0 +1,52 @@
+from src.services.outbox import sottoscrivi
+from src.services.eventi import pubblica
+from src.services.ricerca import indice_conversazioni
+from src.services.matching import motore_matching
+from src.services.ricerca_aziende import azienda_aggiornata, azienda_eliminata
+
+# Reazioni agli eventi dell'outbox, tutte in un posto. I sottoscrittori globali vengono eseguiti
+# una volta per evento dal dispatcher; quelli locali in ogni processo e non possono usare il database
+
+# Campi del payload che restano lato server (non vengono inviati nelle notifiche push)
+CAMPI_INTERNI = ('promotore_id', 'azienda_id', 'testo')
+
+# Eventi dell'azienda che servono solo agli indici in memoria (nessuna notifica push)
+EVENTI_INDICI_AZIENDE = ('azienda_aggiornata', 'azienda_eliminata')
+
+@sottoscrivi('richiesta')
+def notifica_parti_richiesta(evento):
+    """Notifica push a entrambe le parti della richiesta"""
+    dati = evento.dati
+    pubblica(
+        [dati['promotore_id'], dati['azienda_id']],
+        evento.tipo,
+        richiesta_id=evento.aggregato_id,
+        **{campo: valore for campo, valore in dati.items() if campo not in CAMPI_INTERNI}
+    )
+
+@sottoscrivi('richiesta', locale=True)
+def indicizza_conversazione(evento):
+    """Aggiorna l'indice locale delle conversazioni con la nuova richiesta o il nuovo messaggio"""
+    dati = evento.dati
+    if evento.tipo == 'richiesta_nuova':
+        indice_conversazioni.aggiungi_richiesta(evento.aggregato_id, dati['promotore_id'], dati['azienda_id'], dati['testo'])
+    elif evento.tipo == 'messaggio_nuovo':
+        indice_conversazioni.aggiungi_messaggio(
+            dati['messaggio_id'], dati['testo'], evento.aggregato_id, dati['promotore_id'], dati['azienda_id']
+        )
+
+@sottoscrivi('azienda')
+def notifica_azienda(evento):
+    """Notifica push all'azienda (perk e abbonamento, utile alle altre sessioni aperte)"""
+    if evento.tipo not in EVENTI_INDICI_AZIENDE:
+        pubblica([evento.aggregato_id], evento.tipo, **evento.dati)
+
+@sottoscrivi('azienda', locale=True)
+def aggiorna_indici_aziende(evento):
+    """Indici di ricerca e autocompletamento e matrice del matching; i perk attivi entrano nel punteggio"""
+    if evento.tipo == 'azienda_aggiornata':
+        azienda_aggiornata(evento.aggregato_id, evento.dati)
+    elif evento.tipo == 'azienda_eliminata':
+        azienda_eliminata(evento.aggregato_id)
+    elif evento.tipo in ('perk_attivato', 'perk_disattivato', 'perk_scaduto'):
+        motore_matching.invalida_aziende()
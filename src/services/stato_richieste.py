@@ -0,0 +1,137 @@
+from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.orm.attributes import set_committed_value
+from src.models.user import db, Richiesta
+from src.models.contatori import applica_delta
+from src.services.eventi import registra_evento_richiesta
+from src.services.outbox import registra_evento
+
+# Tabella delle transizioni: stato attuale -> {azione: nuovo stato}.
+# Gli stati finali non compaiono come chiave, quindi non ammettono transizioni
+TRANSIZIONI = {
+    'In sospeso': {
+        'accetta': 'Accettata',
+        'rifiuta': 'Rifiutata',
+        'controproposta': 'Controproposta',
+        'negozia': 'In negoziazione',
+    },
+    'Controproposta': {
+        'accetta': 'Accettata',
+        'rifiuta': 'Rifiutata',
+        'negozia': 'In negoziazione',
+    },
+    'In negoziazione': {
+        'accetta': 'Accettata',
+        'rifiuta': 'Rifiutata',
+        'negozia': 'In negoziazione',
+    },
+}
+
+# Azione innescata da ciascun tipo di messaggio della conversazione
+AZIONE_PER_TIPO_MESSAGGIO = {
+    'messaggio': 'negozia',
+    'controproposta': 'negozia',
+    'accettazione': 'accetta',
+    'rifiuto': 'rifiuta',
+}
+
+# Azioni ammesse nella gestione multipla dell'inbox dell'azienda
+AZIONI_MULTIPLE = ('accetta', 'rifiuta')
+TRANSIZIONI_MULTIPLE_MAX = 500
+
+class TransizioneNonValida(ValueError):
+    """L'azione non è ammessa dallo stato attuale della richiesta (o lo stato è cambiato nel frattempo)"""
+    pass
+
+def nuovo_stato(stato, azione):
+    """Stato di arrivo dell'azione a partire da stato, None se la transizione non è ammessa"""
+    return TRANSIZIONI.get(stato, {}).get(azione)
+
+def stati_di_partenza(azione):
+    """Stati da cui l'azione è ammessa"""
+    return [stato for stato, azioni in TRANSIZIONI.items() if azione in azioni]
+
+def _valori_transizione(stato, adesso):
+    valori = {'stato': stato, 'data_aggiornamento': adesso}
+    if stato == 'Accettata':
+        valori['data_accettazione'] = adesso
+    return valori
+
+def applica_transizione(richiesta, azione):
+    """
+    Applica l'azione alla richiesta con un UPDATE condizionato allo stato letto
+    (WHERE stato = :atteso), aggiornando i contatori e scrivendo l'evento nella stessa transazione.
+    Un'azione che lascia lo stato invariato (ogni messaggio di una negoziazione) aggiorna solo
+    data_aggiornamento, senza evento 'stato_richiesta'.
+    Solleva TransizioneNonValida se l'azione non è ammessa o se un'altra richiesta
+    ha cambiato lo stato nel frattempo. Il commit resta al chiamante
+    """
+    atteso = richiesta.stato
+    stato = nuovo_stato(atteso, azione)
+    if stato is None:
+        raise TransizioneNonValida(f"Azione '{azione}' non consentita per una richiesta {atteso.lower()}")
+
+    adesso = datetime.utcnow()
+    cambia_stato = stato != atteso
+    valori = _valori_transizione(stato, adesso) if cambia_stato else {'data_aggiornamento': adesso}
+    risultato = db.session.execute(
+        update(Richiesta)
+        .where(Richiesta.id == richiesta.id, Richiesta.stato == atteso)
+        .values(**valori)
+        .execution_options(synchronize_session=False)
+    )
+    if risultato.rowcount == 0:
+        raise TransizioneNonValida('La richiesta è stata modificata nel frattempo')
+
+    # Allinea l'oggetto in memoria senza marcarlo come modificato: il listener dei contatori
+    # non deve contare una seconda volta la transizione al prossimo flush
+    for chiave, valore in valori.items():
+        set_committed_value(richiesta, chiave, valore)
+
+    if cambia_stato:
+        applica_delta(db.session.connection(), {richiesta.azienda_id: {atteso: -1, stato: 1}})
+        registra_evento_richiesta(richiesta, 'stato_richiesta')
+    return richiesta
+
+def applica_transizione_multipla(azienda_id, richiesta_ids, azione):
+    """
+    Applica l'azione a più richieste dell'azienda: un UPDATE ... WHERE stato = :atteso
+    per ciascuno stato di partenza ammesso (al più tre istruzioni, indipendentemente dal numero di richieste).
+    Le richieste non dell'azienda o in uno stato che non ammette l'azione restano invariate.
+    Per ogni richiesta aggiornata scrive un evento nell'outbox.
+    Restituisce le righe aggiornate come (id, promotore_id); il commit resta al chiamante
+    """
+    partenze = stati_di_partenza(azione)
+    if azione not in AZIONI_MULTIPLE or not partenze or not richiesta_ids:
+        return []
+
+    # Le azioni multiple portano allo stesso stato finale da qualsiasi stato di partenza
+    stato = nuovo_stato(partenze[0], azione)
+    valori = _valori_transizione(stato, datetime.utcnow())
+    aggiornate = []
+    delta = {}
+    for atteso in partenze:
+        righe = db.session.execute(
+            update(Richiesta)
+            .where(
+                Richiesta.azienda_id == azienda_id,
+                Richiesta.id.in_(richiesta_ids),
+                Richiesta.stato == atteso
+            )
+            .values(**valori)
+            .returning(Richiesta.id, Richiesta.promotore_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if righe:
+            delta[atteso] = -len(righe)
+            delta[stato] = delta.get(stato, 0) + len(righe)
+            aggiornate.extend(righe)
+
+    if delta:
+        applica_delta(db.session.connection(), {azienda_id: delta})
+    for richiesta_id, promotore_id in aggiornate:
+        registra_evento(
+            'richiesta', richiesta_id, 'stato_richiesta',
+            promotore_id=promotore_id, azienda_id=azienda_id, stato=stato
+        )
+    return aggiornate
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import event, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from src.models.user import db, violazione_unicita
+from src.models.task import Task, PRIORITA_NORMALE
+
+logger = logging.getLogger(__name__)
+
+# Numero di thread del pool (variabile d'ambiente TASK_WORKERS)
+TASK_WORKERS_DEFAULT = 2
+
+# Attesa massima tra due controlli della coda quando non arrivano notifiche
+INTERVALLO_POLLING_SECONDI = 2.0
+
+# Backoff esponenziale tra i tentativi: 5s, 10s, 20s, ... fino a un'ora
+BACKOFF_BASE_SECONDI = 5
+BACKOFF_MAX_SECONDI = 3600
+
+# Un task in esecuzione da più di così è considerato abbandonato (worker terminato) e torna in coda
+TIMEOUT_ESECUZIONE = timedelta(minutes=30)
+
+class GestoreTask:
+    """Funzione registrata per un nome di task, con i valori predefiniti per l'accodamento"""
+
+    def __init__(self, funzione, priorita, max_tentativi, al_fallimento):
+        self.funzione = funzione
+        self.priorita = priorita
+        self.max_tentativi = max_tentativi
+        self.al_fallimento = al_fallimento
+
+_gestori = {}
+
+def task(nome, priorita=PRIORITA_NORMALE, max_tentativi=5, al_fallimento=None):
+    """
+    Registra la funzione decorata come gestore del task nome.
+    La funzione riceve il payload come argomenti con nome ed è eseguita in un app context;
+    al_fallimento(**payload, errore=...) viene chiamata quando i tentativi sono esauriti
+    """
+    def decoratore(funzione):
+        _gestori[nome] = GestoreTask(funzione, priorita, max_tentativi, al_fallimento)
+        return funzione
+    return decoratore
+
+def accoda(nome, priorita=None, ritardo_secondi=0, chiave=None, **payload):
+    """
+    Aggiunge un task alla transazione corrente: viene eseguito solo se il chiamante fa commit.
+    Con una chiave, se esiste già un task in coda con la stessa chiave non ne crea un altro e restituisce None
+    """
+    gestore = _gestori.get(nome)
+    if gestore is None:
+        raise ValueError(f"Task '{nome}' non registrato")
+
+    nuovo = Task(
+        nome=nome,
+        payload=json.dumps(payload),
+        priorita=gestore.priorita if priorita is None else priorita,
+        chiave=chiave,
+        max_tentativi=gestore.max_tentativi,
+        esegui_dopo=datetime.utcnow() + timedelta(seconds=ritardo_secondi)
+    )
+    try:
+        with db.session.begin_nested():
+            db.session.add(nuovo)
+    except IntegrityError as e:
+        if not violazione_unicita(e):
+            raise
+        return None
+
+    # I worker vengono svegliati al commit, quando il task diventa visibile
+    db.session.info['task_accodati'] = True
+    return nuovo
+
+@event.listens_for(Session, 'after_commit')
+def _sveglia_worker(session):
+    if session.info.pop('task_accodati', False):
+        pool_task.sveglia()
+
+def ritardo_backoff(tentativi):
+    """Attesa prima del tentativo successivo al tentativo numero tentativi"""
+    return timedelta(seconds=min(BACKOFF_BASE_SECONDI * 2 ** (tentativi - 1), BACKOFF_MAX_SECONDI))
+
+def _preleva():
+    """
+    Riserva il prossimo task eseguibile con un UPDATE condizionato allo stato 'In coda':
+    se un altro worker lo ha preso per primo si passa al candidato successivo
+    """
+    adesso = datetime.utcnow()
+    candidati = db.session.scalars(
+        select(Task.id)
+        .where(Task.stato == 'In coda', Task.esegui_dopo <= adesso)
+        .order_by(Task.priorita, Task.esegui_dopo, Task.id)
+        .limit(10)
+        .with_for_update(skip_locked=True)
+    ).all()
+    for task_id in candidati:
+        risultato = db.session.execute(
+            update(Task)
+            .where(Task.id == task_id, Task.stato == 'In coda')
+            .values(stato='In esecuzione', started_at=adesso, tentativi=Task.tentativi + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if risultato.rowcount:
+            db.session.commit()
+            return db.session.get(Task, task_id)
+    db.session.commit()
+    return None
+
+def _esegui(task_corrente):
+    gestore = _gestori.get(task_corrente.nome)
+    task_id = task_corrente.id
+    try:
+        if gestore is None:
+            raise ValueError(f"Task '{task_corrente.nome}' non registrato")
+        gestore.funzione(**task_corrente.argomenti)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        task_corrente = db.session.get(Task, task_id)
+        task_corrente.errore = str(e)
+        if gestore is not None and task_corrente.tentativi < task_corrente.max_tentativi:
+            task_corrente.stato = 'In coda'
+            task_corrente.esegui_dopo = datetime.utcnow() + ritardo_backoff(task_corrente.tentativi)
+            logger.warning(f"Task {task_corrente.nome} ({task_id}) fallito, nuovo tentativo: {e}")
+        else:
+            task_corrente.stato = 'Fallito'
+            task_corrente.completed_at = datetime.utcnow()
+            logger.error(f"Task {task_corrente.nome} ({task_id}) fallito definitivamente: {e}")
+        try:
+            db.session.commit()
+        except IntegrityError as errore_commit:
+            # Nel frattempo è stato accodato un task con la stessa chiave: farà lui il lavoro
+            if not violazione_unicita(errore_commit):
+                raise
+            db.session.rollback()
+            task_corrente = db.session.get(Task, task_id)
+            task_corrente.stato = 'Fallito'
+            task_corrente.errore = f'{e} (sostituito da un task in coda con la stessa chiave)'
+            task_corrente.completed_at = datetime.utcnow()
+            db.session.commit()
+            return
+
+        if task_corrente.stato == 'Fallito' and gestore is not None and gestore.al_fallimento:
+            try:
+                gestore.al_fallimento(**task_corrente.argomenti, errore=str(e))
+                db.session.commit()
+            except Exception as errore_callback:
+                db.session.rollback()
+                logger.error(f"Errore nella gestione del fallimento di {task_corrente.nome}: {errore_callback}")
+        return
+
+    task_corrente = db.session.get(Task, task_id)
+    task_corrente.stato = 'Completato'
+    task_corrente.errore = None
+    task_corrente.completed_at = datetime.utcnow()
+    db.session.commit()
+
+def recupera_abbandonati():
+    """Rimette in coda i task rimasti in esecuzione oltre il timeout (worker terminato a metà)"""
+    in_coda = aliased(Task)
+    chiavi_in_coda = select(in_coda.chiave).where(in_coda.stato == 'In coda', in_coda.chiave.isnot(None))
+    risultato = db.session.execute(
+        update(Task)
+        .where(
+            Task.stato == 'In esecuzione',
+            Task.started_at < datetime.utcnow() - TIMEOUT_ESECUZIONE,
+            # Non duplicare un task già rimesso in coda con la stessa chiave
+            or_(Task.chiave.is_(None), Task.chiave.notin_(chiavi_in_coda))
+        )
+        .values(stato='In coda', esegui_dopo=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return risultato.rowcount
+
+class PoolTask:
+    """Thread che prelevano ed eseguono i task persistiti nella tabella task"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sveglia = threading.Event()
+        self._fermo = threading.Event()
+        self._threads = []
+        self._app = None
+
+    def avvia(self, app, workers=None):
+        """Avvia i worker (una sola volta) dopo aver recuperato i task abbandonati"""
+        with self._lock:
+            if self._threads:
+                return
+            self._app = app
+            with app.app_context():
+                recuperati = recupera_abbandonati()
+                if recuperati:
+                    logger.info(f"{recuperati} task abbandonati rimessi in coda")
+
+            numero = workers or int(os.environ.get('TASK_WORKERS', TASK_WORKERS_DEFAULT))
+            self._fermo.clear()
+            for i in range(numero):
+                thread = threading.Thread(target=self._ciclo, name=f'task-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def ferma(self):
+        self._fermo.set()
+        self._sveglia.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def sveglia(self):
+        """Segnala ai worker che potrebbe esserci un nuovo task"""
+        self._sveglia.set()
+
+    def esegui_in_coda(self, app=None):
+        """Esegue nel thread corrente tutti i task già eseguibili (script di manutenzione e test)"""
+        with (app or self._app).app_context():
+            eseguiti = 0
+            while (task_corrente := _preleva()) is not None:
+                _esegui(task_corrente)
+                eseguiti += 1
+            return eseguiti
+
+    def _ciclo(self):
+        while not self._fermo.is_set():
+            try:
+                with self._app.app_context():
+                    task_corrente = _preleva()
+                    if task_corrente is not None:
+                        _esegui(task_corrente)
+                        continue
+            except Exception as e:
+                logger.error(f"Errore nel worker dei task: {e}")
+            self._sveglia.wait(INTERVALLO_POLLING_SECONDI)
+            self._sveglia.clear()
+
+pool_task = PoolTask()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Aggiunge alle aziende le colonne delle coordinate e le valorizza geocodificando
+la località di ciascuna azienda con il gazetteer offline.
+"""
+
+import os
+import sys
+
+# Aggiungi il percorso del progetto
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.models.user import db, Azienda
+from src.services.geo import geocodifica, geohash
+from flask import Flask
+from sqlalchemy import inspect, text
+
+COLONNE = {
+    'latitudine': 'FLOAT',
+    'longitudine': 'FLOAT',
+    'geohash': 'VARCHAR(12)',
+}
+
+def update_database():
+    """Crea le colonne mancanti, geocodifica le aziende esistenti e crea l'indice sul geohash"""
+
+    # Configura l'app Flask (DATABASE_URL permette di puntare al database di produzione)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL',
+        f"sqlite:///{os.path.join(os.path.dirname(__file__), 'src', 'database', 'app.db')}"
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Inizializza il database
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            print("🔄 Aggiornamento coordinate delle aziende...")
+
+            esistenti = {c['name'] for c in inspect(db.engine).get_columns('azienda')}
+            with db.engine.begin() as conn:
+                for nome, tipo in COLONNE.items():
+                    if nome not in esistenti:
+                        conn.execute(text(f'ALTER TABLE azienda ADD COLUMN {nome} {tipo}'))
+                        print(f"  ✅ Colonna {nome} aggiunta")
+
+            riconosciute, sconosciute = 0, []
+            for azienda_id, localita in db.session.query(Azienda.id, Azienda.localita).all():
+                coordinate = geocodifica(localita)
+                valori = {'latitudine': None, 'longitudine': None, 'geohash': None}
+                if coordinate:
+                    valori = {'latitudine': coordinate[0], 'longitudine': coordinate[1], 'geohash': geohash(*coordinate)}
+                    riconosciute += 1
+                else:
+                    sconosciute.append(localita)
+                db.session.query(Azienda).filter_by(id=azienda_id).update(valori, synchronize_session=False)
+            db.session.commit()
+
+            for index in Azienda.__table__.indexes:
+                if index.name == 'ix_azienda_geohash':
+                    index.create(bind=db.engine, checkfirst=True)
+
+            print(f"\n✅ {riconosciute} aziende geocodificate")
+            if sconosciute:
+                print(f"⚠️  {len(sconosciute)} località non presenti nel gazetteer: {', '.join(sorted(set(sconosciute))[:20])}")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Errore nell'aggiornamento del database: {e}")
+            return False
+
+    return True
+
+if __name__ == '__main__':
+    success = update_database()
+
+    if success:
+        print("\n🎉 Aggiornamento completato con successo!")
+    else:
+        print("\n💥 Aggiornamento fallito!")
+        sys.exit(1)
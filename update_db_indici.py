@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Script per creare tabelle e indici mancanti su un database esistente.
+db.create_all() non aggiunge indici a tabelle già presenti: questo script li crea uno per uno.
+Crea anche i contatori della dashboard mancanti (--ricostruisci-contatori li ricalcola tutti).
+"""
+
+import os
+import sys
+
+# Aggiungi il percorso del progetto
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.models.user import db
+from src.models import user, messaggio, leaderboard, perk_points, session, contatori, raccomandazioni, eliminazione, task, outbox, screenshot  # Registra tutti i modelli
+from flask import Flask
+from sqlalchemy import text
+
+def update_database():
+    """Crea le tabelle e gli indici definiti nei modelli che non esistono ancora"""
+
+    # Configura l'app Flask (DATABASE_URL permette di puntare al database di produzione)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL',
+        f"sqlite:///{os.path.join(os.path.dirname(__file__), 'src', 'database', 'app.db')}"
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Inizializza il database
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            print("🔄 Aggiornamento tabelle e indici...")
+            if db.engine.dialect.name == 'postgresql':
+                # Richiesta dagli indici a trigrammi (gin_trgm_ops)
+                with db.engine.begin() as conn:
+                    conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            db.create_all()
+
+            creati = 0
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(bind=db.engine, checkfirst=True)
+                    print(f"  ✅ {table.name}: {index.name}")
+                    creati += 1
+
+            print(f"\n✅ {creati} indici verificati")
+
+            # Contatori della dashboard: una riga per azienda, creata con l'azienda.
+            # Si creano quelle mancanti; con --ricostruisci-contatori si ricalcolano tutte (riparazione delle derive)
+            aziende = db.session.query(user.Azienda.id)
+            if '--ricostruisci-contatori' not in sys.argv:
+                aziende = aziende.filter(~user.Azienda.id.in_(db.session.query(contatori.ContatoriRichieste.azienda_id)))
+            azienda_ids = [azienda_id for azienda_id, in aziende.all()]
+            for azienda_id in azienda_ids:
+                contatori.ContatoriRichieste.ricostruisci(azienda_id)
+                db.session.commit()
+            print(f"✅ Contatori ricalcolati per {len(azienda_ids)} aziende")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Errore nell'aggiornamento del database: {e}")
+            return False
+
+    return True
+
+if __name__ == '__main__':
+    success = update_database()
+
+    if success:
+        print("\n🎉 Aggiornamento completato con successo!")
+    else:
+        print("\n💥 Aggiornamento fallito!")
+        sys.exit(1)
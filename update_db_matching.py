@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Aggiunge ai promotori le colonne usate dal motore di raccomandazione delle aziende
+(pubblico medio dichiarato, località e relative coordinate).
+"""
+
+import os
+import sys
+
+# Aggiungi il percorso del progetto
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.models.user import db
+from flask import Flask
+from sqlalchemy import inspect, text
+
+COLONNE = {
+    'visualizzazioni_medie': 'INTEGER',
+    'localita': 'VARCHAR(255)',
+    'latitudine': 'FLOAT',
+    'longitudine': 'FLOAT',
+}
+
+def update_database():
+    """Crea le colonne mancanti nella tabella promotore"""
+
+    # Configura l'app Flask (DATABASE_URL permette di puntare al database di produzione)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL',
+        f"sqlite:///{os.path.join(os.path.dirname(__file__), 'src', 'database', 'app.db')}"
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Inizializza il database
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            print("🔄 Aggiornamento tabella promotore...")
+
+            esistenti = {c['name'] for c in inspect(db.engine).get_columns('promotore')}
+            with db.engine.begin() as conn:
+                for nome, tipo in COLONNE.items():
+                    if nome not in esistenti:
+                        conn.execute(text(f'ALTER TABLE promotore ADD COLUMN {nome} {tipo}'))
+                        print(f"  ✅ Colonna {nome} aggiunta")
+                    else:
+                        print(f"  ✔️  Colonna {nome} già presente")
+
+        except Exception as e:
+            print(f"❌ Errore nell'aggiornamento del database: {e}")
+            return False
+
+    return True
+
+if __name__ == '__main__':
+    success = update_database()
+
+    if success:
+        print("\n🎉 Aggiornamento completato con successo!")
+    else:
+        print("\n💥 Aggiornamento fallito!")
+        sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Crea le tabelle dell'archivio screenshot per hash e vi importa i file caricati in precedenza
+in uploads/screenshots/<user_id>. I file importati vengono rimossi dalla vecchia cartella.
+"""
+
+import os
+import sys
+from datetime import datetime
+
+# Aggiungi il percorso del progetto
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from src.models.user import db, User
+from src.models import task, screenshot  # Registra i modelli
+from src.services.archivio_screenshot import scrivi_stream, archivia, TIPI_MIME
+from flask import Flask
+
+CARTELLA_PRECEDENTE = 'uploads/screenshots'
+
+def _nome_e_data(filename):
+    """I vecchi file si chiamano <timestamp>_<nome originale>"""
+    prefisso, _, nome = filename.partition('_')
+    if prefisso.isdigit() and nome:
+        return nome, datetime.utcfromtimestamp(int(prefisso))
+    return filename, None
+
+def update_database():
+    """Crea le tabelle mancanti e importa i file della vecchia cartella"""
+
+    # Configura l'app Flask (DATABASE_URL permette di puntare al database di produzione)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL',
+        f"sqlite:///{os.path.join(os.path.dirname(__file__), 'src', 'database', 'app.db')}"
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    # Inizializza il database
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            print("🔄 Creazione tabelle dell'archivio screenshot...")
+            db.create_all()
+
+            if not os.path.isdir(CARTELLA_PRECEDENTE):
+                print("  ✔️  Nessun file da importare")
+                return True
+
+            importati = 0
+            for cartella in sorted(os.listdir(CARTELLA_PRECEDENTE)):
+                percorso_cartella = os.path.join(CARTELLA_PRECEDENTE, cartella)
+                if not cartella.isdigit() or not os.path.isdir(percorso_cartella):
+                    continue
+                user = db.session.get(User, int(cartella))
+                if user is None:
+                    print(f"  ⚠️  Utente {cartella} inesistente: cartella ignorata")
+                    continue
+
+                importati_utente = []
+                for filename in sorted(os.listdir(percorso_cartella)):
+                    estensione = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+                    if estensione not in TIPI_MIME:
+                        continue
+                    percorso = os.path.join(percorso_cartella, filename)
+                    with open(percorso, 'rb') as file:
+                        scrittura = scrivi_stream(file)
+                    nome, caricato_il = _nome_e_data(filename)
+                    # Il file entra nell'archivio al commit (e viene scartato con il rollback)
+                    nuovo_screenshot, nuovo = archivia(scrittura, user.id, TIPI_MIME[estensione], nome)
+                    if nuovo and caricato_il:
+                        nuovo_screenshot.created_at = caricato_il
+                    importati_utente.append(percorso)
+
+                # I vecchi file si rimuovono solo dopo il commit dei riferimenti
+                db.session.commit()
+                for percorso in importati_utente:
+                    os.unlink(percorso)
+                if not os.listdir(percorso_cartella):
+                    os.rmdir(percorso_cartella)
+                importati += len(importati_utente)
+                print(f"  ✅ Utente {cartella}: {len(importati_utente)} file importati")
+
+            print(f"\n✅ {importati} file importati nell'archivio")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Errore nell'aggiornamento del database: {e}")
+            return False
+
+    return True
+
+if __name__ == '__main__':
+    success = update_database()
+
+    if success:
+        print("\n🎉 Aggiornamento completato con successo!")
+    else:
+        print("\n💥 Aggiornamento fallito!")
+        sys.exit(1)